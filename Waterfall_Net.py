@@ -1,7 +1,7 @@
 from os.path import exists, join
 from os import makedirs
-from sklearn.metrics import confusion_matrix
 from helper_tool import DataProcessing as DP
+from helper_metrics import ConfusionAccumulator
 import tensorflow as tf
 import numpy as np
 import helper_tf_util
@@ -90,6 +90,18 @@ class Network:
             self.accuracy = tf.reduce_mean(tf.cast(self.correct_prediction, tf.float32))
             self.prob_logits = tf.nn.softmax(self.logits)
 
+            # Confusion matrix of the valid points accumulated in the graph during evaluation, only C*C values are
+            # fetched at the end (local variable, so not saved in the snapshots)
+            num_classes = self.config.num_classes
+            self.confusion = tf.Variable(tf.zeros([num_classes, num_classes], dtype=tf.int64), trainable=False,
+                                         name='confusion', collections=[tf.GraphKeys.LOCAL_VARIABLES])
+            valid_preds = tf.argmax(valid_logits, axis=1, output_type=tf.int32)
+            batch_confusion = tf.bincount(valid_labels * num_classes + valid_preds, minlength=num_classes ** 2,
+                                          maxlength=num_classes ** 2, dtype=tf.int64)
+            self.confusion_update_op = tf.assign_add(self.confusion,
+                                                     tf.reshape(batch_confusion, [num_classes, num_classes]))
+            self.confusion_reset_op = tf.variables_initializer([self.confusion])
+
             tf.summary.scalar('learning_rate', self.learning_rate)
             tf.summary.scalar('loss', self.loss)
             tf.summary.scalar('accuracy', self.accuracy)
@@ -264,48 +276,22 @@ class Network:
 
         # Initialise iterator with validation data
         self.sess.run(dataset.val_init_op)
-
-        gt_classes = [0 for _ in range(self.config.num_classes)]
-        positive_classes = [0 for _ in range(self.config.num_classes)]
-        true_positive_classes = [0 for _ in range(self.config.num_classes)]
-        val_total_correct = 0
-        val_total_seen = 0
+        self.sess.run(self.confusion_reset_op)
 
         for step_id in range(self.config.val_steps):
             if step_id % 50 == 0:
                 print(str(step_id) + '/' + str(self.config.val_steps))
             try:
-                ops = (self.prob_logits, self.labels, self.accuracy)
-                stacked_prob, labels, acc = self.sess.run(ops, {self.is_training: False})
-                pred = np.argmax(stacked_prob, 1)
-                if not self.config.ignored_label_inds:
-                    pred_valid = pred
-                    labels_valid = labels
-                else:
-                    invalid_idx = np.where(labels == self.config.ignored_label_inds)[0]
-                    labels_valid = np.delete(labels, invalid_idx)
-                    labels_valid = labels_valid - 1
-                    pred_valid = np.delete(pred, invalid_idx)
-
-                correct = np.sum(pred_valid == labels_valid)
-                val_total_correct += correct
-                val_total_seen += len(labels_valid)
-
-                conf_matrix = confusion_matrix(labels_valid, pred_valid, np.arange(0, self.config.num_classes, 1))
-                gt_classes += np.sum(conf_matrix, axis=1)
-                positive_classes += np.sum(conf_matrix, axis=0)
-                true_positive_classes += np.diagonal(conf_matrix)
-
+                # the confusion of the valid points is accumulated in the graph, nothing is fetched per step
+                self.sess.run(self.confusion_update_op, {self.is_training: False})
             except tf.errors.OutOfRangeError:
                 break
 
-        iou_list = []
-        for n in range(0, self.config.num_classes, 1):
-            iou = true_positive_classes[n] / float(gt_classes[n] + positive_classes[n] - true_positive_classes[n])
-            iou_list.append(iou)
-        mean_iou = sum(iou_list) / float(self.config.num_classes)
+        confusion = ConfusionAccumulator(self.config.num_classes).merge(self.sess.run(self.confusion))
+        iou_list = confusion.ious()
+        mean_iou = confusion.mean_iou()
 
-        log_out('eval accuracy: {}'.format(val_total_correct / float(val_total_seen)), self.Log_file)
+        log_out('eval accuracy: {}'.format(confusion.overall_accuracy()), self.Log_file)
         log_out('mean IoU: {}'.format(mean_iou), self.Log_file)
 
         mean_iou = 100 * mean_iou
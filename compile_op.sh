@@ -1,5 +1,6 @@
 cd utils/nearest_neighbors
 python setup.py install --home="."
+sh compile_tf_op.sh
 cd ../../
 
 cd utils/cpp_wrappers
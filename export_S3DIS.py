@@ -0,0 +1,78 @@
+from Waterfall_Net import Network
+from main_S3DIS import choose_snapshot
+from helper_tool import ConfigS3DIS as cfg
+import helper_tf_util
+import tensorflow as tf
+import argparse, os
+
+
+class InferenceNetwork(Network):
+    """
+    Layers of the network alone, on placeholders of the input pyramid of S3DIS.get_tf_mapping2: no input pipeline,
+    dropout, loss, optimizer or summaries
+    """
+
+    def __init__(self, config):
+        self.config = config
+        num_layers = self.config.num_layers
+
+        with tf.variable_scope('inputs'):
+            self.inputs = dict()
+            for key, dtype, dim in [('xyz', tf.float32, 3), ('neigh_idx', tf.int32, None), ('sub_idx', tf.int32, None),
+                                    ('interp_idx', tf.int32, None), ('sub_xyz', tf.float32, 3)]:
+                self.inputs[key] = [tf.placeholder(dtype, [None, None, dim], name='{:s}_{:d}'.format(key, i))
+                                    for i in range(num_layers)]
+            self.inputs['backbone1'] = tf.placeholder(tf.int32, [None, None, None], name='backbone1')
+            self.inputs['backbone2'] = tf.placeholder(tf.int32, [None, None, None], name='backbone2')
+            self.inputs['features'] = tf.placeholder(tf.float32, [None, None, 6], name='features')
+
+        with tf.variable_scope('layers'):
+            self.logits = self.inference(self.inputs, False)
+
+        with tf.variable_scope('results'):
+            self.prob_logits = tf.nn.softmax(self.logits, name='probs')
+
+    @staticmethod
+    def flat_input_names(config):
+        # placeholder names in the order of the flat inputs of get_tf_mapping2
+        names = []
+        for key in ['xyz', 'neigh_idx', 'sub_idx', 'interp_idx', 'sub_xyz']:
+            names += ['inputs/{:s}_{:d}'.format(key, i) for i in range(config.num_layers)]
+        return names + ['inputs/backbone1', 'inputs/backbone2', 'inputs/features']
+
+
+def export(restore_snap, output_file):
+    """
+    Restore a snapshot in the inference network, freeze it and fold its batch normalizations
+    :return: input names, output name
+    """
+    with tf.Graph().as_default() as graph:
+        model = InferenceNetwork(cfg)
+        output_name = model.prob_logits.op.name
+        saver = tf.train.Saver(tf.global_variables())
+        with tf.Session() as sess:
+            saver.restore(sess, restore_snap)
+            graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), [output_name])
+
+    input_names = InferenceNetwork.flat_input_names(cfg)
+    graph_def, num_folded = helper_tf_util.fold_batch_norms(graph_def)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=input_names + [output_name])
+    graph_def = tf.graph_util.extract_sub_graph(graph_def, [output_name])
+    with tf.gfile.GFile(output_file, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+
+    print('{:d} batch normalizations folded, {:d} nodes, {:.1f} MB written to {:s}'.format(
+        num_folded, len(graph_def.node), os.path.getsize(output_file) / 1e6, output_file))
+    return input_names, output_name
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, default='None', help='snapshot to export [default: last one]')
+    parser.add_argument('--output', type=str, default='waterfall_net.pb', help='frozen GraphDef file')
+    FLAGS = parser.parse_args()
+
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+    input_names, output_name = export(choose_snapshot(FLAGS.model_path), FLAGS.output)
+    print('inputs: ' + ', '.join(input_names))
+    print('output: ' + output_name)
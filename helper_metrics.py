@@ -0,0 +1,64 @@
+import numpy as np
+
+
+class ConfusionAccumulator:
+    """
+    Streaming confusion matrix of a semantic segmentation, rows are the labels and columns the predictions.
+    Each update is a single bincount over label * C + pred, and accumulators of different batches, rooms or processes
+    can be merged (the matrix is a plain int64 array, so it can be pickled or summed).
+    :param num_classes: number of classes C
+    """
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+
+    def update(self, labels, preds):
+        """
+        Add the points of a batch or a cloud
+        :param labels: ground truth classes in [0, C), any shape
+        :param preds: predicted classes in [0, C), same number of points
+        :return: self
+        """
+        labels = np.asarray(labels, dtype=np.int64).reshape(-1)
+        preds = np.asarray(preds, dtype=np.int64).reshape(-1)
+        C = self.num_classes
+        self.confusion += np.bincount(labels * C + preds, minlength=C * C).reshape(C, C)
+        return self
+
+    def merge(self, other):
+        """
+        Add the points of another accumulator (or of a C*C confusion matrix)
+        :return: self
+        """
+        confusion = other.confusion if isinstance(other, ConfusionAccumulator) else np.asarray(other)
+        self.confusion += confusion.astype(np.int64)
+        return self
+
+    def reset(self):
+        self.confusion[:] = 0
+
+    @property
+    def num_points(self):
+        return int(np.sum(self.confusion))
+
+    def overall_accuracy(self):
+        return np.trace(self.confusion) / float(max(self.num_points, 1))
+
+    def class_accuracies(self):
+        # recall of each class, 0 for the classes absent from the labels
+        TP = np.diagonal(self.confusion)
+        TP_plus_FN = np.sum(self.confusion, axis=1)
+        return TP / np.maximum(TP_plus_FN, 1).astype(np.float64)
+
+    def mean_accuracy(self):
+        return float(np.mean(self.class_accuracies()))
+
+    def ious(self):
+        # IoU of each class, 0 for the classes neither in the labels nor in the predictions
+        TP = np.diagonal(self.confusion)
+        union = np.sum(self.confusion, axis=1) + np.sum(self.confusion, axis=0) - TP
+        return TP / np.maximum(union, 1).astype(np.float64)
+
+    def mean_iou(self):
+        return float(np.mean(self.ious()))
@@ -210,7 +210,86 @@ def dropout(inputs,
         tensor variable
     """
     with tf.variable_scope(scope) as sc:
+        # a python bool (inference only graph) gives no cond at all
+        if isinstance(is_training, bool):
+            return tf.nn.dropout(inputs, keep_prob, noise_shape) if is_training else inputs
         outputs = tf.cond(is_training,
                           lambda: tf.nn.dropout(inputs, keep_prob, noise_shape),
                           lambda: inputs)
         return outputs
+
+
+def fold_batch_norms(graph_def):
+    """ Fold the inference batch normalizations of conv2d and conv2d_transpose into their weights and biases.
+
+    Args:
+        graph_def: frozen GraphDef (variables converted to constants), built with is_training=False
+
+    Returns:
+        GraphDef where each folded FusedBatchNorm is an Identity of its convolution,
+        number of folded batch normalizations
+
+    Note: conv -> bias_add -> bn(scale, offset, mean, variance) is conv(w * s) -> bias_add((b - mean) * s + offset)
+    with s = scale / sqrt(variance + epsilon), applied along the output channels of the kernel
+    """
+    from tensorflow.python.framework import tensor_util
+    folded_def = tf.GraphDef()
+    folded_def.CopyFrom(graph_def)
+    nodes = {node.name: node for node in folded_def.node}
+
+    def node_name(input_name):
+        return input_name.lstrip('^').split(':')[0]
+
+    num_uses = {}
+    for node in folded_def.node:
+        for input_name in node.input:
+            num_uses[node_name(input_name)] = num_uses.get(node_name(input_name), 0) + 1
+
+    def own_const(input_name):
+        # constant behind the variable reads, only if nothing else uses it
+        node = nodes[node_name(input_name)]
+        while node.op == 'Identity' and num_uses[node.name] == 1:
+            node = nodes[node_name(node.input[0])]
+        return node if node.op == 'Const' and num_uses[node.name] == 1 else None
+
+    num_folded = 0
+    for node in folded_def.node:
+        if node.op not in ('FusedBatchNorm', 'FusedBatchNormV2', 'FusedBatchNormV3') or node.attr['is_training'].b:
+            continue
+        if node.attr['data_format'].s not in (b'', b'NHWC'):
+            continue
+        bias_add = nodes[node_name(node.input[0])]
+        if bias_add.op != 'BiasAdd' or num_uses[bias_add.name] != 1:
+            continue
+        conv = nodes[node_name(bias_add.input[0])]
+        if conv.op == 'Conv2D':
+            channel_axis = 3
+        elif conv.op == 'Conv2DBackpropInput':
+            channel_axis = 2
+        else:
+            continue
+        consts = [own_const(name) for name in [conv.input[1], bias_add.input[1]] + list(node.input[1:5])]
+        if any(const is None for const in consts):
+            continue
+
+        kernel, biases, scale, offset, mean, variance = [tensor_util.MakeNdarray(const.attr['value'].tensor)
+                                                         for const in consts]
+        multiplier = scale / np.sqrt(variance + node.attr['epsilon'].f)
+        shape = [1] * kernel.ndim
+        shape[channel_axis] = -1
+        kernel = (kernel * np.reshape(multiplier, shape)).astype(kernel.dtype)
+        biases = ((biases - mean) * multiplier + offset).astype(biases.dtype)
+        consts[0].attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(kernel))
+        consts[1].attr['value'].tensor.CopyFrom(tensor_util.make_tensor_proto(biases))
+
+        # the batch normalization only forwards the biased convolution now
+        bn_input = node.input[0]
+        dtype = node.attr['T'].type
+        del node.input[:]
+        node.input.append(bn_input)
+        node.op = 'Identity'
+        node.attr.clear()
+        node.attr['T'].type = dtype
+        num_folded += 1
+
+    return folded_def, num_folded
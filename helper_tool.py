@@ -1,7 +1,8 @@
 from open3d import linux as open3d
 from os.path import join
 import numpy as np
-import colorsys, random, os, sys
+import colorsys, random, os, sys, heapq, time
+import multiprocessing
 import pandas as pd
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
@@ -28,6 +29,24 @@ class ConfigS3DIS:
     val_steps = 200  # Number of validation steps per epoch
 
     sub_sampling_ratio = [4, 4, 4, 4, 2]  # sampling ratio of random sampling at each layer
+    knn_op = False  # run the knn searches with the compiled tensorflow op instead of tf.py_func (kd-trees only)
+    knn_threads = 0  # cap of the threads of the omp knn searches, 0 for the omp default (every core)
+    knn_brute_force_npts = 128  # support sets up to this size are searched by brute force instead of a kd-tree
+    knn_backend = 'kdtree'  # 'voxel': voxel grids for the full resolution knn and the crops (exact, needs knn_op off)
+    knn_eps = [0, 0, 0, 0, 0]  # approximation of the training neighbour search of each layer (see DP.knn_recall)
+    num_workers = 0  # number of processes cropping the input regions (0: crop in the tf.data generator)
+    worker_queue_size = 64  # number of cropped input regions buffered by the workers
+    memory_budget = 0  # bytes of sub-sampled clouds kept opened, least recently used ones closed first (0: no limit)
+    test_tiling = True  # test on a fixed greedy tiling of the clouds instead of the random possibility sampler
+    test_tile_overlap = 0.25  # fraction of the radius of a tile overlapping the next tiles
+    test_reproject_workers = 0  # processes projecting the test rooms to their full resolution, 0 for the main process
+    server_batch_timeout = 0.05  # server: seconds a partial batch waits for the crops of other requests
+    infer_votes = 2  # inference: passes over the tiles of each file
+    infer_workers = 2  # inference: processes reading, sub-sampling and tiling the files
+    infer_prefetch = 2  # inference: prepared files waiting for the network
+    test_adaptive = False  # stop test voting once the predictions converge instead of after a fixed number of votes
+    test_change_threshold = 1e-3  # adaptive test: stop when less sub cloud predictions change between two votes
+    test_miou_delta = 1e-3  # adaptive test: stop when the sub cloud mIoU changes less between two votes
     d_out = [16, 64, 128, 256, 512]  # feature dimension
 
     noise_init = 3.5  # noise initial parameter
@@ -95,16 +114,105 @@ class DataProcessing:
         return train_file_list, val_file_list, test_file_list
 
     @staticmethod
-    def knn_search(support_pts, query_pts, k):
+    def knn_search(support_pts, query_pts, k, voxel=False, eps=0):
         """
         :param support_pts: points you have, B*N1*3
         :param query_pts: points you want to know the neighbour index, B*N2*3
         :param k: Number of neighbours in knn search
+        :param voxel: search in voxel grids instead of kd-trees (always exact)
+        :param eps: approximate kd-tree search, the squared distance of the k-th neighbour found is at most (1 + eps)
+                    times the exact one
         :return: neighbor_idx: neighboring points indexes, B*N2*k
         """
 
-        neighbor_idx = nearest_neighbors.knn_batch(support_pts, query_pts, k, omp=True)
-        return neighbor_idx.astype(np.int32)
+        if voxel:
+            return nearest_neighbors.knn_batch_voxel(support_pts, query_pts, k, omp=True)
+        neighbor_idx = nearest_neighbors.knn_batch(support_pts, query_pts, k, omp=True, eps=eps)
+        return neighbor_idx
+
+    @staticmethod
+    def knn_recall(support_pts, query_pts, k, eps, repeat=3):
+        """
+        Quality and speed of the approximate knn search against the exact one
+        :param eps: approximation of DP.knn_search
+        :param repeat: the times are the best of this number of searches
+        :return: recall (fraction of the exact neighbours found), exact search time / approximate search time
+        """
+        times = []
+        for search_eps in [0, eps]:
+            best = np.inf
+            for _ in range(repeat):
+                t0 = time.time()
+                neighbor_idx = DataProcessing.knn_search(support_pts, query_pts, k, eps=search_eps)
+                best = min(best, time.time() - t0)
+            times += [(best, neighbor_idx.reshape(-1, k))]
+        (exact_time, exact_idx), (approx_time, approx_idx) = times
+
+        # ids made unique per query, so that the neighbours of all the queries are compared at once
+        query_ids = np.arange(len(exact_idx), dtype=np.int64)[:, None] * np.shape(support_pts)[1]
+        found = np.isin(approx_idx + query_ids, exact_idx + query_ids)
+        return np.mean(found), exact_time / max(approx_time, 1e-9)
+
+    @staticmethod
+    def pyramid_searches(k_n, num_layers):
+        """
+        :return: the (support level, query level, k) knn searches of the network inputs, in the order of
+                 neighbour indexes, up-sampling indexes, backbone1 and backbone2
+        """
+        searches = [(i, i, k_n) for i in range(num_layers)]
+        searches += [(i + 1, i, 3) for i in range(num_layers)]
+        searches += [(num_layers - 2, 1, 3), (num_layers - 1, 2, 3)]
+        return searches
+
+    @staticmethod
+    def knn_pyramid(batch_xyz, k_n, sub_sampling_ratio, voxel=False, eps=None):
+        """
+        All the knn searches of the sub-sampling pyramid in one call, the kd-tree of each level is built only once
+        :param batch_xyz: input points, B*N*3 (level i is made of the first N_i points of level i-1)
+        :param k_n: Number of neighbours at each level
+        :param sub_sampling_ratio: sub-sampling ratio of each layer
+        :param voxel: search the neighbours of the full resolution level in voxel grids (no kd-tree of this level)
+        :param eps: approximation of the neighbour search of each level, as in knn_search (None: exact searches)
+        :return: num_layers neighbour indexes (B*N_i*k_n), num_layers up-sampling indexes (B*N_i*3),
+                 backbone1 (B*N_1*3) and backbone2 (B*N_2*3) indexes
+        """
+        level_npts = [batch_xyz.shape[1]]
+        for ratio in sub_sampling_ratio:
+            level_npts.append(level_npts[-1] // int(ratio))
+        searches = DataProcessing.pyramid_searches(int(k_n), len(sub_sampling_ratio))
+        # the up-sampling and backbone searches stay exact
+        eps = [0.0] * len(searches) if eps is None else list(eps) + [0.0] * (len(searches) - len(eps))
+        if voxel:
+            # the first search is the only one with the full resolution level as support
+            neighbor_idx = nearest_neighbors.knn_batch_pyramid(batch_xyz, level_npts, searches[1:], omp=True,
+                                                               eps=eps[1:])
+            return [nearest_neighbors.knn_batch_voxel(batch_xyz, batch_xyz, int(k_n), omp=True)] + neighbor_idx
+        neighbor_idx = nearest_neighbors.knn_batch_pyramid(batch_xyz, level_npts, searches, omp=True, eps=eps)
+        return neighbor_idx
+
+    @staticmethod
+    def pyramid_inputs(batch_xyz, batch_colors, k_n, sub_sampling_ratio, voxel=False):
+        """
+        Network inputs of a batch of crops outside of the tf.data pipeline, in the order of S3DIS.get_tf_mapping2
+        :param batch_xyz: B*N*3 crop points
+        :param batch_colors: B*N*3 crop colors
+        :param voxel: as in knn_pyramid
+        :return: num_layers points, neighbour, pooling, up-sampling and sub-sampled points arrays, then backbone1,
+                 backbone2 and features
+        """
+        num_layers = len(sub_sampling_ratio)
+        knn_idx = DataProcessing.knn_pyramid(batch_xyz, k_n, sub_sampling_ratio, voxel)
+        input_points, input_neighbors, input_pools, input_up_samples, input_sub_points = [], [], [], [], []
+        for i in range(num_layers):
+            sub_points = batch_xyz[:, :batch_xyz.shape[1] // sub_sampling_ratio[i], :]
+            input_points.append(batch_xyz)
+            input_neighbors.append(knn_idx[i])
+            input_pools.append(knn_idx[i][:, :sub_points.shape[1], :])
+            input_up_samples.append(knn_idx[num_layers + i])
+            input_sub_points.append(sub_points)
+            batch_xyz = sub_points
+        input_list = input_points + input_neighbors + input_pools + input_up_samples + input_sub_points
+        return input_list + list(knn_idx[2 * num_layers:]) + [np.concatenate([input_points[0], batch_colors], axis=-1)]
 
     @staticmethod
     def data_aug(xyz, color, labels, idx, num_out):
@@ -133,6 +241,45 @@ class DataProcessing:
         data_list = data_list[indices]
         return data_list
 
+    @staticmethod
+    def tile_cover(tree, num_points, overlap):
+        """
+        Greedy cover of a cloud with input regions, each region centered on the first point not covered yet. The points
+        of a region closer to its center than (1 - overlap) times its radius are covered by it.
+        :param tree: nearest_neighbors.KDTree of the cloud
+        :param num_points: number of points of a region
+        :param overlap: fraction of the radius of a region overlapping the next regions
+        :return: indices of the centers
+        """
+        covered = np.zeros(len(tree), dtype=np.bool_)
+        inner_ratio = (1 - overlap) ** 2
+        centers = []
+        center_idx = 0
+        while True:
+            centers += [center_idx]
+            queried_idx, dists = tree.query_crop(tree.data[center_idx:center_idx + 1], num_points)
+            if len(queried_idx) == len(tree):
+                # a region of the whole cloud (smaller than num_points) covers all of it
+                return centers
+            covered[queried_idx[dists <= inner_ratio * np.max(dists)]] = True
+            covered[center_idx] = True
+            uncovered = np.flatnonzero(~covered[center_idx:])
+            if len(uncovered) == 0:
+                return centers
+            center_idx += uncovered[0]
+
+    @staticmethod
+    def tile_input(queried_idx, num_points, rng):
+        """
+        Shuffle the points of a region with the given random state, up-sampled with replacement to num_points
+        :return: point indices of the input
+        """
+        queried_idx = queried_idx[rng.permutation(len(queried_idx))]
+        if len(queried_idx) < num_points:
+            dup = rng.choice(len(queried_idx), num_points - len(queried_idx))
+            queried_idx = np.concatenate([queried_idx, queried_idx[dup]])
+        return queried_idx
+
     @staticmethod
     def grid_sub_sampling(points, features=None, labels=None, grid_size=0.1, verbose=0):
         """
@@ -201,6 +348,269 @@ class DataProcessing:
         return np.expand_dims(ce_label_weight, axis=0)
 
 
+def shared_array(shape, dtype):
+    """
+    Zero-initialized numpy array in shared memory, visible to (and writable by) the processes forked after its creation
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    buffer = multiprocessing.RawArray('b', max(1, size * dtype.itemsize))
+    return np.frombuffer(buffer, dtype=dtype, count=size).reshape(shape)
+
+
+class PossibilityIndex:
+    """
+    Possibility of every point of a list of clouds for the spatially regular sampler, with the argmin needed to pick
+    the next input region in O(sqrt(N)) instead of full passes over the clouds. Each cloud is cut into blocks of
+    about sqrt(N) points whose minimum and argmin are cached (a two-level min tree), and the clouds are ordered by
+    their minimum in a heap. As possibilities grow, an update only rescans the blocks whose minimum point was
+    increased. argmin() returns exactly the np.argmin over min_possibility and then over the cloud possibility.
+    :param sizes: number of points of each cloud
+    :param shared: allocate the index in shared memory, for sampling workers forked after its creation (the clouds
+                   are then picked with np.argmin over min_possibility instead of the heap, which is process-local)
+    :param lazy: only draw the minimum of each cloud (a Beta(1, N) variable) at first, and the possibility of its
+                 points conditionally to that minimum when the cloud is first picked (not with shared)
+    """
+
+    def __init__(self, sizes, shared=False, lazy=False):
+        self.shared = shared
+        self.lazy = lazy and not shared
+        self.sizes = list(sizes)
+        num_clouds = len(self.sizes)
+        self.possibility = [None] * num_clouds
+        self.blocks = [None] * num_clouds
+        self.block_min = [None] * num_clouds
+        self.block_arg = [None] * num_clouds
+        self.is_block_min = [None] * num_clouds
+        if shared:
+            self.min_possibility = shared_array(num_clouds, np.float64)
+        else:
+            self.min_possibility = [0.0] * num_clouds
+
+        for cloud_idx, size in enumerate(self.sizes):
+            if self.lazy:
+                self.min_possibility[cloud_idx] = float(np.random.beta(1, max(size, 1)) * 1e-3)
+            else:
+                self.init_cloud(cloud_idx, np.random.rand(size) * 1e-3)
+
+        if shared:
+            self.heap = None
+        else:
+            self.heap = [(m, i) for i, m in enumerate(self.min_possibility)]
+            heapq.heapify(self.heap)
+
+    def init_cloud(self, cloud_idx, initial):
+        # allocate the possibility of a cloud and its block minima
+        new_array = shared_array if self.shared else np.zeros
+        size = len(initial)
+        block_size = 1 << max(6, int(np.ceil(np.log2(max(size, 1)) / 2)))
+        num_blocks = -(-size // block_size)
+        values = new_array(num_blocks * block_size, np.float64)
+        values[:size] = initial
+        values[size:] = np.inf
+        blocks = values.reshape(num_blocks, block_size)
+        block_arg = new_array(num_blocks, np.int64)
+        block_arg[:] = np.argmin(blocks, axis=1)
+        block_min = new_array(num_blocks, np.float64)
+        block_min[:] = blocks[np.arange(num_blocks), block_arg]
+        is_block_min = new_array(len(values), np.bool_)
+        is_block_min[np.arange(num_blocks) * block_size + block_arg] = True
+
+        self.possibility[cloud_idx] = values[:size]
+        self.blocks[cloud_idx] = blocks
+        self.block_arg[cloud_idx] = block_arg
+        self.block_min[cloud_idx] = block_min
+        self.is_block_min[cloud_idx] = is_block_min
+        self.min_possibility[cloud_idx] = float(np.min(block_min))
+
+    def init_lazy_cloud(self, cloud_idx):
+        # the other points are uniform above the minimum drawn at creation
+        min_possibility = self.min_possibility[cloud_idx]
+        size = self.sizes[cloud_idx]
+        initial = min_possibility + np.random.rand(size) * (1e-3 - min_possibility)
+        initial[np.random.randint(size)] = min_possibility
+        self.init_cloud(cloud_idx, initial)
+
+    def argmin(self):
+        """
+        :return: cloud with the lowest possibility and point with the lowest possibility in it (first one on ties)
+        """
+        if self.heap is None:
+            cloud_idx = int(np.argmin(self.min_possibility))
+        else:
+            # drop the entries of clouds whose minimum changed since they were pushed
+            while self.heap[0][0] != self.min_possibility[self.heap[0][1]]:
+                heapq.heappop(self.heap)
+            cloud_idx = self.heap[0][1]
+
+        if self.blocks[cloud_idx] is None:
+            self.init_lazy_cloud(cloud_idx)
+        block_idx = np.argmin(self.block_min[cloud_idx])
+        point_idx = block_idx * self.blocks[cloud_idx].shape[1] + self.block_arg[cloud_idx][block_idx]
+        return cloud_idx, point_idx
+
+    def update(self, cloud_idx, point_idx, delta):
+        """
+        possibility[cloud_idx][point_idx] += delta, with point_idx without duplicates
+        """
+        if self.blocks[cloud_idx] is None:
+            self.init_lazy_cloud(cloud_idx)
+        point_idx = np.asarray(point_idx)
+        delta = np.asarray(delta)
+        blocks = self.blocks[cloud_idx]
+        block_size = blocks.shape[1]
+        is_block_min = self.is_block_min[cloud_idx]
+        self.possibility[cloud_idx][point_idx] += delta
+
+        # only the blocks whose minimum point was increased, or with a decreased point, can have a new minimum
+        refresh = is_block_min[point_idx]
+        if np.any(delta < 0):
+            refresh |= delta < 0
+        if not np.any(refresh):
+            return
+        block_idx = np.unique(point_idx[refresh] // block_size)
+        block_arg = np.argmin(blocks[block_idx], axis=1)
+        is_block_min[block_idx * block_size + self.block_arg[cloud_idx][block_idx]] = False
+        is_block_min[block_idx * block_size + block_arg] = True
+        self.block_arg[cloud_idx][block_idx] = block_arg
+        self.block_min[cloud_idx][block_idx] = blocks[block_idx, block_arg]
+
+        new_min = float(np.min(self.block_min[cloud_idx]))
+        if new_min != self.min_possibility[cloud_idx]:
+            self.min_possibility[cloud_idx] = new_min
+            if self.heap is not None:
+                heapq.heappush(self.heap, (new_min, cloud_idx))
+
+
+class VoteAccumulator:
+    """
+    Exponentially smoothed votes of the test crops, p <- smooth * p + (1 - smooth) * probs, in one flat buffer over
+    all the clouds. A whole batch is applied at once, and a point voted several times in a batch (up-sampled crops,
+    overlapping crops) gets all its votes, in the order of the batch: p <- smooth^m * p + sum_k (1 - smooth) *
+    smooth^(m - k) * probs_k.
+    :param sizes: number of points of each cloud
+    :param num_classes: number of classes
+    :param smooth: smoothing parameter of the votes
+    """
+
+    def __init__(self, sizes, num_classes, smooth=0.95):
+        self.smooth = smooth
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.probs = np.zeros((self.offsets[-1], num_classes), dtype=np.float32)
+        self.stamp = np.zeros(self.offsets[-1], dtype=np.int64)
+        self.is_duplicate = np.zeros(self.offsets[-1], dtype=np.bool_)
+
+    def cloud_probs(self, cloud_idx):
+        # view of the votes of one cloud
+        return self.probs[self.offsets[cloud_idx]:self.offsets[cloud_idx + 1]]
+
+    def update(self, cloud_idx, point_idx, probs):
+        """
+        :param cloud_idx: cloud of each crop, B (or B*1)
+        :param point_idx: points of each crop in its cloud, B*N
+        :param probs: predicted probabilities, B*N*C
+        """
+        num_classes = self.probs.shape[1]
+        flat_idx = (self.offsets[np.reshape(cloud_idx, -1)][:, None] + point_idx).reshape(-1)
+        probs = np.reshape(probs, (-1, num_classes))
+
+        # the points voted several times are found with a scatter of the vote positions (the last one wins)
+        order = np.arange(len(flat_idx))
+        self.stamp[flat_idx] = order
+        duplicates = flat_idx[self.stamp[flat_idx] != order]
+        if len(duplicates) > 0:
+            self.is_duplicate[duplicates] = True
+            multiple = np.flatnonzero(self.is_duplicate[flat_idx])
+            self.is_duplicate[duplicates] = False
+            multiple_idx = flat_idx[multiple]
+            old_probs = self.probs[multiple_idx]
+
+        # single votes, the points voted several times only keep their last vote here
+        new_probs = np.take(self.probs, flat_idx, axis=0)
+        new_probs *= self.smooth
+        new_probs += (1 - self.smooth) * probs
+        self.probs[flat_idx] = new_probs
+        if len(duplicates) == 0:
+            return
+
+        # all the votes of the other points, in the order of the batch
+        order = np.argsort(multiple_idx, kind='stable')
+        sorted_idx = multiple_idx[order]
+        starts = np.flatnonzero(np.concatenate([[True], sorted_idx[1:] != sorted_idx[:-1]]))
+        counts = np.diff(np.concatenate([starts, [len(sorted_idx)]]))
+        rank = np.arange(len(sorted_idx)) - np.repeat(starts, counts)
+        later = np.repeat(counts, counts) - 1 - rank
+        weights = ((1 - self.smooth) * self.smooth ** later).astype(np.float32)
+        votes = np.add.reduceat(probs[multiple[order]] * weights[:, None], starts, axis=0)
+        decay = (self.smooth ** counts).astype(np.float32)
+        self.probs[sorted_idx[starts]] = decay[:, None] * old_probs[order[starts]] + votes
+
+
+class PipelineTimer:
+    """
+    Time spent in the stages of the input pipeline: the crops of the generator, their batching (from the last crop of
+    a batch to the start of its knn searches) and the knn searches, in a py_func or in the knn op. The stages of a
+    pipeline run one after the other in its thread, so that these times add up to the time of a batch when the
+    pipeline is the bottleneck.
+    """
+
+    def __init__(self):
+        self.times = {'generator': [], 'batching': [], 'knn py_func': [], 'knn op': []}
+        self.last_crop = None
+        self.knn_start = None
+
+    def generator(self, gen_func):
+        # generator function of the same crops, timed
+        def timed_gen():
+            crops = iter(gen_func())
+            while True:
+                start = time.time()
+                crop = next(crops, None)
+                if crop is None:
+                    return
+                self.last_crop = time.time()
+                self.times['generator'].append(self.last_crop - start)
+                yield crop
+
+        return timed_gen
+
+    def py_func(self, func):
+        # py_func function of the same outputs, timed
+        def timed_func(*args):
+            self.op_start()
+            outputs = func(*args)
+            self.times['knn py_func'].append(time.time() - self.knn_start)
+            return outputs
+
+        return timed_func
+
+    def op_start(self, *inputs):
+        # marker run (in a py_func) just before the knn op, passing its inputs through
+        self.knn_start = time.time()
+        if self.last_crop is not None:
+            self.times['batching'].append(self.knn_start - self.last_crop)
+        return inputs[0] if len(inputs) == 1 else inputs
+
+    def op_stop(self, *outputs):
+        # marker run (in a py_func) just after the knn op, passing some of its outputs through
+        self.times['knn op'].append(time.time() - self.knn_start)
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def report(self, wall_time, num_batches):
+        """
+        :param wall_time: time taken by the num_batches batches drained from the pipeline
+        """
+        print('{:d} batches in {:.2f}s: {:.2f} batches/s'.format(num_batches, wall_time, num_batches / wall_time))
+        for name, times in self.times.items():
+            if len(times) == 0:
+                continue
+            times = 1000 * np.array(times)
+            print('{:12s} {:6d} calls, total {:8.2f}s ({:5.1f}% of the wall time), mean {:8.2f} ms, p50 {:8.2f} ms, '
+                  'p90 {:8.2f} ms, p99 {:8.2f} ms'.format(name, len(times), np.sum(times) / 1000,
+                                                          100 * np.sum(times) / 1000 / wall_time, np.mean(times),
+                                                          *np.percentile(times, [50, 90, 99])))
+
+
 class Plot:
     @staticmethod
     def random_colors(N, bright=True, seed=0):
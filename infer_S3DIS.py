@@ -0,0 +1,87 @@
+from os import makedirs
+from os.path import exists, join
+from helper_ply import write_ply
+from helper_tool import VoteAccumulator
+import tensorflow as tf
+import numpy as np
+import time
+
+
+def log_out(out_str, log_f_out):
+    log_f_out.write(out_str + '\n')
+    log_f_out.flush()
+    print(out_str)
+
+
+class ModelInference:
+    def __init__(self, model, dataset, restore_snap=None):
+        my_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
+        self.saver = tf.train.Saver(my_vars, max_to_keep=100)
+        self.Log_file = open('log_infer.txt', 'a')
+
+        # Create a session for running Ops on the Graph.
+        c_proto = tf.ConfigProto()
+        c_proto.gpu_options.allow_growth = True
+        self.sess = tf.Session(config=c_proto)
+        self.sess.run(tf.global_variables_initializer())
+
+        # Load trained model
+        if restore_snap is not None:
+            self.saver.restore(self.sess, restore_snap)
+            print("Model restored from " + restore_snap)
+
+        self.prob_logits = tf.nn.softmax(model.logits)
+
+    def infer(self, model, dataset, output_path):
+        """
+        Vote on the tiles of every file fed by the dataset, and write the predictions of a file on its original points
+        as soon as all its tiles went through the network
+        :param output_path: folder of the predicted ply files
+        """
+        makedirs(output_path) if not exists(output_path) else None
+        self.sess.run(dataset.val_init_op)
+
+        votes = {}
+        num_inputs = {}
+        num_points = 0
+        t0 = time.time()
+
+        while True:
+            try:
+                ops = (self.prob_logits,
+                       model.inputs['input_inds'],
+                       model.inputs['cloud_inds'],
+                       )
+                stacked_probs, point_idx, cloud_idx = self.sess.run(ops, {model.is_training: False})
+            except tf.errors.OutOfRangeError:
+                break
+
+            # the last batch can be smaller
+            cloud_idx = np.reshape(cloud_idx, -1)
+            stacked_probs = np.reshape(stacked_probs, [len(cloud_idx), -1, model.config.num_classes])
+
+            for file_id in np.unique(cloud_idx):
+                mask = cloud_idx == file_id
+                cloud = dataset.clouds[file_id]
+                if file_id not in votes:
+                    votes[file_id] = VoteAccumulator([len(cloud['sub_xyz'])], model.config.num_classes)
+                    num_inputs[file_id] = 0
+                votes[file_id].update(np.zeros(np.sum(mask), dtype=np.int32), point_idx[mask], stacked_probs[mask])
+                num_inputs[file_id] += np.sum(mask)
+
+                # Reproject the votes of the finished files and release them
+                if num_inputs[file_id] == cloud['num_inputs']:
+                    sub_preds = np.argmax(votes.pop(file_id).probs, axis=1)
+                    preds = dataset.label_values[sub_preds][cloud['proj_idx']].astype(np.uint8)
+                    write_ply(join(output_path, cloud['name'] + '.ply'), [cloud['points'], preds],
+                              ['x', 'y', 'z', 'pred'])
+                    del dataset.clouds[file_id]
+                    num_points += len(preds)
+                    log_out('{:s}: {:d} points, {:.0f} points/s'.format(cloud['name'], len(preds),
+                                                                       num_points / (time.time() - t0)), self.Log_file)
+
+        log_out('{:d} files, {:d} points in {:.1f}s, {:.0f} points/s'.format(len(dataset.files), num_points,
+                                                                          time.time() - t0,
+                                                                          num_points / (time.time() - t0)),
+                self.Log_file)
+        self.sess.close()
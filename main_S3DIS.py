@@ -1,19 +1,172 @@
-from os.path import join
+from os.path import join, exists, getmtime, getsize
 from Waterfall_Net import Network
 from tester_S3DIS import ModelTester
+from infer_S3DIS import ModelInference
 from helper_ply import read_ply
 from helper_tool import ConfigS3DIS as cfg
 from helper_tool import DataProcessing as DP
+from helper_tool import PossibilityIndex
+from helper_tool import PipelineTimer
 from helper_tool import Plot
 import tensorflow as tf
 import numpy as np
 import time, pickle, argparse, glob, os
+import nearest_neighbors.lib.python.nearest_neighbors as nearest_neighbors
+import multiprocessing
+import collections
+from queue import Empty
+
+
+def crop_worker(dataset, split, possibility, lock, queue, seed):
+    # Sampling worker process, cropping input regions until the main process exits (an error is put on the queue
+    # as a message, the main process raises it)
+    np.random.seed(seed)
+    try:
+        while True:
+            queue.put(dataset.spatially_regular_crop(split, possibility, lock))
+    except Exception as e:
+        queue.put('crop worker {:d}: {:s}: {!s}'.format(os.getpid(), type(e).__name__, e))
+
+
+def worker_item(queue, workers, poll=1.0):
+    """
+    Next item put on the queue by the worker processes, raising instead of waiting forever once one of them died
+    """
+    while True:
+        for worker in workers:
+            if worker.exitcode is not None and worker.exitcode != 0:
+                raise RuntimeError('worker process {:d} exited with code {:d}'.format(worker.pid, worker.exitcode))
+        try:
+            return queue.get(timeout=poll)
+        except Empty:
+            pass
+
+
+def search_index(xyz, index_file=None):
+    """
+    Search structure of a sub-sampled cloud for cfg.knn_backend: voxel grid, or kd-tree loaded from index_file if given
+    """
+    if cfg.knn_backend == 'voxel':
+        return nearest_neighbors.VoxelGrid(xyz)
+    return nearest_neighbors.KDTree(xyz, index_file=index_file)
+
+
+def prepare_ply(file_path):
+    """
+    Read a point cloud file (xyz + rgb) and prepare it with prepare_cloud
+    :param file_path: path of the ply file
+    :return: dict of prepare_cloud, with the name of the file
+    """
+    data = read_ply(file_path)
+    points = np.vstack((data['x'], data['y'], data['z'])).T
+    colors = np.vstack((data['red'], data['green'], data['blue'])).T.astype(np.uint8)
+    cloud = prepare_cloud(points, colors)
+    cloud['name'] = os.path.basename(file_path)[:-4]
+    return cloud
+
+
+def prepare_cloud(points, colors):
+    """
+    Sub-sample a point cloud and cover the sub-sampled cloud with input regions
+    :param points: N*3 original points
+    :param colors: N*3 uint8 colors
+    :return: dict of the original points, the sub-sampled cloud, the projection indices and the input regions
+    """
+    # same pre-processing as utils/data_prepare_s3dis.py
+    xyz = (points - np.amin(points, axis=0)).astype(np.float32)
+    sub_xyz, sub_colors = DP.grid_sub_sampling(xyz, colors, grid_size=cfg.sub_grid_size)
+    sub_colors = sub_colors / 255.0
+    search_tree = search_index(sub_xyz)
+    proj_idx = np.reshape(search_tree.query(xyz, return_distance=False), -1).astype(np.int32)
+
+    centers = DP.tile_cover(search_tree, cfg.num_points, cfg.test_tile_overlap)
+    crops = [search_tree.query_crop(sub_xyz[center_idx:center_idx + 1], cfg.num_points)[0] for center_idx in centers]
+    return {'points': points, 'sub_xyz': sub_xyz,
+            'sub_colors': sub_colors.astype(np.float32), 'proj_idx': proj_idx, 'centers': centers, 'crops': crops}
+
+
+def ply_worker(files, file_ids, queue):
+    # Inference worker process, preparing its share of the files (the files failing to load are reported on the queue,
+    # the main process waits for one item per file)
+    for file_id, file_path in zip(file_ids, files):
+        try:
+            cloud = prepare_ply(file_path)
+        except Exception as e:
+            cloud = {'error': '{:s}: {:s}: {!s}'.format(file_path, type(e).__name__, e)}
+        cloud['file_id'] = file_id
+        queue.put(cloud)
+
+
+class CloudCache:
+    """
+    Sub-sampled clouds opened on first use (memory maps of the binary cache and kd-tree index), the least recently
+    used ones being closed when the loaded clouds exceed the memory budget
+    :param memory_budget: bytes of loaded clouds (0: no limit)
+    """
+
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+        self.clouds = collections.OrderedDict()
+        self.nbytes = 0
+
+    def get(self, cache_file):
+        if cache_file in self.clouds:
+            self.clouds.move_to_end(cache_file)
+            return self.clouds[cache_file][0]
+
+        sub_xyz = np.load(cache_file + '_xyz.npy', mmap_mode='r')
+        sub_colors = np.load(cache_file + '_colors.npy', mmap_mode='r')
+        sub_labels = np.load(cache_file + '_labels.npy', mmap_mode='r')
+        search_tree = search_index(sub_xyz, index_file=cache_file + '_tree.bin')
+        nbytes = sub_xyz.nbytes + sub_colors.nbytes + sub_labels.nbytes
+        if isinstance(search_tree, nearest_neighbors.VoxelGrid):
+            nbytes += search_tree.nbytes
+        else:
+            nbytes += getsize(cache_file + '_tree.bin')
+
+        # close the least recently used clouds to make room for this one
+        while self.memory_budget > 0 and self.clouds and self.nbytes + nbytes > self.memory_budget:
+            _, (_, old_nbytes) = self.clouds.popitem(last=False)
+            self.nbytes -= old_nbytes
+        self.clouds[cache_file] = ((search_tree, sub_colors, sub_labels), nbytes)
+        self.nbytes += nbytes
+        return search_tree, sub_colors, sub_labels
+
+    def labels(self, cache_file):
+        # the labels alone are a memory map, no need to load the cloud and its search index for them
+        if cache_file in self.clouds:
+            return self.clouds[cache_file][0][2]
+        return np.load(cache_file + '_labels.npy', mmap_mode='r')
+
+
+class CachedClouds:
+    """
+    List-like view of one field (0: tree, 1: colors, 2: labels) of the clouds of a split, loaded by the cloud cache
+    (the labels of a cloud that is not loaded are read without loading it, e.g. to score the predictions)
+    """
+
+    def __init__(self, cloud_cache, cache_files, field):
+        self.cloud_cache = cloud_cache
+        self.cache_files = cache_files
+        self.field = field
+
+    def __len__(self):
+        return len(self.cache_files)
+
+    def __getitem__(self, cloud_idx):
+        if self.field == 2:
+            return self.cloud_cache.labels(self.cache_files[cloud_idx])
+        return self.cloud_cache.get(self.cache_files[cloud_idx])[self.field]
+
+    def __iter__(self):
+        for cloud_idx in range(len(self)):
+            yield self[cloud_idx]
 
 
 class S3DIS:
-    def __init__(self, test_area_idx):
+    def __init__(self, test_area_idx, splits=('training', 'validation'), path='/home/data/S3DIS'):
         self.name = 'S3DIS'
-        self.path = '/home/data/S3DIS'
+        self.path = path
         self.label_to_names = {0: 'ceiling',
                                1: 'floor',
                                2: 'wall',
@@ -40,14 +193,22 @@ class S3DIS:
         self.val_labels = []
         self.possibility = {}
         self.min_possibility = {}
-        self.input_trees = {'training': [], 'validation': []}
-        self.input_colors = {'training': [], 'validation': []}
-        self.input_labels = {'training': [], 'validation': []}
-        self.input_names = {'training': [], 'validation': []}
+        self.splits = list(splits)
+        self.cloud_cache = CloudCache(cfg.memory_budget)
+        self.input_trees = {}
+        self.input_colors = {}
+        self.input_labels = {}
+        self.input_names = {split: [] for split in self.splits}
+        self.input_sizes = {split: [] for split in self.splits}
+        self.timer = None  # PipelineTimer of the input pipeline, set before init_input_pipeline to time its stages
+        self.workers = {}  # worker processes of each split
         self.load_sub_sampled_clouds(cfg.sub_grid_size)
 
     def load_sub_sampled_clouds(self, sub_grid_size):
         tree_path = join(self.path, 'input_{:.3f}'.format(sub_grid_size))
+        cache_path = join(self.path, 'cache_{:.3f}'.format(sub_grid_size))
+        os.makedirs(cache_path, exist_ok=True)
+        cache_files = {split: [] for split in self.splits}
         for i, file_path in enumerate(self.all_files):
             t0 = time.time()
             cloud_name = file_path.split('/')[-1][:-4]
@@ -55,26 +216,32 @@ class S3DIS:
                 cloud_split = 'validation'
             else:
                 cloud_split = 'training'
+            if cloud_split not in self.splits:
+                continue
 
             # Name of the input files
-            kd_tree_file = join(tree_path, '{:s}_KDTree.pkl'.format(cloud_name))
             sub_ply_file = join(tree_path, '{:s}.ply'.format(cloud_name))
+            cache_file = join(cache_path, cloud_name)
 
-            data = read_ply(sub_ply_file)
-            sub_colors = np.vstack((data['red'], data['green'], data['blue'])).T
-            sub_labels = data['class']
+            # Convert the sub-sampled cloud to the binary cache once (or again when the ply is newer)
+            if not exists(cache_file + '_tree.bin') or getmtime(cache_file + '_tree.bin') < getmtime(sub_ply_file):
+                self.write_cache(sub_ply_file, cache_file)
+                print('{:s} cached in {:.1f}s'.format(cloud_name, time.time() - t0))
 
-            # Read pkl with search tree
-            with open(kd_tree_file, 'rb') as f:
-                search_tree = pickle.load(f)
-
-            self.input_trees[cloud_split] += [search_tree]
-            self.input_colors[cloud_split] += [sub_colors]
-            self.input_labels[cloud_split] += [sub_labels]
+            # The clouds themselves are only opened when used
+            cache_files[cloud_split] += [cache_file]
             self.input_names[cloud_split] += [cloud_name]
+            self.input_sizes[cloud_split] += [np.load(cache_file + '_xyz.npy', mmap_mode='r').shape[0]]
+
+        for split in self.splits:
+            self.input_trees[split] = CachedClouds(self.cloud_cache, cache_files[split], 0)
+            self.input_colors[split] = CachedClouds(self.cloud_cache, cache_files[split], 1)
+            self.input_labels[split] = CachedClouds(self.cloud_cache, cache_files[split], 2)
+            print('{:d} {:s} clouds, {:d} points'.format(len(cache_files[split]), split,
+                                                        int(np.sum(self.input_sizes[split]))))
 
-            size = sub_colors.shape[0] * 4 * 7
-            print('{:s} {:.1f} MB loaded in {:.1f}s'.format(kd_tree_file.split('/')[-1], size * 1e-6, time.time() - t0))
+        if 'validation' not in self.splits:
+            return
 
         print('\nPreparing reprojected indices for testing')
 
@@ -86,88 +253,215 @@ class S3DIS:
             # Validation projection and labels
             if self.val_split in cloud_name:
                 proj_file = join(tree_path, '{:s}_proj.pkl'.format(cloud_name))
-                with open(proj_file, 'rb') as f:
-                    proj_idx, labels = pickle.load(f)
-                self.val_proj += [proj_idx]
-                self.val_labels += [labels]
+                cache_file = join(cache_path, cloud_name)
+                if not exists(cache_file + '_proj.npy') or getmtime(cache_file + '_proj.npy') < getmtime(proj_file):
+                    with open(proj_file, 'rb') as f:
+                        proj_idx, labels = pickle.load(f)
+                    self.save_cache_array(cache_file + '_proj_labels.npy', labels)
+                    self.save_cache_array(cache_file + '_proj.npy', proj_idx)
+                self.val_proj += [np.load(cache_file + '_proj.npy', mmap_mode='r')]
+                self.val_labels += [np.load(cache_file + '_proj_labels.npy', mmap_mode='r')]
                 print('{:s} done in {:.1f}s'.format(cloud_name, time.time() - t0))
 
+    def write_cache(self, sub_ply_file, cache_file):
+        data = read_ply(sub_ply_file)
+        sub_xyz = np.vstack((data['x'], data['y'], data['z'])).T.astype(np.float32)
+        sub_colors = np.vstack((data['red'], data['green'], data['blue'])).T
+        self.save_cache_array(cache_file + '_xyz.npy', sub_xyz)
+        self.save_cache_array(cache_file + '_colors.npy', sub_colors)
+        self.save_cache_array(cache_file + '_labels.npy', data['class'])
+
+        # the tree file is written last, its presence marks a complete cache
+        tmp_file = '{:s}_tree.{:d}.tmp'.format(cache_file, os.getpid())
+        nearest_neighbors.KDTree(sub_xyz).save_index(tmp_file)
+        os.replace(tmp_file, cache_file + '_tree.bin')
+
+    @staticmethod
+    def save_cache_array(file_name, array):
+        # write to a temporary file first, so that concurrent readers never see a partial array
+        tmp_file = '{:s}.{:d}.tmp.npy'.format(file_name[:-4], os.getpid())
+        np.save(tmp_file, np.ascontiguousarray(array))
+        os.replace(tmp_file, file_name)
+
     # Generate the input data flow
-    def get_batch_gen(self, split):
+    def get_batch_gen(self, split, tiling=False):
+        if tiling:
+            return self.get_tile_gen(split)
+
         if split == 'training':
             num_per_epoch = cfg.train_steps * cfg.batch_size
         elif split == 'validation':
             num_per_epoch = cfg.val_steps * cfg.val_batch_size
 
-        self.possibility[split] = []
-        self.min_possibility[split] = []
         # Random initialize
-        for i, tree in enumerate(self.input_colors[split]):
-            self.possibility[split] += [np.random.rand(tree.data.shape[0]) * 1e-3]
-            self.min_possibility[split] += [float(np.min(self.possibility[split][-1]))]
-
-        def spatially_regular_gen():
-            # Generator loop
-            for i in range(num_per_epoch):
-
-                # Choose the cloud with the lowest probability
-                cloud_idx = int(np.argmin(self.min_possibility[split]))
-
-                # Choose the point with the minimum of possibility in the cloud as query point
-                point_ind = np.argmin(self.possibility[split][cloud_idx])
-
-                # Get all points within the cloud from tree structure
-                points = np.array(self.input_trees[split][cloud_idx].data, copy=False)
-
-                # Center point of input region
-                center_point = points[point_ind, :].reshape(1, -1)
-
-                # Add noise to the center point
-                noise = np.random.normal(scale=cfg.noise_init / 10, size=center_point.shape)
-                pick_point = center_point + noise.astype(center_point.dtype)
-
-                # Check if the number of points in the selected cloud is less that the predefined num_points
-                if len(points) < cfg.num_points:
-                    # Query all points within the cloud
-                    queried_idx = self.input_trees[split][cloud_idx].query(pick_point, k=len(points))[1][0]
-                else:
-                    # Query all predefined number of points
-                    queried_idx = self.input_trees[split][cloud_idx].query(pick_point, k=cfg.num_points)[1][0]
-
-                # Shuffle index
-                queried_idx = DP.shuffle_idx(queried_idx)
-                # Get corresponding points and colors based on the index
-                queried_pc_xyz = points[queried_idx]
-                queried_pc_xyz = queried_pc_xyz - pick_point
-                queried_pc_colors = self.input_colors[split][cloud_idx][queried_idx]
-                queried_pc_labels = self.input_labels[split][cloud_idx][queried_idx]
-
-                # Update the possibility of the selected points
-                dists = np.sum(np.square((points[queried_idx] - pick_point).astype(np.float32)), axis=1)
-                delta = np.square(1 - dists / np.max(dists))
-                self.possibility[split][cloud_idx][queried_idx] += delta
-                self.min_possibility[split][cloud_idx] = float(np.min(self.possibility[split][cloud_idx]))
-
-                # up_sampled with replacement
-                if len(points) < cfg.num_points:
-                    queried_pc_xyz, queried_pc_colors, queried_idx, queried_pc_labels = \
-                        DP.data_aug(queried_pc_xyz, queried_pc_colors, queried_pc_labels, queried_idx, cfg.num_points)
-
-                if True:
-                    yield (queried_pc_xyz.astype(np.float32),
-                           queried_pc_colors.astype(np.float32),
-                           queried_pc_labels,
-                           queried_idx.astype(np.int32),
-                           np.array([cloud_idx], dtype=np.int32))
+        possibility = PossibilityIndex(self.input_sizes[split], shared=cfg.num_workers > 0, lazy=True)
+        self.possibility[split] = possibility.possibility
+        self.min_possibility[split] = possibility.min_possibility
+
+        if cfg.num_workers > 0:
+            # Crop the input regions in forked worker processes sharing the possibility (the clouds and trees are
+            # shared copy-on-write with the workers)
+            self.stop_workers(split)
+            ctx = multiprocessing.get_context('fork')
+            lock = ctx.Lock()
+            queue = ctx.Queue(cfg.worker_queue_size)
+            workers = []
+            for worker_id in range(cfg.num_workers):
+                seed = np.random.randint(2 ** 31)
+                worker = ctx.Process(target=crop_worker, args=(self, split, possibility, lock, queue, seed))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+            self.workers[split] = workers
+
+            def spatially_regular_gen():
+                # Generator loop, a worker error stops all the workers (a worker killed holding the lock would block
+                # the others)
+                for i in range(num_per_epoch):
+                    try:
+                        crop = worker_item(queue, workers)
+                        if isinstance(crop, str):
+                            raise RuntimeError(crop)
+                    except RuntimeError:
+                        self.stop_workers(split)
+                        raise
+                    yield crop
+        else:
+            def spatially_regular_gen():
+                # Generator loop
+                for i in range(num_per_epoch):
+                    yield self.spatially_regular_crop(split, possibility)
 
         gen_func = spatially_regular_gen
         gen_types = (tf.float32, tf.float32, tf.int32, tf.int32, tf.int32)
         gen_shapes = ([None, 3], [None, 3], [None], [None], [None])
         return gen_func, gen_types, gen_shapes
 
+    def stop_workers(self, split):
+        for worker in self.workers.pop(split, []):
+            worker.terminate()
+            worker.join()
+
+    def get_tile_gen(self, split):
+        # Fixed tiling of the clouds, each epoch is a whole number of batches going on cyclically over the tiles
+        tiles = []
+        for cloud_idx in range(len(self.input_sizes[split])):
+            tiles += [(cloud_idx, center_idx) for center_idx in self.tile_centers(split, cloud_idx)]
+        batch_size = cfg.val_batch_size if split == 'validation' else cfg.batch_size
+        num_per_epoch = int(np.ceil(len(tiles) / batch_size)) * batch_size
+        print('{:d} {:s} tiles, {:d} steps per epoch'.format(len(tiles), split, num_per_epoch // batch_size))
+
+        # number of complete passes over each cloud, like the possibility of the random sampler
+        self.possibility[split] = None
+        self.min_possibility[split] = np.zeros(len(self.input_sizes[split]), dtype=np.float64)
+        last_tiles = {cloud_idx: i for i, (cloud_idx, _) in enumerate(tiles)}
+        state = {'next': 0}
+
+        def tile_gen():
+            for i in range(num_per_epoch):
+                tile_idx = state['next'] % len(tiles)
+                # each pass over the tiles gets other shuffles, still the same from one run to the next
+                rng = np.random.RandomState(state['next'])
+                state['next'] += 1
+                cloud_idx, center_idx = tiles[tile_idx]
+                yield self.tile_crop(split, cloud_idx, center_idx, rng)
+                if last_tiles[cloud_idx] == tile_idx:
+                    self.min_possibility[split][cloud_idx] += 1
+
+        gen_types = (tf.float32, tf.float32, tf.int32, tf.int32, tf.int32)
+        gen_shapes = ([None, 3], [None, 3], [None], [None], [None])
+        return tile_gen, gen_types, gen_shapes
+
+    def tile_centers(self, split, cloud_idx):
+        return DP.tile_cover(self.input_trees[split][cloud_idx], cfg.num_points, cfg.test_tile_overlap)
+
+    def tile_crop(self, split, cloud_idx, center_idx, rng):
+        """
+        Input region of a tile, without noise and shuffled with the given random state
+        :return: xyz, colors, labels, point indices and cloud index of the input region
+        """
+        points = np.array(self.input_trees[split][cloud_idx].data, copy=False)
+        center_point = points[center_idx, :].reshape(1, -1)
+        queried_idx, _ = self.input_trees[split][cloud_idx].query_crop(center_point, cfg.num_points)
+        queried_idx = DP.tile_input(queried_idx, cfg.num_points, rng)
+
+        return ((points[queried_idx] - center_point).astype(np.float32),
+                self.input_colors[split][cloud_idx][queried_idx].astype(np.float32),
+                self.input_labels[split][cloud_idx][queried_idx],
+                queried_idx.astype(np.int32),
+                np.array([cloud_idx], dtype=np.int32))
+
+    def spatially_regular_crop(self, split, possibility, lock=None):
+        """
+        Crop the input region around the point with the lowest possibility and update the possibility
+        :param split: 'training' or 'validation'
+        :param possibility: PossibilityIndex of the split
+        :param lock: lock shared by the sampling workers, the center point is then reserved while cropping
+        :return: xyz, colors, labels, point indices and cloud index of the input region
+        """
+        # Choose the cloud with the lowest probability, and the point with the minimum of possibility in
+        # this cloud as query point
+        if lock is None:
+            cloud_idx, point_ind = possibility.argmin()
+        else:
+            with lock:
+                cloud_idx, point_ind = possibility.argmin()
+                # reserve the center point so that the other workers pick another region meanwhile
+                possibility.update(cloud_idx, [point_ind], [1.0])
+
+        # Get all points within the cloud from tree structure
+        points = np.array(self.input_trees[split][cloud_idx].data, copy=False)
+
+        # Center point of input region
+        center_point = points[point_ind, :].reshape(1, -1)
+
+        # Add noise to the center point
+        noise = np.random.normal(scale=cfg.noise_init / 10, size=center_point.shape)
+        pick_point = center_point + noise.astype(center_point.dtype)
+
+        # Query the predefined number of points (all points within the cloud if it has less than num_points), with
+        # their squared distances to the pick point
+        queried_idx, dists = self.input_trees[split][cloud_idx].query_crop(pick_point, cfg.num_points)
+
+        # Shuffle index
+        shuffle = DP.shuffle_idx(np.arange(len(queried_idx)))
+        queried_idx = queried_idx[shuffle]
+        dists = dists[shuffle]
+        # Get corresponding points and colors based on the index
+        queried_pc_xyz = points[queried_idx]
+        queried_pc_xyz = queried_pc_xyz - pick_point
+        queried_pc_colors = self.input_colors[split][cloud_idx][queried_idx]
+        queried_pc_labels = self.input_labels[split][cloud_idx][queried_idx]
+
+        # Update the possibility of the selected points
+        delta = np.square(1 - dists / np.max(dists))
+        if lock is None:
+            possibility.update(cloud_idx, queried_idx, delta)
+        else:
+            with lock:
+                possibility.update(cloud_idx, queried_idx, delta)
+                possibility.update(cloud_idx, [point_ind], [-1.0])
+
+        # up_sampled with replacement
+        if len(points) < cfg.num_points:
+            queried_pc_xyz, queried_pc_colors, queried_idx, queried_pc_labels = \
+                DP.data_aug(queried_pc_xyz, queried_pc_colors, queried_pc_labels, queried_idx, cfg.num_points)
+
+        return (queried_pc_xyz.astype(np.float32),
+                queried_pc_colors.astype(np.float32),
+                queried_pc_labels,
+                queried_idx.astype(np.int32),
+                np.array([cloud_idx], dtype=np.int32))
+
     @staticmethod
-    def get_tf_mapping2():
-        # Collect flat inputs
+    def get_tf_mapping2(knn_eps=None, timer=None):
+        # Collect flat inputs (knn_eps: approximation of the neighbour search of each layer, None for exact searches)
+        knn_eps = [0.0] * cfg.num_layers if knn_eps is None else [float(eps) for eps in knn_eps]
+        knn_func = DP.knn_pyramid if timer is None else timer.py_func(DP.knn_pyramid)
+        if cfg.knn_op and cfg.knn_backend != 'kdtree':
+            raise ValueError('the knn op only searches kd-trees, knn_backend={:s} needs knn_op=False'.format(
+                cfg.knn_backend))
+
         def tf_map(batch_xyz, batch_features, batch_labels, batch_pc_idx, batch_cloud_idx):
             batch_features = tf.concat([batch_xyz, batch_features], axis=-1)
             input_points = []
@@ -176,11 +470,30 @@ class S3DIS:
             input_up_samples = []
             input_sub_points = []
 
+            # All the neighbour searches of the pyramid at once
+            if cfg.knn_op:
+                from nearest_neighbors.tf_knn import knn_pyramid
+                searches = DP.pyramid_searches(cfg.k_n, cfg.num_layers)
+                knn_xyz = batch_xyz
+                if timer is not None:
+                    # the op is timed between two markers, its outputs are all produced at once
+                    knn_xyz = tf.py_func(timer.op_start, [batch_xyz], tf.float32)
+                    knn_xyz.set_shape(batch_xyz.get_shape())
+                knn_idx = knn_pyramid(knn_xyz, cfg.sub_sampling_ratio, searches, knn_eps)
+                if timer is not None:
+                    last_idx = tf.py_func(timer.op_stop, [knn_idx[-1]], tf.int32)
+                    last_idx.set_shape(knn_idx[-1].get_shape())
+                    knn_idx = knn_idx[:-1] + [last_idx]
+            else:
+                knn_idx = tf.py_func(knn_func,
+                                     [batch_xyz, cfg.k_n, cfg.sub_sampling_ratio, cfg.knn_backend == 'voxel', knn_eps],
+                                     [tf.int32] * (2 * cfg.num_layers + 2))
+
             for i in range(cfg.num_layers):
-                neighbour_idx = tf.py_func(DP.knn_search, [batch_xyz, batch_xyz, cfg.k_n], tf.int32)
+                neighbour_idx = knn_idx[i]
                 sub_points = batch_xyz[:, :tf.shape(batch_xyz)[1] // cfg.sub_sampling_ratio[i], :]
                 pool_i = neighbour_idx[:, :tf.shape(batch_xyz)[1] // cfg.sub_sampling_ratio[i], :]
-                up_i = tf.py_func(DP.knn_search, [sub_points, batch_xyz, 3], tf.int32)
+                up_i = knn_idx[cfg.num_layers + i]
                 input_points.append(batch_xyz)
                 input_neighbors.append(neighbour_idx)
                 input_pools.append(pool_i)
@@ -188,8 +501,7 @@ class S3DIS:
                 input_sub_points.append(sub_points)
                 batch_xyz = sub_points
 
-            backbone1 = tf.py_func(DP.knn_search, [input_points[-2], input_points[1], 3], tf.int32)
-            backbone2 = tf.py_func(DP.knn_search, [input_points[-1], input_points[2], 3], tf.int32)
+            backbone1, backbone2 = knn_idx[2 * cfg.num_layers:]
 
             input_list = input_points + input_neighbors + input_pools + input_up_samples + input_sub_points
             input_list += [backbone1, backbone2, batch_features, batch_labels, batch_pc_idx, batch_cloud_idx]
@@ -198,36 +510,159 @@ class S3DIS:
 
         return tf_map
 
-    def init_input_pipeline(self):
+    def init_input_pipeline(self, tiling=False):
         print('Initiating input pipeline')
         cfg.ignored_label_inds = [self.label_to_idx[ign_label] for ign_label in self.ignored_labels]
-        gen_function, gen_types, gen_shapes = self.get_batch_gen('training')
-        gen_function_val, _, _ = self.get_batch_gen('validation')
-        self.train_data = tf.data.Dataset.from_generator(gen_function, gen_types, gen_shapes)
-        self.val_data = tf.data.Dataset.from_generator(gen_function_val, gen_types, gen_shapes)
+        nearest_neighbors.set_num_threads(cfg.knn_threads)
+        nearest_neighbors.set_brute_force_threshold(cfg.knn_brute_force_npts)
+
+        # Only the loaded splits get a pipeline, the neighbour searches are approximate in training only
+        batch_data = {}
+        for split, batch_size in [('training', cfg.batch_size), ('validation', cfg.val_batch_size)]:
+            if split in self.splits:
+                gen_function, gen_types, gen_shapes = self.get_batch_gen(split, tiling)
+                if self.timer is not None:
+                    gen_function = self.timer.generator(gen_function)
+                data = tf.data.Dataset.from_generator(gen_function, gen_types, gen_shapes)
+                data = data.batch(batch_size)
+                data = data.map(map_func=self.get_tf_mapping2(cfg.knn_eps if split == 'training' else None,
+                                                              self.timer))
+                batch_data[split] = data.prefetch(batch_size)
+        self.batch_train_data = batch_data.get('training')
+        self.batch_val_data = batch_data.get('validation')
+
+        some_data = batch_data[self.splits[0]]
+        iter = tf.data.Iterator.from_structure(some_data.output_types, some_data.output_shapes)
+        self.flat_inputs = iter.get_next()
+        self.train_init_op = iter.make_initializer(self.batch_train_data) if 'training' in batch_data else None
+        self.val_init_op = iter.make_initializer(self.batch_val_data) if 'validation' in batch_data else None
 
-        self.batch_train_data = self.train_data.batch(cfg.batch_size)
-        self.batch_val_data = self.val_data.batch(cfg.val_batch_size)
-        map_func = self.get_tf_mapping2()
 
-        self.batch_train_data = self.batch_train_data.map(map_func=map_func)
-        self.batch_val_data = self.batch_val_data.map(map_func=map_func)
+class PlyClouds(S3DIS):
+    """
+    Unlabelled point cloud files (xyz + rgb) to run the network on. Worker processes read, sub-sample and tile the files
+    into a bounded queue while the network runs, and the tiles of each file are fed cfg.infer_votes times.
+    :param files: paths of the ply files
+    """
 
-        self.batch_train_data = self.batch_train_data.prefetch(cfg.batch_size)
-        self.batch_val_data = self.batch_val_data.prefetch(cfg.val_batch_size)
+    def __init__(self, files):
+        self.files = list(files)
+        self.clouds = {}
+        super(PlyClouds, self).__init__(0, splits=['validation'])
 
-        iter = tf.data.Iterator.from_structure(self.batch_train_data.output_types, self.batch_train_data.output_shapes)
-        self.flat_inputs = iter.get_next()
-        self.train_init_op = iter.make_initializer(self.batch_train_data)
-        self.val_init_op = iter.make_initializer(self.batch_val_data)
+    def load_sub_sampled_clouds(self, sub_grid_size):
+        # the clouds are prepared on the fly by the workers
+        pass
+
+    def get_batch_gen(self, split, tiling=True):
+        # the workers are forked here, before the session and its threads exist (not from the generator thread), so
+        # the files are fed once
+        self.stop_workers(split)
+        ctx = multiprocessing.get_context('fork')
+        queue = ctx.Queue(cfg.infer_prefetch)
+        num_workers = max(1, min(cfg.infer_workers, len(self.files)))
+        file_ids = list(range(len(self.files)))
+        worker_file_ids = [file_ids[i::num_workers] for i in range(num_workers)]
+        workers = [ctx.Process(target=ply_worker, daemon=True,
+                               args=(self.files[i::num_workers], worker_file_ids[i], queue))
+                   for i in range(num_workers)]
+        for worker in workers:
+            worker.start()
+        self.workers[split] = workers
+
+        def next_cloud(pending):
+            # next prepared file, or None once the remaining files are all lost with their dead workers
+            while True:
+                try:
+                    return queue.get(timeout=1.0)
+                except Empty:
+                    pass
+                for worker, ids in zip(workers, worker_file_ids):
+                    lost = pending.intersection(ids)
+                    if worker.exitcode is not None and worker.exitcode != 0 and lost:
+                        for file_id in sorted(lost):
+                            print('skipping {:s}: its worker exited with code {:d}'.format(self.files[file_id],
+                                                                                        worker.exitcode))
+                        pending.difference_update(lost)
+                if not pending:
+                    return None
+
+        def ply_gen():
+            pending = set(file_ids)
+            while pending:
+                cloud = next_cloud(pending)
+                if cloud is None:
+                    break
+                pending.discard(cloud['file_id'])
+                if 'error' in cloud:
+                    print('skipping {:s}'.format(cloud['error']))
+                    continue
+                file_id = cloud['file_id']
+                cloud['num_inputs'] = cfg.infer_votes * len(cloud['crops'])
+                self.clouds[file_id] = cloud
+                for vote in range(cfg.infer_votes):
+                    rng = np.random.RandomState(vote)
+                    for center_idx, crop in zip(cloud['centers'], cloud['crops']):
+                        queried_idx = DP.tile_input(crop, cfg.num_points, rng)
+                        yield ((cloud['sub_xyz'][queried_idx] - cloud['sub_xyz'][center_idx]).astype(np.float32),
+                               cloud['sub_colors'][queried_idx],
+                               np.zeros(cfg.num_points, dtype=np.int32),
+                               queried_idx.astype(np.int32),
+                               np.array([file_id], dtype=np.int32))
+
+            for worker in workers:
+                worker.join()
+            self.workers.pop(split, None)
+
+        gen_types = (tf.float32, tf.float32, tf.int32, tf.int32, tf.int32)
+        gen_shapes = ([None, 3], [None, 3], [None], [None], [None])
+        return ply_gen, gen_types, gen_shapes
+
+
+def choose_snapshot(model_path):
+    # given snapshot, or the last one of the last training log
+    if model_path != 'None':
+        return model_path
+    logs = np.sort([os.path.join('results', f) for f in os.listdir('results') if f.startswith('Log')])
+    chosen_folder = logs[-1]
+    snap_path = join(chosen_folder, 'snapshots')
+    snap_steps = [int(f[:-5].split('-')[-1]) for f in os.listdir(snap_path) if f[-5:] == '.meta']
+    chosen_step = np.sort(snap_steps)[-1]
+    return os.path.join(snap_path, 'snap-{:d}'.format(chosen_step))
+
+
+def benchmark_pipeline(dataset, steps, warmup_steps=5):
+    """
+    Drain the training input pipeline for steps batches (no model) and report its throughput and the time spent in
+    its stages, dataset.timer must have been set before init_input_pipeline
+    """
+    with tf.Session() as sess:
+        sess.run(dataset.train_init_op)
+        for _ in range(warmup_steps):
+            sess.run(dataset.flat_inputs)
+        for times in dataset.timer.times.values():
+            del times[:]
+        t0 = time.time()
+        for _ in range(steps):
+            try:
+                sess.run(dataset.flat_inputs)
+            except tf.errors.OutOfRangeError:
+                # end of an epoch of the generator
+                sess.run(dataset.train_init_op)
+                sess.run(dataset.flat_inputs)
+        dataset.timer.report(time.time() - t0, steps)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--gpu', type=int, default=0, help='the number of GPUs to use [default: 0]')
     parser.add_argument('--test_area', type=int, default=5, help='Which area to use for test, option: 1-6 [default: 5]')
-    parser.add_argument('--mode', type=str, default='train', help='options: train, test, vis')
+    parser.add_argument('--mode', type=str, default='train', help='options: train, test, infer, vis, benchmark')
     parser.add_argument('--model_path', type=str, default='None', help='pretrained model path')
+    parser.add_argument('--inputs', type=str, nargs='+', default=[], help='infer mode: ply files or glob patterns')
+    parser.add_argument('--output_path', type=str, default='predictions', help='infer mode: output folder')
+    parser.add_argument('--data_path', type=str, default='/home/data/S3DIS', help='folder of the prepared S3DIS clouds')
+    parser.add_argument('--steps', type=int, default=100, help='benchmark mode: number of batches drained')
     FLAGS = parser.parse_args()
 
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
@@ -236,8 +671,19 @@ if __name__ == '__main__':
     Mode = FLAGS.mode
 
     test_area = FLAGS.test_area
-    dataset = S3DIS(test_area)
-    dataset.init_input_pipeline()
+    if Mode == 'infer':
+        # any ply files, prepared on the fly
+        dataset = PlyClouds(sorted(set(f for pattern in FLAGS.inputs for f in glob.glob(pattern))))
+    elif Mode == 'benchmark':
+        # training input pipeline alone, e.g. on the synthetic rooms of utils/data_prepare_s3dis.py --synthetic
+        dataset = S3DIS(test_area, splits=['training'], path=FLAGS.data_path)
+        dataset.timer = PipelineTimer()
+    else:
+        # test mode only needs the validation clouds
+        dataset = S3DIS(test_area, splits=['validation'] if Mode == 'test' else ['training', 'validation'],
+                        path=FLAGS.data_path)
+    # test mode covers the clouds with a fixed tiling instead of the random sampler
+    dataset.init_input_pipeline(tiling=Mode == 'test' and cfg.test_tiling)
 
     if Mode == 'train':
         model = Network(dataset, cfg)
@@ -245,18 +691,15 @@ if __name__ == '__main__':
     elif Mode == 'test':
         cfg.saving = False
         model = Network(dataset, cfg)
-        if FLAGS.model_path is not 'None':
-            chosen_snap = FLAGS.model_path
-        else:
-            chosen_snapshot = -1
-            logs = np.sort([os.path.join('results', f) for f in os.listdir('results') if f.startswith('Log')])
-            chosen_folder = logs[-1]
-            snap_path = join(chosen_folder, 'snapshots')
-            snap_steps = [int(f[:-5].split('-')[-1]) for f in os.listdir(snap_path) if f[-5:] == '.meta']
-            chosen_step = np.sort(snap_steps)[-1]
-            chosen_snap = os.path.join(snap_path, 'snap-{:d}'.format(chosen_step))
-        tester = ModelTester(model, dataset, restore_snap=chosen_snap)
+        tester = ModelTester(model, dataset, restore_snap=choose_snapshot(FLAGS.model_path))
         tester.test(model, dataset)
+    elif Mode == 'infer':
+        cfg.saving = False
+        model = Network(dataset, cfg)
+        inference = ModelInference(model, dataset, restore_snap=choose_snapshot(FLAGS.model_path))
+        inference.infer(model, dataset, FLAGS.output_path)
+    elif Mode == 'benchmark':
+        benchmark_pipeline(dataset, FLAGS.steps)
     else:
         ##################
         # Visualize data #
@@ -0,0 +1,216 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from concurrent.futures import Future
+from main_S3DIS import choose_snapshot, prepare_cloud
+from export_S3DIS import InferenceNetwork
+from helper_tool import ConfigS3DIS as cfg
+from helper_tool import DataProcessing as DP
+from helper_tool import VoteAccumulator
+import tensorflow as tf
+import numpy as np
+import threading, queue, collections, argparse, json, time, io, os
+
+
+class CropBatcher:
+    """
+    Single session running the crops of all the requests, a batch is run as soon as it is full (val_batch_size crops)
+    or when its first crop waited batch_timeout seconds
+    :param model_path: snapshot, or frozen GraphDef (.pb) written by export_S3DIS.py
+    """
+
+    def __init__(self, model_path, batch_size, batch_timeout):
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.crops = queue.Queue()
+        self.num_batches = 0
+        self.num_crops = 0
+
+        graph = tf.Graph()
+        with graph.as_default():
+            if model_path.endswith('.pb'):
+                graph_def = tf.GraphDef()
+                with tf.gfile.GFile(model_path, 'rb') as f:
+                    graph_def.ParseFromString(f.read())
+                tf.import_graph_def(graph_def, name='')
+                self.sess = tf.Session(graph=graph)
+            else:
+                InferenceNetwork(cfg)
+                self.sess = tf.Session(graph=graph)
+                tf.train.Saver(tf.global_variables()).restore(self.sess, model_path)
+            self.input_names = InferenceNetwork.flat_input_names(cfg)
+            self.inputs = [graph.get_tensor_by_name(name + ':0') for name in self.input_names]
+            self.probs = graph.get_tensor_by_name('results/probs:0')
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, xyz, colors):
+        # future of the probabilities of one crop, the crop is stamped with its submission time
+        future = Future()
+        self.crops.put((xyz, colors, future, time.time()))
+        return future
+
+    def next_batch(self):
+        # the timeout runs from the submission of the first crop, which may have been queued for a while
+        batch = [self.crops.get()]
+        deadline = batch[0][3] + self.batch_timeout
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.crops.get(timeout=max(0.0, deadline - time.time())))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                batch_xyz = np.stack([xyz for xyz, _, _, _ in batch])
+                batch_colors = np.stack([colors for _, colors, _, _ in batch])
+                flat_inputs = DP.pyramid_inputs(batch_xyz, batch_colors, cfg.k_n, cfg.sub_sampling_ratio,
+                                                cfg.knn_backend == 'voxel')
+                probs = self.sess.run(self.probs, dict(zip(self.inputs, flat_inputs)))
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            self.num_batches += 1
+            self.num_crops += len(batch)
+            for i, (_, _, future, _) in enumerate(batch):
+                future.set_result(probs[i])
+
+
+class SegmentationService:
+    """
+    Segmentation of whole clouds: sub-sampling, tiling, votes of the crops run by the batcher and reprojection
+    """
+
+    def __init__(self, batcher, num_votes):
+        self.batcher = batcher
+        self.num_votes = num_votes
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.num_requests = 0
+        self.num_points = 0
+        self.latencies = collections.deque(maxlen=1000)
+        self.start_time = time.time()
+
+    def segment(self, points, colors):
+        """
+        :param points: N*3 points
+        :param colors: N*3 colors in [0, 255]
+        :return: N predicted labels
+        """
+        t0 = time.time()
+        with self.lock:
+            self.in_flight += 1
+        try:
+            cloud = prepare_cloud(points, colors.astype(np.uint8))
+            crops = []
+            for vote in range(self.num_votes):
+                rng = np.random.RandomState(vote)
+                for center_idx, crop in zip(cloud['centers'], cloud['crops']):
+                    queried_idx = DP.tile_input(crop, cfg.num_points, rng)
+                    xyz = (cloud['sub_xyz'][queried_idx] - cloud['sub_xyz'][center_idx]).astype(np.float32)
+                    crops += [(queried_idx, self.batcher.submit(xyz, cloud['sub_colors'][queried_idx]))]
+
+            votes = VoteAccumulator([len(cloud['sub_xyz'])], cfg.num_classes)
+            for queried_idx, future in crops:
+                votes.update(np.zeros(1, dtype=np.int32), queried_idx[None, :], future.result()[None, :, :])
+            preds = np.argmax(votes.probs, axis=1)[cloud['proj_idx']].astype(np.uint8)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+        latency = time.time() - t0
+        with self.lock:
+            self.num_requests += 1
+            self.num_points += len(preds)
+            self.latencies.append(latency)
+        return preds, latency
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            stats = {'requests': self.num_requests,
+                     'in_flight': self.in_flight,
+                     'queued_crops': self.batcher.crops.qsize(),
+                     'batches': self.batcher.num_batches,
+                     'mean_batch_size': self.batcher.num_crops / max(self.batcher.num_batches, 1),
+                     'points_per_second': self.num_points / (time.time() - self.start_time)}
+        if len(latencies) > 0:
+            for p in [50, 95, 99]:
+                stats['latency_p{:d}_ms'.format(p)] = float(np.percentile(latencies, p))
+            stats['latency_max_ms'] = float(np.max(latencies))
+        return stats
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SegmentationHandler(BaseHTTPRequestHandler):
+    """
+    POST /segment: body is a .npy N*6 array (x, y, z, r, g, b), answers a .npy array of N uint8 labels
+    GET /stats: json statistics of the service
+    """
+    service = None
+
+    def do_POST(self):
+        if self.path != '/segment':
+            self.send_error(404)
+            return
+        try:
+            data = np.load(io.BytesIO(self.rfile.read(int(self.headers['Content-Length']))))
+            if data.ndim != 2 or data.shape[0] == 0 or data.shape[1] != 6:
+                raise ValueError('expected a N*6 array (x, y, z, r, g, b), got shape {}'.format(data.shape))
+        except Exception as e:
+            # unreadable body
+            self.send_error(400, str(e))
+            return
+        try:
+            preds, latency = self.service.segment(data[:, :3], data[:, 3:])
+        except Exception as e:
+            # e.g. an error of the session, raised again by the future of a crop
+            self.send_error(500, str(e))
+            return
+        out = io.BytesIO()
+        np.save(out, preds)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(out.getvalue())))
+        self.send_header('X-Latency-Ms', '{:.1f}'.format(1000 * latency))
+        self.end_headers()
+        self.wfile.write(out.getvalue())
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        body = json.dumps(self.service.stats()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gpu', type=int, default=0, help='the number of GPUs to use [default: 0]')
+    parser.add_argument('--model_path', type=str, default='None', help='snapshot or frozen graph (.pb) to serve')
+    parser.add_argument('--port', type=int, default=8000, help='port on localhost')
+    FLAGS = parser.parse_args()
+
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(FLAGS.gpu)
+    os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+    batcher = CropBatcher(choose_snapshot(FLAGS.model_path), cfg.val_batch_size, cfg.server_batch_timeout)
+    SegmentationHandler.service = SegmentationService(batcher, cfg.infer_votes)
+    server = ThreadingHTTPServer(('127.0.0.1', FLAGS.port), SegmentationHandler)
+    print('Serving on http://127.0.0.1:{:d} (POST /segment, GET /stats)'.format(FLAGS.port))
+    server.serve_forever()
@@ -1,12 +1,17 @@
 from os import makedirs
 from os.path import exists, join
 from helper_ply import write_ply
-from sklearn.metrics import confusion_matrix
 from helper_tool import DataProcessing as DP
+from helper_tool import VoteAccumulator
+from helper_metrics import ConfusionAccumulator
 import tensorflow as tf
 import numpy as np
+import multiprocessing
 import time
 
+# dataset of the reprojection, inherited by the forked workers
+reproject_dataset = None
+
 
 def log_out(out_str, log_f_out):
     log_f_out.write(out_str + '\n')
@@ -14,6 +19,25 @@ def log_out(out_str, log_f_out):
     print(out_str)
 
 
+def reproject_cloud(args):
+    """
+    Project the sub cloud predictions of a room to its original points and save them
+    :param args: room index, sub cloud predictions (indices of the classes) and saving path of the predictions
+    :return: confusion matrix and accuracy of the room
+    """
+    i_val, sub_preds, ply_file = args
+    dataset = reproject_dataset
+
+    # Gather the labels through the projection indices, never the probabilities
+    preds = dataset.label_values[sub_preds][dataset.val_proj[i_val]].astype(np.uint8)
+    labels = np.asarray(dataset.val_labels[i_val])
+    acc = np.sum(preds == labels) / len(labels)
+
+    write_ply(ply_file, [preds, labels], ['pred', 'label'])
+    confusion = ConfusionAccumulator(dataset.num_classes).update(labels, preds)
+    return confusion.confusion, acc
+
+
 class ModelTester:
     def __init__(self, model, dataset, restore_snap=None):
         my_vars = tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES)
@@ -37,15 +61,12 @@ class ModelTester:
 
         self.prob_logits = tf.nn.softmax(model.logits)
 
-        # Initiate global prediction over all test clouds
-        self.test_probs = [np.zeros(shape=[l.shape[0], model.config.num_classes], dtype=np.float32)
-                           for l in dataset.input_labels['validation']]
+        # Initiate global prediction over all test clouds, in one flat buffer
+        self.test_votes = VoteAccumulator(dataset.input_sizes['validation'], model.config.num_classes)
+        self.test_probs = [self.test_votes.cloud_probs(i) for i in range(len(dataset.input_sizes['validation']))]
 
     def test(self, model, dataset, num_votes=100):
 
-        # Smoothing parameter for votes
-        test_smooth = 0.95
-
         # Initialise iterator with validation/test data
         self.sess.run(dataset.val_init_op)
 
@@ -66,6 +87,8 @@ class ModelTester:
         step_id = 0
         epoch_id = 0
         last_min = -0.5
+        last_preds = None
+        last_m_IoU = 0
 
         while last_min < num_votes:
             try:
@@ -82,11 +105,8 @@ class ModelTester:
                 stacked_probs = np.reshape(stacked_probs, [model.config.val_batch_size, model.config.num_points,
                                                            model.config.num_classes])
 
-                for j in range(np.shape(stacked_probs)[0]):
-                    probs = stacked_probs[j, :, :]
-                    p_idx = point_idx[j, :]
-                    c_i = cloud_idx[j][0]
-                    self.test_probs[c_i][p_idx] = test_smooth * self.test_probs[c_i][p_idx] + (1 - test_smooth) * probs
+                # Smooth the votes of the whole batch (0.95 smoothing), duplicated points get all their votes
+                self.test_votes.update(cloud_idx, point_idx, stacked_probs)
                 step_id += 1
 
             except tf.errors.OutOfRangeError:
@@ -101,20 +121,20 @@ class ModelTester:
 
                     # Show vote results (On subcloud so it is not the good values here)
                     log_out('\nConfusion on sub clouds', self.Log_file)
-                    confusion_list = []
+                    confusion = ConfusionAccumulator(dataset.num_classes)
 
                     num_val = len(dataset.input_labels['validation'])
+                    sub_preds = np.argmax(self.test_votes.probs, axis=1)
 
                     for i_test in range(num_val):
-                        probs = self.test_probs[i_test]
-                        preds = dataset.label_values[np.argmax(probs, axis=1)].astype(np.int32)
+                        start, end = self.test_votes.offsets[i_test:i_test + 2]
+                        preds = dataset.label_values[sub_preds[start:end]].astype(np.int32)
                         labels = dataset.input_labels['validation'][i_test]
 
                         # Confs
-                        confusion_list += [confusion_matrix(labels, preds, dataset.label_values)]
+                        confusion.update(labels, preds)
 
-                    # Regroup confusions
-                    C = np.sum(np.stack(confusion_list), axis=0).astype(np.float32)
+                    C = confusion.confusion.astype(np.float32)
 
                     # Rescale with the right number of point per class
                     C *= np.expand_dims(val_proportions / (np.sum(C, axis=1) + 1e-6), 1)
@@ -127,47 +147,25 @@ class ModelTester:
                         s += '{:5.2f} '.format(100 * IoU)
                     log_out(s + '\n', self.Log_file)
 
-                    if int(np.ceil(new_min)) % 1 == 0:
-
-                        # Project predictions
-                        log_out('\nReproject Vote #{:d}'.format(int(np.floor(new_min))), self.Log_file)
-                        proj_probs_list = []
-
-                        for i_val in range(num_val):
-                            # Reproject probs back to the evaluations points
-                            proj_idx = dataset.val_proj[i_val]
-                            probs = self.test_probs[i_val][proj_idx, :]
-                            proj_probs_list += [probs]
-
-                        # Show vote results
-                        log_out('Confusion on full clouds', self.Log_file)
-                        confusion_list = []
-                        for i_test in range(num_val):
-                            # Get the predicted labels
-                            preds = dataset.label_values[np.argmax(proj_probs_list[i_test], axis=1)].astype(np.uint8)
-
-                            # Confusion
-                            labels = dataset.val_labels[i_test]
-                            acc = np.sum(preds == labels) / len(labels)
-                            log_out(dataset.input_names['validation'][i_test] + ' Acc:' + str(acc), self.Log_file)
-
-                            confusion_list += [confusion_matrix(labels, preds, dataset.label_values)]
-                            name = dataset.input_names['validation'][i_test] + '.ply'
-                            write_ply(join(test_path, 'val_preds', name), [preds, labels], ['pred', 'label'])
-
-                        # Regroup confusions
-                        C = np.sum(np.stack(confusion_list), axis=0)
-
-                        IoUs = DP.IoU_from_confusions(C)
-                        m_IoU = np.mean(IoUs)
-                        s = '{:5.2f} | '.format(100 * m_IoU)
-                        for IoU in IoUs:
-                            s += '{:5.2f} '.format(100 * IoU)
-                        log_out('-' * len(s), self.Log_file)
-                        log_out(s, self.Log_file)
-                        log_out('-' * len(s) + '\n', self.Log_file)
-                        print('finished \n')
-                        self.sess.close()
+                    if model.config.test_adaptive:
+                        # Stop voting once the sub cloud predictions or the mIoU do not move anymore between two
+                        # vote rounds, the full clouds are only projected and saved at the end
+                        converged = False
+                        if last_preds is not None:
+                            changed = np.mean(sub_preds != last_preds)
+                            delta = abs(m_IoU - last_m_IoU)
+                            log_out('Predictions changed: {:.3f}%, mIoU delta: {:.3f}'.format(100 * changed,
+                                                                                          100 * delta), self.Log_file)
+                            converged = changed < model.config.test_change_threshold or \
+                                delta < model.config.test_miou_delta
+                        last_preds = sub_preds
+                        last_m_IoU = m_IoU
+                        if converged or last_min + 1 >= num_votes:
+                            self.reproject(dataset, test_path, new_min, model.config.test_reproject_workers)
+                            return
+
+                    elif int(np.ceil(new_min)) % 1 == 0:
+                        self.reproject(dataset, test_path, new_min, model.config.test_reproject_workers)
                         return
 
                 self.sess.run(dataset.val_init_op)
@@ -176,3 +174,45 @@ class ModelTester:
                 continue
 
         return
+
+    def reproject(self, dataset, test_path, new_min, num_workers=0):
+        # Project predictions, one room at a time so only the largest room is held in memory
+        global reproject_dataset
+        log_out('\nReproject Vote #{:d}'.format(int(np.floor(new_min))), self.Log_file)
+        num_val = len(dataset.input_labels['validation'])
+        reproject_dataset = dataset
+
+        def jobs():
+            for i_val in range(num_val):
+                name = dataset.input_names['validation'][i_val] + '.ply'
+                yield i_val, np.argmax(self.test_probs[i_val], axis=1), join(test_path, 'val_preds', name)
+
+        # Show vote results
+        log_out('Confusion on full clouds', self.Log_file)
+        confusion = ConfusionAccumulator(dataset.num_classes)
+        if num_workers > 0:
+            pool = multiprocessing.get_context('fork').Pool(num_workers)
+            results = pool.imap(reproject_cloud, jobs())
+        else:
+            pool = None
+            results = map(reproject_cloud, jobs())
+
+        for i_test, (room_confusion, acc) in enumerate(results):
+            log_out(dataset.input_names['validation'][i_test] + ' Acc:' + str(acc), self.Log_file)
+            confusion.merge(room_confusion)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+        reproject_dataset = None
+
+        IoUs = DP.IoU_from_confusions(confusion.confusion)
+        m_IoU = np.mean(IoUs)
+        s = '{:5.2f} | '.format(100 * m_IoU)
+        for IoU in IoUs:
+            s += '{:5.2f} '.format(100 * IoU)
+        log_out('-' * len(s), self.Log_file)
+        log_out(s, self.Log_file)
+        log_out('-' * len(s) + '\n', self.Log_file)
+        print('finished \n')
+        self.sess.close()
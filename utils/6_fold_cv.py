@@ -6,6 +6,7 @@ ROOT_DIR = os.path.dirname(BASE_DIR)
 sys.path.append(ROOT_DIR)
 from helper_ply import read_ply
 from helper_tool import Plot
+from helper_metrics import ConfusionAccumulator
 
 
 if __name__ == '__main__':
@@ -14,11 +15,7 @@ if __name__ == '__main__':
     data_path = glob.glob(os.path.join(base_dir, '*.ply'))
     data_path = np.sort(data_path)
 
-    test_total_correct = 0
-    test_total_seen = 0
-    gt_classes = [0 for _ in range(13)]
-    positive_classes = [0 for _ in range(13)]
-    true_positive_classes = [0 for _ in range(13)]
+    confusion = ConfusionAccumulator(13)
     visualization = False
 
     for file_name in data_path:
@@ -40,28 +37,13 @@ if __name__ == '__main__':
 
         correct = np.sum(pred == labels)
         print(str(file_name.split('/')[-1][:-4]) + '_acc:' + str(correct / float(len(labels))))
-        test_total_correct += correct
-        test_total_seen += len(labels)
+        confusion.update(labels, pred)
 
-        for j in range(len(labels)):
-            gt_l = int(labels[j])
-            pred_l = int(pred[j])
-            gt_classes[gt_l] += 1
-            positive_classes[pred_l] += 1
-            true_positive_classes[gt_l] += int(gt_l == pred_l)
-
-    iou_list = []
-    for n in range(13):
-        iou = true_positive_classes[n] / float(gt_classes[n] + positive_classes[n] - true_positive_classes[n])
-        iou_list.append(iou)
-    mean_iou = sum(iou_list) / 13.0
-    print('eval accuracy: {}'.format(test_total_correct / float(test_total_seen)))
+    iou_list = list(confusion.ious())
+    mean_iou = confusion.mean_iou()
+    print('eval accuracy: {}'.format(confusion.overall_accuracy()))
     print('mean IoU: {}'.format(mean_iou))
     print(iou_list)
 
-    acc_list = []
-    for n in range(13):
-        acc = true_positive_classes[n] / float(gt_classes[n])
-        acc_list.append(acc)
-    mean_acc = sum(acc_list) / 13.0
+    mean_acc = confusion.mean_accuracy()
     print('mAcc value is: {}'.format(mean_acc))
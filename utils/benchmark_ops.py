@@ -0,0 +1,276 @@
+from os.path import dirname, abspath
+import numpy as np
+import sys, time, json, re, platform, argparse, multiprocessing
+
+BASE_DIR = dirname(abspath(__file__))
+ROOT_DIR = dirname(BASE_DIR)
+sys.path.append(BASE_DIR)
+sys.path.append(ROOT_DIR)
+from helper_tool import ConfigS3DIS as cfg
+from helper_tool import DataProcessing as DP
+from synthetic_rooms import synthetic_room
+import nearest_neighbors.lib.python.nearest_neighbors as nearest_neighbors
+
+
+def timings(fn, repeat):
+    """
+    :return: wall times of repeat calls of fn (after a warm-up call), in milliseconds
+    """
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return 1000 * np.array(times)
+
+
+def summary(name, params, times, items):
+    """
+    :param items: number of items (queries, crops, points) processed by a call, for the throughput
+    """
+    result = {'name': name, 'params': params, 'repeat': len(times), 'items': items}
+    result.update({key: float(value) for key, value in zip(['min', 'p50', 'p90', 'p99', 'max'],
+                                                           np.percentile(times, [0, 50, 90, 99, 100]))})
+    result['mean'] = float(np.mean(times))
+    result['items_per_s'] = items / max(result['p50'], 1e-6) * 1000
+    print('{:60s} p50 {:9.3f} ms  p90 {:9.3f} ms  p99 {:9.3f} ms  {:12.0f} items/s'.format(
+        name, result['p50'], result['p90'], result['p99'], result['items_per_s']))
+    return result
+
+
+def neighbour_distances(points, neighbor_idx):
+    batch_ids = np.arange(len(points))[:, None, None]
+    return np.sum((points[batch_ids, neighbor_idx] - points[:, :neighbor_idx.shape[1], None, :]) ** 2, axis=-1)
+
+
+class Clouds:
+    """
+    Input crops of the benchmarks, cfg.num_points points each in the random order of the training pipeline (so that
+    the first N_i points are the sub-sampled level i), either cut in synthetic rooms or drawn uniformly in a box
+    """
+
+    def __init__(self, rng, num_rooms):
+        self.rng = rng
+        self.rooms = []
+        for _ in range(num_rooms):
+            xyz, colors, labels = synthetic_room(rng)
+            self.rooms.append(DP.grid_sub_sampling(xyz, grid_size=cfg.sub_grid_size))
+
+    def crop(self, distribution, room_id=0):
+        if distribution == 'uniform':
+            room = self.rooms[room_id % len(self.rooms)]
+            extent = np.amax(room, axis=0) - np.amin(room, axis=0)
+            return (self.rng.rand(cfg.num_points, 3) * extent).astype(np.float32)
+        room = self.rooms[room_id % len(self.rooms)]
+        center = room[self.rng.randint(len(room))]
+        crop_ids = np.argpartition(np.sum((room - center) ** 2, axis=1), cfg.num_points - 1)[:cfg.num_points]
+        return room[self.rng.permutation(crop_ids)] - center
+
+    def batch(self, distribution, batch_size):
+        return np.stack([self.crop(distribution, i) for i in range(batch_size)])
+
+
+def set_backend(backend, npts):
+    # the brute force threshold picks between the kd-trees and the brute force for the knn_batch searches
+    nearest_neighbors.set_brute_force_threshold(npts if backend == 'brute_force' else 0)
+
+
+def bench_knn(FLAGS, clouds, selected):
+    """
+    knn_batch / knn_batch_voxel self searches of every pyramid level, the neighbour distances of the brute force and
+    voxel searches are checked against the kd-tree ones
+    """
+    results = []
+    level_npts = [cfg.num_points]
+    for ratio in cfg.sub_sampling_ratio:
+        level_npts.append(level_npts[-1] // ratio)
+    for distribution in FLAGS.distributions:
+        batches = {batch_size: clouds.batch(distribution, batch_size) for batch_size in FLAGS.batch_sizes}
+        for level in FLAGS.levels:
+            npts = level_npts[level]
+            for K in FLAGS.ks:
+                for batch_size in FLAGS.batch_sizes:
+                    points = np.ascontiguousarray(batches[batch_size][:, :npts])
+                    reference = None
+                    for num_threads in FLAGS.threads:
+                        for backend in FLAGS.backends:
+                            name = 'knn/{}/n={}/k={}/b={}/t={}/{}'.format(distribution, npts, K, batch_size,
+                                                                         num_threads, backend)
+                            if not selected(name) or (backend == 'brute_force' and npts > FLAGS.brute_force_max):
+                                continue
+                            nearest_neighbors.set_num_threads(num_threads)
+                            set_backend(backend, npts)
+                            knn_batch = nearest_neighbors.knn_batch_voxel if backend == 'voxel' else \
+                                nearest_neighbors.knn_batch
+                            times = timings(lambda: knn_batch(points, points, K, omp=True), FLAGS.repeat)
+                            params = {'distribution': distribution, 'npts': npts, 'level': level, 'k': K,
+                                      'batch_size': batch_size, 'threads': num_threads, 'backend': backend}
+                            result = summary(name, params, times, batch_size * npts)
+                            dists = neighbour_distances(points, knn_batch(points, points, K, omp=True))
+                            if reference is None:
+                                set_backend('kdtree', npts)
+                                reference = neighbour_distances(
+                                    points, nearest_neighbors.knn_batch(points, points, K, omp=True))
+                            result['exact'] = bool(np.array_equal(dists, reference))
+                            if not result['exact']:
+                                print('  neighbour distances differ from the kd-tree ones')
+                            results.append(result)
+    return results
+
+
+def bench_pyramid(FLAGS, clouds, selected):
+    """
+    DP.knn_pyramid: all the searches of the network inputs of a batch, as run by the input pipeline
+    """
+    results = []
+    for distribution in FLAGS.distributions:
+        for batch_size in FLAGS.batch_sizes:
+            batch_xyz = clouds.batch(distribution, batch_size)
+            for num_threads in FLAGS.threads:
+                for voxel in [False, True]:
+                    name = 'pyramid/{}/b={}/t={}/{}'.format(distribution, batch_size, num_threads,
+                                                           'voxel' if voxel else 'kdtree')
+                    if not selected(name):
+                        continue
+                    nearest_neighbors.set_num_threads(num_threads)
+                    nearest_neighbors.set_brute_force_threshold(cfg.knn_brute_force_npts)
+                    times = timings(lambda: DP.knn_pyramid(batch_xyz, cfg.k_n, cfg.sub_sampling_ratio, voxel=voxel),
+                                    FLAGS.repeat)
+                    params = {'distribution': distribution, 'batch_size': batch_size, 'threads': num_threads,
+                              'backend': 'voxel' if voxel else 'kdtree'}
+                    results.append(summary(name, params, times, batch_size))
+    return results
+
+
+def bench_crop(FLAGS, clouds, selected):
+    """
+    Search index of a sub-sampled room (KDTree or VoxelGrid) and the crops of cfg.num_points points around random
+    centers, as in the training generator
+    """
+    results = []
+    room = clouds.rooms[0]
+    for backend, index in [('kdtree', nearest_neighbors.KDTree), ('voxel', nearest_neighbors.VoxelGrid)]:
+        name = 'index/room/n={}/{}'.format(len(room), backend)
+        if selected(name):
+            times = timings(lambda: index(room), FLAGS.repeat)
+            results.append(summary(name, {'npts': len(room), 'backend': backend}, times, len(room)))
+        name = 'crop/room/n={}/k={}/{}'.format(len(room), cfg.num_points, backend)
+        if selected(name):
+            tree = index(room)
+            centers = iter(room[clouds.rng.randint(len(room), size=FLAGS.repeat + 1)])
+            times = timings(lambda: tree.query_crop(next(centers), cfg.num_points), FLAGS.repeat)
+            params = {'npts': len(room), 'k': cfg.num_points, 'backend': backend}
+            results.append(summary(name, params, times, 1))
+    return results
+
+
+def bench_subsampling(FLAGS, clouds, selected):
+    """
+    Grid sub-sampling (cpp_subsampling) of raw rooms (points, colors and labels, as in utils/data_prepare_s3dis.py) and on uniform
+    clouds of the same size
+    """
+    results = []
+    for density in FLAGS.densities:
+        xyz, colors, labels = synthetic_room(clouds.rng, density=density)
+        for distribution in FLAGS.distributions:
+            if distribution == 'uniform':
+                points = (clouds.rng.rand(*xyz.shape) * np.amax(xyz, axis=0)).astype(np.float32)
+            else:
+                points = xyz
+            name = 'subsampling/{}/n={}/dl={:.3f}'.format(distribution, len(points), cfg.sub_grid_size)
+            if not selected(name):
+                continue
+            times = timings(lambda: DP.grid_sub_sampling(points, colors, labels, cfg.sub_grid_size), FLAGS.repeat)
+            params = {'distribution': distribution, 'npts': len(points), 'density': density,
+                      'sub_grid_size': cfg.sub_grid_size}
+            results.append(summary(name, params, times, len(points)))
+    return results
+
+
+def compare(results, baseline_file, tolerance):
+    """
+    Compare the p50 times with the ones of a previous run
+    :return: names of the cases more than tolerance slower than in the baseline
+    """
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    for key in ['cpu_count', 'machine']:
+        if baseline['meta'].get(key) != platform_meta()[key]:
+            print('warning: baseline {} is {}, not {}'.format(key, baseline['meta'].get(key), platform_meta()[key]))
+    baseline_p50 = {result['name']: result['p50'] for result in baseline['results']}
+    regressions = []
+    print('\n{:60s} {:>12s} {:>12s} {:>8s}'.format('case', 'baseline ms', 'p50 ms', 'ratio'))
+    for result in results:
+        if result['name'] not in baseline_p50:
+            continue
+        ratio = result['p50'] / max(baseline_p50[result['name']], 1e-6)
+        slower = ratio > 1 + tolerance
+        print('{:60s} {:12.3f} {:12.3f} {:8.2f}{}'.format(result['name'], baseline_p50[result['name']],
+                                                         result['p50'], ratio, '  REGRESSION' if slower else ''))
+        if slower:
+            regressions.append(result['name'])
+    missing = set(baseline_p50) - set(result['name'] for result in results)
+    if missing:
+        print('{} baseline cases not run'.format(len(missing)))
+    return regressions
+
+
+def platform_meta():
+    return {'machine': platform.machine(), 'processor': platform.processor(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'cpu_count': multiprocessing.cpu_count()}
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark of the knn searches, crops and grid sub-sampling')
+    parser.add_argument('--benchmarks', type=lambda v: v.split(','), default=['knn', 'pyramid', 'crop', 'subsampling'],
+                        help='comma separated benchmarks among knn, pyramid, crop, subsampling')
+    parser.add_argument('--filter', type=str, default='', help='only run the cases whose name matches this regex')
+    parser.add_argument('--distributions', type=lambda v: v.split(','), default=['room', 'uniform'],
+                        help='point distributions: room (synthetic S3DIS-like rooms) and/or uniform')
+    parser.add_argument('--levels', type=int_list, default=list(range(len(cfg.sub_sampling_ratio) + 1)),
+                        help='pyramid levels of the knn searches [default: all]')
+    parser.add_argument('--ks', type=int_list, default=[3, cfg.k_n], help='numbers of neighbours')
+    parser.add_argument('--batch_sizes', type=int_list, default=[1, cfg.batch_size], help='batch sizes')
+    parser.add_argument('--threads', type=int_list, default=sorted({1, multiprocessing.cpu_count()}),
+                        help='thread counts of the omp searches')
+    parser.add_argument('--backends', type=lambda v: v.split(','), default=['kdtree', 'brute_force', 'voxel'],
+                        help='knn backends: kdtree, brute_force and/or voxel')
+    parser.add_argument('--brute_force_max', type=int, default=2048, help='largest level searched by brute force')
+    parser.add_argument('--densities', type=int_list, default=[2000, 8000],
+                        help='raw points per square meter of the sub-sampled rooms')
+    parser.add_argument('--repeat', type=int, default=10, help='timed runs of each case')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=str, default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', type=str, default=None, help='json results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='relative p50 slow down above which a case is reported as a regression')
+    FLAGS = parser.parse_args()
+
+    pattern = re.compile(FLAGS.filter)
+    selected = lambda name: pattern.search(name) is not None
+    clouds = Clouds(np.random.RandomState(FLAGS.seed), max(FLAGS.batch_sizes))
+    benchmarks = {'knn': bench_knn, 'pyramid': bench_pyramid, 'crop': bench_crop, 'subsampling': bench_subsampling}
+    brute_force_npts = nearest_neighbors.set_brute_force_threshold(0)
+    results = []
+    for benchmark in FLAGS.benchmarks:
+        results += benchmarks[benchmark](FLAGS, clouds, selected)
+    nearest_neighbors.set_brute_force_threshold(brute_force_npts)
+    nearest_neighbors.set_num_threads(0)
+
+    if FLAGS.output is not None:
+        meta = platform_meta()
+        meta.update({'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'flags': vars(FLAGS)})
+        with open(FLAGS.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+    if FLAGS.baseline is not None:
+        regressions = compare(results, FLAGS.baseline, FLAGS.tolerance)
+        if regressions:
+            print('{} regressions'.format(len(regressions)))
+            sys.exit(1)
+    if not all(result.get('exact', True) for result in results):
+        sys.exit(1)
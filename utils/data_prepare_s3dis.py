@@ -2,14 +2,17 @@ from sklearn.neighbors import KDTree
 from os.path import join, exists, dirname, abspath
 import numpy as np
 import pandas as pd
-import os, sys, glob, pickle
+import os, sys, glob, pickle, time, argparse
+import multiprocessing
 
 BASE_DIR = dirname(abspath(__file__))
 ROOT_DIR = dirname(BASE_DIR)
 sys.path.append(BASE_DIR)
 sys.path.append(ROOT_DIR)
-from helper_ply import write_ply
+from helper_ply import write_ply, read_ply
 from helper_tool import DataProcessing as DP
+from synthetic_rooms import synthetic_room
+import nearest_neighbors.lib.python.nearest_neighbors as nearest_neighbors
 
 dataset_path = '/home/data/S3DIS/Stanford3dDataset_v1.2_Aligned_Version'
 anno_paths = [line.rstrip() for line in open(join(BASE_DIR, 'meta/anno_paths.txt'))]
@@ -20,10 +23,33 @@ gt_class2label = {cls: i for i, cls in enumerate(gt_class)}
 
 sub_grid_size = 0.04
 original_pc_folder = join(dirname(dataset_path), 'original_ply')
-sub_pc_folder = join(dirname(dataset_path), 'inout_{:.3f}'.format(sub_grid_size))
-os.mkdir(original_pc_folder) if not exists(original_pc_folder) else None
-os.mkdir(sub_pc_folder) if not exists(sub_pc_folder) else None
+sub_pc_folder = join(dirname(dataset_path), 'input_{:.3f}'.format(sub_grid_size))
 out_format = '.ply'
+proj_omp = True
+
+
+def read_xyzrgb(file_name):
+    """
+    Read an annotation file (each line is XYZRGB) with the single-space fast path of the pandas C parser, falling back
+    to the whitespace-delimited parser for irregular files
+    :param file_name: path to the txt file
+    :return: N*6 float64 array
+    """
+    try:
+        pc = pd.read_csv(file_name, header=None, sep=' ', dtype=np.float64, na_filter=False, engine='c').values
+        if pc.shape[1] == 6:
+            return pc
+    except ValueError:
+        pass
+    # e.g. the extra character in Area_5/hallway_6, tabs or repeated spaces
+    return pd.read_csv(file_name, header=None, delim_whitespace=True).values
+
+
+def is_up_to_date(outputs, inputs):
+    # all the outputs exist and are newer than all the inputs (no or missing inputs: not up to date)
+    if not inputs or not all(exists(f) for f in list(outputs) + list(inputs)):
+        return False
+    return min(os.path.getmtime(f) for f in outputs) >= max(os.path.getmtime(f) for f in inputs)
 
 
 def convert_pc2ply(anno_path, save_path):
@@ -36,11 +62,14 @@ def convert_pc2ply(anno_path, save_path):
     """
     data_list = []
 
-    for f in glob.glob(join(anno_path, '*.txt')):
+    anno_files = glob.glob(join(anno_path, '*.txt'))
+    if not anno_files:
+        raise ValueError('no annotation files in {:s}'.format(anno_path))
+    for f in anno_files:
         class_name = os.path.basename(f).split('_')[0]
         if class_name not in gt_class:  # note: in some room there is 'staris' class..
             class_name = 'clutter'
-        pc = pd.read_csv(f, header=None, delim_whitespace=True).values
+        pc = read_xyzrgb(f)
         labels = np.ones((pc.shape[0], 1)) * gt_class2label[class_name]
         data_list.append(np.concatenate([pc, labels], 1))  # Nx7
 
@@ -52,7 +81,18 @@ def convert_pc2ply(anno_path, save_path):
     colors = pc_label[:, 3:6].astype(np.uint8)
     labels = pc_label[:, 6].astype(np.uint8)
     write_ply(save_path, (xyz, colors, labels), ['x', 'y', 'z', 'red', 'green', 'blue', 'class'])
+    return xyz, colors, labels
 
+
+def sub_sample_ply(xyz, colors, labels, save_path):
+    """
+    Sub-sample an original point cloud and save the sub-sampled cloud, its KDTree and the projection indices.
+    :param xyz: original points
+    :param colors: original colors
+    :param labels: original labels
+    :param save_path: path of the original point cloud
+    :return: None
+    """
     # save sub_cloud and KDTree file
     sub_xyz, sub_colors, sub_labels = DP.grid_sub_sampling(xyz, colors, labels, sub_grid_size)
     sub_colors = sub_colors / 255.0
@@ -64,17 +104,96 @@ def convert_pc2ply(anno_path, save_path):
     with open(kd_tree_file, 'wb') as f:
         pickle.dump(search_tree, f)
 
-    proj_idx = np.squeeze(search_tree.query(xyz, return_distance=False))
+    # project the original points with a nanoflann tree, much faster than the sklearn one on millions of queries
+    proj_idx = np.squeeze(nearest_neighbors.KDTree(sub_xyz).query(xyz, return_distance=False, omp=proj_omp))
     proj_idx = proj_idx.astype(np.int32)
     proj_save = join(sub_pc_folder, str(save_path.split('/')[-1][:-4]) + '_proj.pkl')
     with open(proj_save, 'wb') as f:
         pickle.dump([proj_idx, labels], f)
 
 
+def prepare_room(args):
+    """
+    Convert and sub-sample one room, skipping the steps whose outputs are newer than their inputs
+    :param args: (path to annotations, force)
+    :return: log line
+    """
+    anno_path, force = args
+    t0 = time.time()
+    elements = str(anno_path).split('/')
+    cloud_name = elements[-3] + '_' + elements[-2]
+    save_path = join(original_pc_folder, cloud_name + out_format)
+    sub_outputs = [join(sub_pc_folder, cloud_name + suffix) for suffix in ['.ply', '_KDTree.pkl', '_proj.pkl']]
+
+    # the original cloud only depends on the annotation files, so it is kept when changing sub_grid_size
+    if force or not is_up_to_date([save_path], glob.glob(join(anno_path, '*.txt'))):
+        xyz, colors, labels = convert_pc2ply(anno_path, save_path)
+    elif not is_up_to_date(sub_outputs, [save_path]):
+        data = read_ply(save_path)
+        xyz = np.vstack((data['x'], data['y'], data['z'])).T
+        colors = np.vstack((data['red'], data['green'], data['blue'])).T
+        labels = data['class']
+    else:
+        return '{:s} up to date'.format(cloud_name)
+
+    sub_sample_ply(xyz, colors, labels, save_path)
+    return '{:s} done in {:.1f}s'.format(cloud_name, time.time() - t0)
+
+
+def prepare_synthetic_room(args):
+    """
+    Generate one synthetic S3DIS-like room (utils/synthetic_rooms.py) and prepare it as the real ones, e.g. to benchmark
+    the input pipeline without the dataset
+    :param args: (room index, force), the room is in area room % 6 + 1 and only depends on its index
+    :return: log line
+    """
+    room, force = args
+    t0 = time.time()
+    cloud_name = 'Area_{:d}_synthetic_{:d}'.format(room % 6 + 1, room)
+    save_path = join(original_pc_folder, cloud_name + out_format)
+    sub_outputs = [join(sub_pc_folder, cloud_name + suffix) for suffix in ['.ply', '_KDTree.pkl', '_proj.pkl']]
+    if not force and is_up_to_date(sub_outputs, [save_path]):
+        return '{:s} up to date'.format(cloud_name)
+
+    xyz, colors, labels = synthetic_room(np.random.RandomState(room))
+    write_ply(save_path, (xyz, colors, labels), ['x', 'y', 'z', 'red', 'green', 'blue', 'class'])
+    sub_sample_ply(xyz, colors, labels, save_path)
+    return '{:s} done in {:.1f}s'.format(cloud_name, time.time() - t0)
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of rooms prepared in parallel [default: number of cpus]')
+    parser.add_argument('--sub_grid_size', type=float, default=sub_grid_size, help='sub-sampling grid size')
+    parser.add_argument('--force', action='store_true', help='prepare all the rooms again, even up to date ones')
+    parser.add_argument('--data_path', type=str, default=dirname(dataset_path),
+                        help='folder of the Stanford3dDataset_v1.2_Aligned_Version folder and of the prepared clouds')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='prepare this number of synthetic rooms instead of the dataset (no download needed)')
+    FLAGS = parser.parse_args()
+
+    sub_grid_size = FLAGS.sub_grid_size
+    dataset_path = join(FLAGS.data_path, 'Stanford3dDataset_v1.2_Aligned_Version')
+    anno_paths = [join(dataset_path, line.rstrip()) for line in open(join(BASE_DIR, 'meta/anno_paths.txt'))]
+    original_pc_folder = join(FLAGS.data_path, 'original_ply')
+    sub_pc_folder = join(FLAGS.data_path, 'input_{:.3f}'.format(sub_grid_size))
+    # the rooms are spread over the workers, one thread each for the projection then
+    proj_omp = FLAGS.num_workers <= 1
+    os.makedirs(original_pc_folder, exist_ok=True)
+    os.makedirs(sub_pc_folder, exist_ok=True)
+
     # Note: there is an extra character in the v1.2 data in Area_5/hallway_6. It's fixed manually.
-    for annotation_path in anno_paths:
-        print(annotation_path)
-        elements = str(annotation_path).split('/')
-        out_file_name = elements[-3] + '_' + elements[-2] + out_format
-        convert_pc2ply(annotation_path, join(original_pc_folder, out_file_name))
+    if FLAGS.synthetic > 0:
+        prepare, jobs = prepare_synthetic_room, [(room, FLAGS.force) for room in range(FLAGS.synthetic)]
+    else:
+        prepare, jobs = prepare_room, [(annotation_path, FLAGS.force) for annotation_path in anno_paths]
+    if FLAGS.num_workers <= 1:
+        for job in jobs:
+            print(prepare(job))
+    else:
+        pool = multiprocessing.get_context('fork').Pool(FLAGS.num_workers)
+        for log in pool.imap_unordered(prepare, jobs):
+            print(log)
+        pool.close()
+        pool.join()
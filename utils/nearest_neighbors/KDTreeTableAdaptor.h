@@ -131,11 +131,13 @@ struct KDTreeTableAdaptor
 	const TableType* m_data;
 
 	/// Constructor: takes a const ref to the vector of vectors object with the data points
-	KDTreeTableAdaptor(const size_t npts, const size_t dim, const TableType* mat, const int leaf_max_size = 10) : m_data(mat), dim(dim), npts(npts)
+	/// (without building the index when it is loaded from a file afterwards)
+	KDTreeTableAdaptor(const size_t npts, const size_t dim, const TableType* mat, const int leaf_max_size = 10, const bool build_index = true) : m_data(mat), dim(dim), npts(npts)
 	{
 		assert(npts != 0);
 		index = new index_t( static_cast<int>(dim), *this /* adaptor */, nanoflann::KDTreeSingleIndexAdaptorParams(leaf_max_size ) );
-		index->buildIndex();
+		if (build_index)
+			index->buildIndex();
 	}
 
 	~KDTreeTableAdaptor() {
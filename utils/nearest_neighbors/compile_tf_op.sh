@@ -0,0 +1,8 @@
+#!/bin/bash
+
+# Compile the tensorflow knn ops against the installed tensorflow
+TF_CFLAGS=$(python -c 'import tensorflow as tf; print(" ".join(tf.sysconfig.get_compile_flags()))')
+TF_LFLAGS=$(python -c 'import tensorflow as tf; print(" ".join(tf.sysconfig.get_link_flags()))')
+
+mkdir -p lib/tf
+g++ -std=c++11 -shared -fPIC -O2 -fopenmp tf_knn_op.cpp knn_.cxx -o lib/tf/tf_knn_op.so -I. $TF_CFLAGS $TF_LFLAGS
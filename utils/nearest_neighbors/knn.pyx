@@ -1,26 +1,35 @@
 # distutils: language = c++
 # distutils: sources = knn.cxx
 
+import os
 import numpy as np
 cimport numpy as np
 import cython
+from libcpp.vector cimport vector
+from libcpp.pair cimport pair
+from libcpp cimport bool
 
-cdef extern from "knn_.h":
-    void cpp_knn(const float* points, const size_t npts, const size_t dim,
+cdef extern from "knn_.h" nogil:
+    void cpp_knn_set_num_threads(const int num_threads)
+    int cpp_knn_num_threads()
+    void cpp_knn_set_brute_force_npts(const size_t npts)
+    size_t cpp_knn_brute_force_npts()
+
+    void cpp_knn[T](const float* points, const size_t npts, const size_t dim,
 			const float* queries, const size_t nqueries,
-			const size_t K, long* indices)
+			const size_t K, T* indices, const float eps)
 
-    void cpp_knn_omp(const float* points, const size_t npts, const size_t dim,
+    void cpp_knn_omp[T](const float* points, const size_t npts, const size_t dim,
                 const float* queries, const size_t nqueries,
-                const size_t K, long* indices)
+                const size_t K, T* indices, const float eps)
 
-    void cpp_knn_batch(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+    void cpp_knn_batch[T](const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
                 const float* queries, const size_t nqueries,
-                const size_t K, long* batch_indices)
+                const size_t K, T* batch_indices, const float eps)
 
-    void cpp_knn_batch_omp(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+    void cpp_knn_batch_omp[T](const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
                     const float* queries, const size_t nqueries,
-                    const size_t K, long* batch_indices)
+                    const size_t K, T* batch_indices, const float eps)
 
     void cpp_knn_batch_distance_pick(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
                     float* queries, const size_t nqueries,
@@ -30,83 +39,250 @@ cdef extern from "knn_.h":
 				float* batch_queries, const size_t nqueries,
 				const size_t K, long* batch_indices)
 
-def knn(pts, queries, K, omp=False):
+    void cpp_knn_batch_pyramid[T](const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+				const size_t* level_npts, const size_t nlevels,
+				const size_t* support_levels, const size_t* query_levels, const size_t* Ks, const size_t nsearches,
+				T** batch_indices, const float* eps)
+
+    void cpp_knn_batch_pyramid_omp[T](const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+				const size_t* level_npts, const size_t nlevels,
+				const size_t* support_levels, const size_t* query_levels, const size_t* Ks, const size_t nsearches,
+				T** batch_indices, const float* eps)
+
+    void cpp_knn_batch_voxel[T](const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+                const float* queries, const size_t nqueries,
+                const size_t K, T* batch_indices) except +
+
+    void cpp_knn_batch_voxel_omp[T](const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+                    const float* queries, const size_t nqueries,
+                    const size_t K, T* batch_indices) except +
+
+    cdef cppclass cpp_kdtree:
+        cpp_kdtree(const float* points, const size_t npts, const size_t dim, const size_t leaf_size) except +
+        cpp_kdtree(const float* points, const size_t npts, const size_t dim, const char* index_file) except +
+        void knn(const float* queries, const size_t nqueries, const size_t K,
+                long* indices, float* dists_sqr, const bool omp)
+        size_t radius(const float* query, const float radius_sqr,
+                vector[pair[size_t, float]]& indices_dists, const bool sorted)
+        void crop(const float* query, const size_t K, long* indices, float* dists_sqr, float& radius_sqr)
+        void save(const char* index_file) except +
+        size_t npts
+        size_t dim
+        size_t leaf_size
+
+    cdef cppclass cpp_voxel_grid:
+        cpp_voxel_grid(const float* points, const size_t npts, const size_t dim) except +
+        void knn(const float* queries, const size_t nqueries, const size_t K,
+                long* indices, float* dists_sqr, const bool omp)
+        void crop(const float* query, const size_t K, long* indices, float* dists_sqr, float& radius_sqr)
+        size_t nbytes()
+        size_t npts
+        size_t dim
+        double voxel_size
+
+def set_num_threads(num_threads):
+    """
+    Cap the threads of the omp searches (0: the omp default, e.g. OMP_NUM_THREADS or every core)
+    :return: number of threads the searches will use
+    """
+    cpp_knn_set_num_threads(num_threads)
+    return cpp_knn_num_threads()
+
+
+def set_brute_force_threshold(npts):
+    """
+    Search the support sets up to npts points by brute force instead of building a kd-tree (0: always a kd-tree).
+    Does not apply to KDTree objects.
+    :return: previous threshold
+    """
+    previous = cpp_knn_brute_force_npts()
+    cpp_knn_set_brute_force_npts(npts)
+    return previous
+
+
+def _indices_buffer(out, shape):
+    # check the buffer given by the caller, or allocate an int32 one
+    if out is None:
+        return np.empty(shape, dtype=np.int32)
+    if (out.shape != shape or out.dtype not in (np.int32, np.int64)
+            or not out.flags['C_CONTIGUOUS'] or not out.flags['WRITEABLE']):
+        raise ValueError('out must be a writeable C-contiguous int32 or int64 array of shape {}'.format(shape))
+    return out
+
+def knn(pts, queries, K, omp=False, out=None, eps=0):
+    """
+    K nearest neighbours of the queries, the search runs without the GIL
+    :param pts: N*dim points (not copied if already C-contiguous float32)
+    :param queries: M*dim query points (not copied if already C-contiguous float32)
+    :param out: optional M*K int32 or int64 array receiving the indices
+    :param eps: approximate search, the squared distance of the K-th neighbour found is at most (1 + eps) times the
+                exact one (0: exact)
+    :return: M*K neighbour indices, int32 unless out is given
+    """
 
     # define shape parameters
-    cdef int npts
-    cdef int dim
-    cdef int K_cpp
-    cdef int nqueries
+    cdef size_t npts
+    cdef size_t dim
+    cdef size_t K_cpp
+    cdef size_t nqueries
+    cdef float eps_cpp = eps
+    cdef bint omp_cpp = omp
+    cdef bint int32
 
     # define tables
     cdef np.ndarray[np.float32_t, ndim=2] pts_cpp
     cdef np.ndarray[np.float32_t, ndim=2] queries_cpp
-    cdef np.ndarray[np.int64_t, ndim=2] indices_cpp
+    cdef np.ndarray indices_cpp
+
+    pts_cpp = np.ascontiguousarray(pts, dtype=np.float32)
+    queries_cpp = np.ascontiguousarray(queries, dtype=np.float32)
 
     # set shape values
-    npts = pts.shape[0]
-    nqueries = queries.shape[0]
-    dim = pts.shape[1]
+    npts = pts_cpp.shape[0]
+    nqueries = queries_cpp.shape[0]
+    dim = pts_cpp.shape[1]
     K_cpp = K
 
     # create indices tensor
-    indices = np.zeros((queries.shape[0], K), dtype=np.int64)
+    indices_cpp = _indices_buffer(out, (queries_cpp.shape[0], K))
+    int32 = indices_cpp.dtype == np.int32
 
-    pts_cpp = np.ascontiguousarray(pts, dtype=np.float32)
-    queries_cpp = np.ascontiguousarray(queries, dtype=np.float32)
-    indices_cpp = indices
+    cdef const float* pts_ptr = <float*> pts_cpp.data
+    cdef const float* queries_ptr = <float*> queries_cpp.data
+    cdef void* indices_ptr = indices_cpp.data
 
-    # normal estimation
-    if omp:
-        cpp_knn_omp(<float*> pts_cpp.data, npts, dim,
-                <float*> queries_cpp.data, nqueries,
-                K_cpp, <long*> indices_cpp.data)
-    else:
-        cpp_knn(<float*> pts_cpp.data, npts, dim,
-                <float*> queries_cpp.data, nqueries,
-                K_cpp, <long*> indices_cpp.data)
+    with nogil:
+        if omp_cpp and int32:
+            cpp_knn_omp[int](pts_ptr, npts, dim, queries_ptr, nqueries, K_cpp, <int*> indices_ptr, eps_cpp)
+        elif omp_cpp:
+            cpp_knn_omp[long](pts_ptr, npts, dim, queries_ptr, nqueries, K_cpp, <long*> indices_ptr, eps_cpp)
+        elif int32:
+            cpp_knn[int](pts_ptr, npts, dim, queries_ptr, nqueries, K_cpp, <int*> indices_ptr, eps_cpp)
+        else:
+            cpp_knn[long](pts_ptr, npts, dim, queries_ptr, nqueries, K_cpp, <long*> indices_ptr, eps_cpp)
 
-    return indices
+    return indices_cpp
 
-def knn_batch(pts, queries, K, omp=False):
+def knn_batch(pts, queries, K, omp=False, out=None, eps=0):
+    """
+    K nearest neighbours of each batch of queries in the corresponding cloud, the search runs without the GIL
+    :param pts: B*N*dim points (not copied if already C-contiguous float32)
+    :param queries: B*M*dim query points (not copied if already C-contiguous float32)
+    :param out: optional B*M*K int32 or int64 array receiving the indices
+    :param eps: approximate search as in knn (0: exact)
+    :return: B*M*K neighbour indices, int32 unless out is given
+    """
 
     # define shape parameters
-    cdef int batch_size
-    cdef int npts
-    cdef int nqueries
-    cdef int K_cpp
-    cdef int dim
+    cdef size_t batch_size
+    cdef size_t npts
+    cdef size_t nqueries
+    cdef size_t K_cpp
+    cdef size_t dim
+    cdef float eps_cpp = eps
+    cdef bint omp_cpp = omp
+    cdef bint int32
 
     # define tables
     cdef np.ndarray[np.float32_t, ndim=3] pts_cpp
     cdef np.ndarray[np.float32_t, ndim=3] queries_cpp
-    cdef np.ndarray[np.int64_t, ndim=3] indices_cpp
+    cdef np.ndarray indices_cpp
+
+    pts_cpp = np.ascontiguousarray(pts, dtype=np.float32)
+    queries_cpp = np.ascontiguousarray(queries, dtype=np.float32)
 
     # set shape values
-    batch_size = pts.shape[0]
-    npts = pts.shape[1]
-    dim = pts.shape[2]
-    nqueries = queries.shape[1]
+    batch_size = pts_cpp.shape[0]
+    npts = pts_cpp.shape[1]
+    dim = pts_cpp.shape[2]
+    nqueries = queries_cpp.shape[1]
     K_cpp = K
 
     # create indices tensor
-    indices = np.zeros((pts.shape[0], queries.shape[1], K), dtype=np.int64)
+    indices_cpp = _indices_buffer(out, (pts_cpp.shape[0], queries_cpp.shape[1], K))
+    int32 = indices_cpp.dtype == np.int32
+
+    cdef const float* pts_ptr = <float*> pts_cpp.data
+    cdef const float* queries_ptr = <float*> queries_cpp.data
+    cdef void* indices_ptr = indices_cpp.data
+
+    with nogil:
+        if omp_cpp and int32:
+            cpp_knn_batch_omp[int](pts_ptr, batch_size, npts, dim, queries_ptr, nqueries, K_cpp,
+                                   <int*> indices_ptr, eps_cpp)
+        elif omp_cpp:
+            cpp_knn_batch_omp[long](pts_ptr, batch_size, npts, dim, queries_ptr, nqueries, K_cpp,
+                                    <long*> indices_ptr, eps_cpp)
+        elif int32:
+            cpp_knn_batch[int](pts_ptr, batch_size, npts, dim, queries_ptr, nqueries, K_cpp,
+                               <int*> indices_ptr, eps_cpp)
+        else:
+            cpp_knn_batch[long](pts_ptr, batch_size, npts, dim, queries_ptr, nqueries, K_cpp,
+                                <long*> indices_ptr, eps_cpp)
+
+    return indices_cpp
+
+def knn_batch_voxel(pts, queries, K, omp=False, out=None):
+    """
+    Same as knn_batch, with a voxel grid of each cloud instead of a kd-tree: faster on clouds of bounded density
+    (e.g. grid sub-sampled) and exact, but the neighbours at equal distances can come in another order
+    :param pts: B*N*3 points (not copied if already C-contiguous float32)
+    :param queries: B*M*3 query points (not copied if already C-contiguous float32)
+    :param out: optional B*M*K int32 or int64 array receiving the indices
+    :return: B*M*K neighbour indices, int32 unless out is given
+    """
+
+    # define shape parameters
+    cdef size_t batch_size
+    cdef size_t npts
+    cdef size_t nqueries
+    cdef size_t K_cpp
+    cdef size_t dim
+    cdef bint omp_cpp = omp
+    cdef bint int32
+
+    # define tables
+    cdef np.ndarray[np.float32_t, ndim=3] pts_cpp
+    cdef np.ndarray[np.float32_t, ndim=3] queries_cpp
+    cdef np.ndarray indices_cpp
 
     pts_cpp = np.ascontiguousarray(pts, dtype=np.float32)
     queries_cpp = np.ascontiguousarray(queries, dtype=np.float32)
-    indices_cpp = indices
+    if pts_cpp.shape[2] != 3 or queries_cpp.shape[2] != 3:
+        raise ValueError('voxel grids are only defined for 3d points')
+    if K > pts_cpp.shape[1]:
+        raise ValueError('K={} is larger than the number of points {}'.format(K, pts_cpp.shape[1]))
 
-    # normal estimation
-    if omp:
-        cpp_knn_batch_omp(<float*> pts_cpp.data, batch_size, npts, dim,
-                <float*> queries_cpp.data, nqueries,
-                K_cpp, <long*> indices_cpp.data)
-    else:
-        cpp_knn_batch(<float*> pts_cpp.data, batch_size, npts, dim,
-                <float*> queries_cpp.data, nqueries,
-                K_cpp, <long*> indices_cpp.data)
+    # set shape values
+    batch_size = pts_cpp.shape[0]
+    npts = pts_cpp.shape[1]
+    dim = pts_cpp.shape[2]
+    nqueries = queries_cpp.shape[1]
+    K_cpp = K
 
-    return indices
+    # create indices tensor
+    indices_cpp = _indices_buffer(out, (pts_cpp.shape[0], queries_cpp.shape[1], K))
+    int32 = indices_cpp.dtype == np.int32
+
+    cdef const float* pts_ptr = <float*> pts_cpp.data
+    cdef const float* queries_ptr = <float*> queries_cpp.data
+    cdef void* indices_ptr = indices_cpp.data
+
+    with nogil:
+        if omp_cpp and int32:
+            cpp_knn_batch_voxel_omp[int](pts_ptr, batch_size, npts, dim, queries_ptr, nqueries, K_cpp,
+                                         <int*> indices_ptr)
+        elif omp_cpp:
+            cpp_knn_batch_voxel_omp[long](pts_ptr, batch_size, npts, dim, queries_ptr, nqueries, K_cpp,
+                                          <long*> indices_ptr)
+        elif int32:
+            cpp_knn_batch_voxel[int](pts_ptr, batch_size, npts, dim, queries_ptr, nqueries, K_cpp,
+                                     <int*> indices_ptr)
+        else:
+            cpp_knn_batch_voxel[long](pts_ptr, batch_size, npts, dim, queries_ptr, nqueries, K_cpp,
+                                      <long*> indices_ptr)
+
+    return indices_cpp
 
 def knn_batch_distance_pick(pts, nqueries, K, omp=False):
 
@@ -147,3 +323,367 @@ def knn_batch_distance_pick(pts, nqueries, K, omp=False):
             K_cpp, <long*> indices_cpp.data)
 
     return indices, queries
+
+def knn_batch_pyramid(pts, level_npts, searches, omp=False, out=None, eps=None):
+    """
+    All the KNN searches of a sub-sampling pyramid in one call, without the GIL. Level l is made of the first
+    level_npts[l] points of each cloud, and the KD-tree of a level is built once and shared by every search using it
+    as support.
+    :param pts: B*N*dim points (not copied if already C-contiguous float32)
+    :param level_npts: number of points of each level, level_npts[0] <= N
+    :param searches: list of (support_level, query_level, K)
+    :param out: optional list of output buffers, one per search, all int32 or all int64
+    :param eps: optional approximation of each search, as in knn (None: all exact)
+    :return: list of B*level_npts[query_level]*K neighbour indices, one per search, int32 unless out is given
+    """
+
+    # define shape parameters
+    cdef size_t batch_size
+    cdef size_t npts
+    cdef size_t dim
+    cdef bint omp_cpp = omp
+    cdef bint int32
+
+    # define tables
+    cdef np.ndarray[np.float32_t, ndim=3] pts_cpp
+    cdef np.ndarray indices_cpp
+    cdef vector[size_t] level_npts_cpp
+    cdef vector[size_t] support_levels_cpp
+    cdef vector[size_t] query_levels_cpp
+    cdef vector[size_t] Ks_cpp
+    cdef vector[float] eps_cpp
+    cdef vector[void*] indices_ptrs
+
+    pts_cpp = np.ascontiguousarray(pts, dtype=np.float32)
+
+    # set shape values
+    batch_size = pts_cpp.shape[0]
+    npts = pts_cpp.shape[1]
+    dim = pts_cpp.shape[2]
+    for n in level_npts:
+        if n < 1 or n > npts:
+            raise ValueError('invalid level size {} for clouds of {} points'.format(n, npts))
+        level_npts_cpp.push_back(n)
+
+    if out is not None and len(out) != len(searches):
+        raise ValueError('out must hold one buffer per search')
+    if eps is not None and len(eps) != len(searches):
+        raise ValueError('eps must hold one value per search')
+    for sid in range(len(searches)):
+        eps_cpp.push_back(0 if eps is None else eps[sid])
+
+    # create indices tensors
+    indices = []
+    for sid, (support_level, query_level, K) in enumerate(searches):
+        if not (0 <= support_level < len(level_npts) and 0 <= query_level < len(level_npts)):
+            raise ValueError('invalid search levels ({}, {})'.format(support_level, query_level))
+        if K > level_npts[support_level]:
+            raise ValueError('K={} is larger than the support level {}'.format(K, support_level))
+        indices_cpp = _indices_buffer(None if out is None else out[sid],
+                                      (pts_cpp.shape[0], level_npts[query_level], K))
+        indices.append(indices_cpp)
+        indices_ptrs.push_back(indices_cpp.data)
+        support_levels_cpp.push_back(support_level)
+        query_levels_cpp.push_back(query_level)
+        Ks_cpp.push_back(K)
+
+    if len(set(idx.dtype for idx in indices)) > 1:
+        raise ValueError('all the output buffers must have the same type')
+    int32 = len(indices) == 0 or indices[0].dtype == np.int32
+
+    cdef const float* pts_ptr = <float*> pts_cpp.data
+
+    with nogil:
+        if omp_cpp and int32:
+            cpp_knn_batch_pyramid_omp[int](pts_ptr, batch_size, npts, dim,
+                level_npts_cpp.data(), level_npts_cpp.size(),
+                support_levels_cpp.data(), query_levels_cpp.data(), Ks_cpp.data(), Ks_cpp.size(),
+                <int**> indices_ptrs.data(), eps_cpp.data())
+        elif omp_cpp:
+            cpp_knn_batch_pyramid_omp[long](pts_ptr, batch_size, npts, dim,
+                level_npts_cpp.data(), level_npts_cpp.size(),
+                support_levels_cpp.data(), query_levels_cpp.data(), Ks_cpp.data(), Ks_cpp.size(),
+                <long**> indices_ptrs.data(), eps_cpp.data())
+        elif int32:
+            cpp_knn_batch_pyramid[int](pts_ptr, batch_size, npts, dim,
+                level_npts_cpp.data(), level_npts_cpp.size(),
+                support_levels_cpp.data(), query_levels_cpp.data(), Ks_cpp.data(), Ks_cpp.size(),
+                <int**> indices_ptrs.data(), eps_cpp.data())
+        else:
+            cpp_knn_batch_pyramid[long](pts_ptr, batch_size, npts, dim,
+                level_npts_cpp.data(), level_npts_cpp.size(),
+                support_levels_cpp.data(), query_levels_cpp.data(), Ks_cpp.data(), Ks_cpp.size(),
+                <long**> indices_ptrs.data(), eps_cpp.data())
+
+    return indices
+
+
+cdef class KDTree:
+    """
+    nanoflann kd-tree built once and queried many times, with the same query interface as sklearn.neighbors.KDTree.
+    The points are kept by reference when they already are a C-contiguous float32 array (e.g. a memory map).
+    Pickling only stores the points and the leaf size, the index is rebuilt when loading. The index can also be saved
+    with save_index and loaded back instead of being built, given the same points.
+    :param data: N*dim points
+    :param leaf_size: maximum number of points in a leaf
+    :param index_file: index saved by save_index for these points, loaded instead of building the tree
+    """
+
+    cdef cpp_kdtree* tree
+    cdef readonly object data
+    cdef readonly int leaf_size
+    cdef float crop_radius_sqr
+
+    def __cinit__(self, data, leaf_size=10, index_file=None):
+        cdef np.ndarray[np.float32_t, ndim=2] data_cpp
+        cdef size_t leaf_size_cpp = leaf_size
+        data_cpp = np.ascontiguousarray(data, dtype=np.float32)
+        if data_cpp.shape[0] == 0:
+            raise ValueError('cannot build a kd-tree on an empty point set')
+        self.data = data_cpp
+        self.crop_radius_sqr = 0
+        if index_file is None:
+            self.tree = new cpp_kdtree(<float*> data_cpp.data, data_cpp.shape[0], data_cpp.shape[1], leaf_size_cpp)
+        else:
+            index_file = os.fsencode(index_file)
+            self.tree = new cpp_kdtree(<float*> data_cpp.data, data_cpp.shape[0], data_cpp.shape[1], <char*> index_file)
+        self.leaf_size = self.tree.leaf_size
+
+    def __dealloc__(self):
+        del self.tree
+
+    def __reduce__(self):
+        return KDTree, (np.asarray(self.data), self.leaf_size)
+
+    def __len__(self):
+        return self.tree.npts
+
+    def save_index(self, index_file):
+        """
+        Write the tree (without the points) to index_file, to be loaded with KDTree(data, index_file=index_file)
+        """
+        index_file = os.fsencode(index_file)
+        self.tree.save(<char*> index_file)
+
+    def _queries(self, X):
+        queries = np.ascontiguousarray(X, dtype=np.float32)
+        if queries.shape[-1] != self.tree.dim:
+            raise ValueError('queries of dimension {} for a tree of dimension {}'.format(queries.shape[-1],
+                                                                                        self.tree.dim))
+        return queries
+
+    def query(self, X, k=1, return_distance=True, omp=False):
+        """
+        K nearest neighbours of a single query (dim,) or of a batch of queries (..., dim)
+        :return: (distances, indices) of shape (..., k), sorted by increasing distance
+        """
+
+        # define tables
+        cdef np.ndarray[np.float32_t, ndim=2] queries_cpp
+        cdef np.ndarray[np.int64_t, ndim=2] indices_cpp
+        cdef np.ndarray[np.float32_t, ndim=2] dists_cpp
+
+        queries = self._queries(X)
+        if k > self.tree.npts:
+            raise ValueError('k={} is larger than the number of points {}'.format(k, self.tree.npts))
+        queries_cpp = queries.reshape(-1, self.tree.dim)
+        indices_cpp = np.zeros((queries_cpp.shape[0], k), dtype=np.int64)
+        dists_cpp = np.zeros((queries_cpp.shape[0], k), dtype=np.float32)
+
+        cdef const float* queries_ptr = <float*> queries_cpp.data
+        cdef size_t nqueries = queries_cpp.shape[0]
+        cdef size_t K = k
+        cdef long* indices_ptr = <long*> indices_cpp.data
+        cdef float* dists_ptr = <float*> dists_cpp.data
+        cdef bint omp_cpp = omp
+        with nogil:
+            self.tree.knn(queries_ptr, nqueries, K, indices_ptr, dists_ptr, omp_cpp)
+
+        out_shape = queries.shape[:-1] + (k,)
+        indices = indices_cpp.reshape(out_shape)
+        if return_distance:
+            return np.sqrt(dists_cpp).reshape(out_shape), indices
+        return indices
+
+    def query_radius(self, X, r, return_distance=False, sort_results=False):
+        """
+        Neighbours within a radius r of a single query (dim,) or of a batch of queries (n, dim)
+        :return: indices (and distances) of each query, as an object array of arrays for a batch of queries
+        """
+
+        # define tables
+        cdef np.ndarray[np.float32_t, ndim=2] queries_cpp
+        cdef vector[pair[size_t, float]] indices_dists
+        cdef np.int64_t[:] indices_view
+        cdef np.float32_t[:] dists_view
+        cdef size_t i
+        cdef size_t j
+        cdef size_t n
+        cdef const float* query_ptr
+        cdef float radius_sqr = r * r
+        cdef bint sorted_cpp = sort_results
+
+        queries = self._queries(X)
+        queries_cpp = queries.reshape(-1, self.tree.dim)
+        all_indices = np.empty(queries_cpp.shape[0], dtype=object)
+        all_dists = np.empty(queries_cpp.shape[0], dtype=object)
+
+        for i in range(queries_cpp.shape[0]):
+            query_ptr = &queries_cpp[i, 0]
+            with nogil:
+                n = self.tree.radius(query_ptr, radius_sqr, indices_dists, sorted_cpp)
+            indices = np.empty(n, dtype=np.int64)
+            dists = np.empty(n, dtype=np.float32)
+            indices_view = indices
+            dists_view = dists
+            for j in range(n):
+                indices_view[j] = indices_dists[j].first
+                dists_view[j] = indices_dists[j].second
+            all_indices[i] = indices
+            all_dists[i] = np.sqrt(dists)
+
+        if queries.ndim == 1:
+            all_indices = all_indices[0]
+            all_dists = all_dists[0]
+        if return_distance:
+            return all_indices, all_dists
+        return all_indices
+
+    def query_crop(self, x, k):
+        """
+        Input region of the k nearest neighbours of a single point, found by a radius search and a partial selection
+        instead of a sorted knn search (the radius is adapted from one crop to the next)
+        :param x: query point, (dim,) or (1, dim)
+        :return: (indices, squared distances) of shape (min(k, N),), in no particular order
+        """
+
+        # define tables
+        cdef np.ndarray[np.float32_t, ndim=1] query_cpp
+        cdef np.ndarray[np.int64_t, ndim=1] indices_cpp
+        cdef np.ndarray[np.float32_t, ndim=1] dists_cpp
+
+        query_cpp = self._queries(x).reshape(-1)
+        if query_cpp.shape[0] != self.tree.dim:
+            raise ValueError('query_crop expects a single query point')
+        K = min(k, self.tree.npts)
+        indices_cpp = np.empty(K, dtype=np.int64)
+        dists_cpp = np.empty(K, dtype=np.float32)
+
+        cdef const float* query_ptr = <float*> query_cpp.data
+        cdef size_t K_cpp = K
+        cdef long* indices_ptr = <long*> indices_cpp.data
+        cdef float* dists_ptr = <float*> dists_cpp.data
+        cdef float radius_sqr = self.crop_radius_sqr
+        with nogil:
+            self.tree.crop(query_ptr, K_cpp, indices_ptr, dists_ptr, radius_sqr)
+        self.crop_radius_sqr = radius_sqr
+        return indices_cpp, dists_cpp
+
+
+cdef class VoxelGrid:
+    """
+    Voxel grid of a 3d cloud of bounded density (e.g. grid sub-sampled), built once and queried many times, with the
+    same query and query_crop interface as KDTree. The searches are exact. The points are kept by reference when
+    they already are a C-contiguous float32 array (e.g. a memory map).
+    :param data: N*3 points
+    """
+
+    cdef cpp_voxel_grid* grid
+    cdef readonly object data
+    cdef float crop_radius_sqr
+
+    def __cinit__(self, data):
+        cdef np.ndarray[np.float32_t, ndim=2] data_cpp
+        data_cpp = np.ascontiguousarray(data, dtype=np.float32)
+        if data_cpp.shape[0] == 0 or data_cpp.shape[1] != 3:
+            raise ValueError('voxel grids are built on a non-empty set of 3d points')
+        self.data = data_cpp
+        self.crop_radius_sqr = 0
+        self.grid = new cpp_voxel_grid(<float*> data_cpp.data, data_cpp.shape[0], data_cpp.shape[1])
+
+    def __dealloc__(self):
+        del self.grid
+
+    def __reduce__(self):
+        return VoxelGrid, (np.asarray(self.data),)
+
+    def __len__(self):
+        return self.grid.npts
+
+    @property
+    def voxel_size(self):
+        return self.grid.voxel_size
+
+    @property
+    def nbytes(self):
+        # memory of the grid, without the points
+        return self.grid.nbytes()
+
+    def _queries(self, X):
+        queries = np.ascontiguousarray(X, dtype=np.float32)
+        if queries.shape[-1] != 3:
+            raise ValueError('queries of dimension {} for a 3d voxel grid'.format(queries.shape[-1]))
+        return queries
+
+    def query(self, X, k=1, return_distance=True, omp=False):
+        """
+        K nearest neighbours of a single query (3,) or of a batch of queries (..., 3)
+        :return: (distances, indices) of shape (..., k), sorted by increasing distance
+        """
+
+        # define tables
+        cdef np.ndarray[np.float32_t, ndim=2] queries_cpp
+        cdef np.ndarray[np.int64_t, ndim=2] indices_cpp
+        cdef np.ndarray[np.float32_t, ndim=2] dists_cpp
+
+        queries = self._queries(X)
+        if k > self.grid.npts:
+            raise ValueError('k={} is larger than the number of points {}'.format(k, self.grid.npts))
+        queries_cpp = queries.reshape(-1, 3)
+        indices_cpp = np.zeros((queries_cpp.shape[0], k), dtype=np.int64)
+        dists_cpp = np.zeros((queries_cpp.shape[0], k), dtype=np.float32)
+
+        cdef const float* queries_ptr = <float*> queries_cpp.data
+        cdef size_t nqueries = queries_cpp.shape[0]
+        cdef size_t K = k
+        cdef long* indices_ptr = <long*> indices_cpp.data
+        cdef float* dists_ptr = <float*> dists_cpp.data
+        cdef bint omp_cpp = omp
+        with nogil:
+            self.grid.knn(queries_ptr, nqueries, K, indices_ptr, dists_ptr, omp_cpp)
+
+        out_shape = queries.shape[:-1] + (k,)
+        indices = indices_cpp.reshape(out_shape)
+        if return_distance:
+            return np.sqrt(dists_cpp).reshape(out_shape), indices
+        return indices
+
+    def query_crop(self, x, k):
+        """
+        Input region of the k nearest neighbours of a single point, found by a search in the voxels of a ball and a
+        partial selection (the radius of the ball is adapted from one crop to the next)
+        :param x: query point, (3,) or (1, 3)
+        :return: (indices, squared distances) of shape (min(k, N),), in no particular order
+        """
+
+        # define tables
+        cdef np.ndarray[np.float32_t, ndim=1] query_cpp
+        cdef np.ndarray[np.int64_t, ndim=1] indices_cpp
+        cdef np.ndarray[np.float32_t, ndim=1] dists_cpp
+
+        query_cpp = self._queries(x).reshape(-1)
+        if query_cpp.shape[0] != 3:
+            raise ValueError('query_crop expects a single query point')
+        K = min(k, self.grid.npts)
+        indices_cpp = np.empty(K, dtype=np.int64)
+        dists_cpp = np.empty(K, dtype=np.float32)
+
+        cdef const float* query_ptr = <float*> query_cpp.data
+        cdef size_t K_cpp = K
+        cdef long* indices_ptr = <long*> indices_cpp.data
+        cdef float* dists_ptr = <float*> dists_cpp.data
+        cdef float radius_sqr = self.crop_radius_sqr
+        with nogil:
+            self.grid.crop(query_ptr, K_cpp, indices_ptr, dists_ptr, radius_sqr)
+        self.crop_radius_sqr = radius_sqr
+        return indices_cpp, dists_cpp
@@ -14,124 +14,207 @@ using namespace nanoflann;
 #include <random>
 #include <algorithm>
 #include <iterator>
+#include <memory>
+#include <limits>
+#include <cmath>
+#include <cstdio>
+#include <ios>
+#include <stdexcept>
+#include <string>
+#include <functional>
 
 using namespace std;
 
+typedef KDTreeTableAdaptor< float, float> KDTree;
 
+// queries of a unit of work of the parallel searches
+static const size_t QUERY_BLOCK = 256;
+// distances compared at once in the brute force top-k selection
+static const size_t SELECT_CHUNK = 16;
 
-void cpp_knn(const float* points, const size_t npts, const size_t dim,
-			const float* queries, const size_t nqueries,
-			const size_t K, long* indices){
+// cap of the omp threads (0: omp default)
+static int knn_max_threads = 0;
 
-	// create the kdtree
-	typedef KDTreeTableAdaptor< float, float> KDTree;
-	KDTree mat_index(npts, dim, points, 10);
-	mat_index.index->buildIndex();
+void cpp_knn_set_num_threads(const int num_threads){
+	knn_max_threads = num_threads;
+}
 
-	std::vector<float> out_dists_sqr(K);
-	std::vector<size_t> out_ids(K);
+int cpp_knn_num_threads(){
+	return knn_max_threads > 0 ? knn_max_threads : omp_get_max_threads();
+}
 
-	// iterate over the points
-	for(size_t i=0; i<nqueries; i++){
+// support sets up to this number of points are searched by brute force instead of a kd-tree
+static size_t knn_brute_force_npts = 128;
 
-		nanoflann::KNNResultSet<float> resultSet(K);
-		resultSet.init(&out_ids[0], &out_dists_sqr[0] );
-		mat_index.index->findNeighbors(resultSet, &queries[i*dim], nanoflann::SearchParams(10));
-		for(size_t j=0; j<K; j++){
-			indices[i*K+j] = long(out_ids[j]);
-		}
-	}
+void cpp_knn_set_brute_force_npts(const size_t npts){
+	knn_brute_force_npts = npts;
 }
 
-void cpp_knn_omp(const float* points, const size_t npts, const size_t dim,
-			const float* queries, const size_t nqueries,
-			const size_t K, long* indices){
+size_t cpp_knn_brute_force_npts(){
+	return knn_brute_force_npts;
+}
 
-	// create the kdtree
-	typedef KDTreeTableAdaptor< float, float> KDTree;
-	KDTree mat_index(npts, dim, points, 10);
-	mat_index.index->buildIndex();
+// support points of the knn searches: a kd-tree, or a brute force search when there are few points (the deep levels
+// of the pyramid), cheaper than building and descending a tree
+class knn_support{
+public:
+	knn_support(const float* points, const size_t npts, const size_t dim) : npts(npts), dim(dim){
+		if(npts > knn_brute_force_npts){
+			tree.reset(new KDTree(npts, dim, points, 10));
+			return;
+		}
+		// one array per dimension, so the distances to all the points are computed by contiguous simd loops
+		coords.resize(npts * dim);
+		for(size_t i=0; i<npts; i++){
+			for(size_t d=0; d<dim; d++){
+				coords[d*npts+i] = points[i*dim+d];
+			}
+		}
+	}
 
+	// knn of the queries [start, end), sorted by increasing distance, eps-approximate in the kd-tree
+	template <typename index_t>
+	void search(const float* queries, const size_t start, const size_t end, const size_t K, index_t* indices,
+			const float eps) const{
 
-	// iterate over the points
-# pragma omp parallel for
-	for(size_t i=0; i<nqueries; i++){
-		std::vector<size_t> out_ids(K);
 		std::vector<float> out_dists_sqr(K);
+		std::vector<size_t> out_ids(K);
+		std::vector<float> dists(tree ? 0 : npts);
 
-		nanoflann::KNNResultSet<float> resultSet(K);
-		resultSet.init(&out_ids[0], &out_dists_sqr[0] );
-		mat_index.index->findNeighbors(resultSet, &queries[i*dim], nanoflann::SearchParams(10));
-		for(size_t j=0; j<K; j++){
-			indices[i*K+j] = long(out_ids[j]);
+		for(size_t i=start; i<end; i++){
+			if(tree){
+				nanoflann::KNNResultSet<float> resultSet(K);
+				resultSet.init(&out_ids[0], &out_dists_sqr[0] );
+				tree->index->findNeighbors(resultSet, &queries[i*dim], nanoflann::SearchParams(10, eps));
+			}
+			else{
+				brute_force(&queries[i*dim], K, &dists[0], &out_ids[0], &out_dists_sqr[0]);
+			}
+			for(size_t j=0; j<K; j++){
+				indices[i*K+j] = index_t(out_ids[j]);
+			}
 		}
 	}
-}
 
+private:
+	void brute_force(const float* query, const size_t K, float* dists, size_t* out_ids, float* out_dists_sqr) const{
+
+		// squared distances to all the points (the row of a small support set stays in the L1 cache)
+		std::fill(dists, dists + npts, 0.f);
+		for(size_t d=0; d<dim; d++){
+			const float* coord = &coords[d*npts];
+			const float q = query[d];
+# pragma omp simd
+			for(size_t j=0; j<npts; j++){
+				const float diff = coord[j] - q;
+				dists[j] += diff * diff;
+			}
+		}
 
-void cpp_knn_batch(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
-			const float* queries, const size_t nqueries,
-			const size_t K, long* batch_indices){
+		// sorted insertion of the K nearest, the chunks without any point closer than the current K-th are skipped
+		size_t count = 0;
+		float worst = std::numeric_limits<float>::max();
+		for(size_t chunk=0; chunk<npts; chunk+=SELECT_CHUNK){
+			const size_t chunk_end = std::min(npts, chunk + SELECT_CHUNK);
+			float chunk_min = std::numeric_limits<float>::max();
+# pragma omp simd reduction(min:chunk_min)
+			for(size_t j=chunk; j<chunk_end; j++){
+				chunk_min = std::min(chunk_min, dists[j]);
+			}
+			if(chunk_min >= worst){
+				continue;
+			}
+			for(size_t j=chunk; j<chunk_end; j++){
+				const float dist = dists[j];
+				if(dist >= worst){
+					continue;
+				}
+				size_t pos = count < K ? count++ : K - 1;
+				for(; pos > 0 && out_dists_sqr[pos-1] > dist; pos--){
+					out_dists_sqr[pos] = out_dists_sqr[pos-1];
+					out_ids[pos] = out_ids[pos-1];
+				}
+				out_dists_sqr[pos] = dist;
+				out_ids[pos] = j;
+				if(count == K){
+					worst = out_dists_sqr[K-1];
+				}
+			}
+		}
+	}
 
-	for(size_t bid=0; bid < batch_size; bid++){
+	size_t npts;
+	size_t dim;
+	std::unique_ptr<KDTree> tree;
+	std::vector<float> coords;
+};
 
-		const float* points = &batch_data[bid*npts*dim];
-		long* indices = &batch_indices[bid*nqueries*K];
 
-		// create the kdtree
-		typedef KDTreeTableAdaptor< float, float> KDTree;
-		KDTree mat_index(npts, dim, points, 10);
+template <typename index_t>
+void cpp_knn(const float* points, const size_t npts, const size_t dim,
+			const float* queries, const size_t nqueries,
+			const size_t K, index_t* indices, const float eps){
 
-		mat_index.index->buildIndex();
+	// create the kdtree (or brute force support)
+	knn_support support(points, npts, dim);
+	support.search(queries, 0, nqueries, K, indices, eps);
+}
 
-		std::vector<float> out_dists_sqr(K);
-		std::vector<size_t> out_ids(K);
+template <typename index_t>
+void cpp_knn_omp(const float* points, const size_t npts, const size_t dim,
+			const float* queries, const size_t nqueries,
+			const size_t K, index_t* indices, const float eps){
 
-		// iterate over the points
-		for(size_t i=0; i<nqueries; i++){
-			nanoflann::KNNResultSet<float> resultSet(K);
-			resultSet.init(&out_ids[0], &out_dists_sqr[0] );
-			mat_index.index->findNeighbors(resultSet, &queries[bid*nqueries*dim + i*dim], nanoflann::SearchParams(10));
-			for(size_t j=0; j<K; j++){
-				indices[i*K+j] = long(out_ids[j]);
-			}
-		}
+	// create the kdtree (or brute force support)
+	knn_support support(points, npts, dim);
 
+	// iterate over blocks of points
+	const size_t nblocks = (nqueries + QUERY_BLOCK - 1) / QUERY_BLOCK;
+# pragma omp parallel for schedule(dynamic) num_threads(cpp_knn_num_threads())
+	for(size_t block=0; block<nblocks; block++){
+		support.search(queries, block * QUERY_BLOCK, std::min(nqueries, (block + 1) * QUERY_BLOCK), K, indices, eps);
 	}
-
 }
 
-void cpp_knn_batch_omp(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
-				const float* queries, const size_t nqueries,
-				const size_t K, long* batch_indices){
 
-# pragma omp parallel for
-	for(size_t bid=0; bid < batch_size; bid++){
+template <typename index_t>
+void cpp_knn_batch(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+			const float* queries, const size_t nqueries,
+			const size_t K, index_t* batch_indices, const float eps){
 
-		const float* points = &batch_data[bid*npts*dim];
-		long* indices = &batch_indices[bid*nqueries*K];
+	for(size_t bid=0; bid < batch_size; bid++){
 
-		// create the kdtree
-		typedef KDTreeTableAdaptor< float, float> KDTree;
-		KDTree mat_index(npts, dim, points, 10);
+		// create the kdtree (or brute force support)
+		knn_support support(&batch_data[bid*npts*dim], npts, dim);
+		support.search(&queries[bid*nqueries*dim], 0, nqueries, K, &batch_indices[bid*nqueries*K], eps);
+	}
 
-		mat_index.index->buildIndex();
+}
 
-		std::vector<float> out_dists_sqr(K);
-		std::vector<size_t> out_ids(K);
+template <typename index_t>
+void cpp_knn_batch_omp(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+				const float* queries, const size_t nqueries,
+				const size_t K, index_t* batch_indices, const float eps){
 
-		// iterate over the points
-		for(size_t i=0; i<nqueries; i++){
-			nanoflann::KNNResultSet<float> resultSet(K);
-			resultSet.init(&out_ids[0], &out_dists_sqr[0] );
-			mat_index.index->findNeighbors(resultSet, &queries[bid*nqueries*dim + i*dim], nanoflann::SearchParams(10));
-			for(size_t j=0; j<K; j++){
-				indices[i*K+j] = long(out_ids[j]);
-			}
-		}
+	const int num_threads = cpp_knn_num_threads();
 
+	// build the trees of all the batch elements in parallel
+	std::vector<std::unique_ptr<knn_support> > trees(batch_size);
+# pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+	for(size_t bid=0; bid < batch_size; bid++){
+		trees[bid].reset(new knn_support(&batch_data[bid*npts*dim], npts, dim));
 	}
 
+	// then every (batch element, block of queries) pair is a unit of work, so all the threads are busy even
+	// when the batch is smaller than the number of threads
+	const size_t nblocks = (nqueries + QUERY_BLOCK - 1) / QUERY_BLOCK;
+# pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+	for(size_t unit=0; unit < batch_size * nblocks; unit++){
+		const size_t bid = unit / nblocks;
+		const size_t start = (unit % nblocks) * QUERY_BLOCK;
+		trees[bid]->search(&queries[bid*nqueries*dim], start, std::min(nqueries, start + QUERY_BLOCK), K,
+			&batch_indices[bid*nqueries*K], eps);
+	}
 }
 
 
@@ -149,9 +232,7 @@ void cpp_knn_batch_distance_pick(const float* batch_data, const size_t batch_siz
 		// float* queries = &batch_queries[bid*nqueries*dim];
 
 		// create the kdtree
-		typedef KDTreeTableAdaptor< float, float> KDTree;
 		KDTree tree(npts, dim, points, 10);
-		tree.index->buildIndex();
 
 		vector<int> used(npts, 0);
 		int current_id = 0;
@@ -209,7 +290,7 @@ void cpp_knn_batch_distance_pick_omp(const float* batch_data, const size_t batch
 
 	mt19937 mt_rand(time(0));
 
-	#pragma omp parallel for
+	#pragma omp parallel for num_threads(cpp_knn_num_threads())
 	for(size_t bid=0; bid < batch_size; bid++){
 
 		const float* points = &batch_data[bid*npts*dim];
@@ -217,9 +298,7 @@ void cpp_knn_batch_distance_pick_omp(const float* batch_data, const size_t batch
 		// float* queries = &batch_queries[bid*nqueries*dim];
 
 		// create the kdtree
-		typedef KDTreeTableAdaptor< float, float> KDTree;
 		KDTree tree(npts, dim, points, 10);
-		tree.index->buildIndex();
 
 		vector<int> used(npts, 0);
 		int current_id = 0;
@@ -269,3 +348,607 @@ void cpp_knn_batch_distance_pick_omp(const float* batch_data, const size_t batch
 	}
 
 }
+
+
+template <typename index_t>
+static void cpp_knn_pyramid_single(const float* points, const size_t dim,
+				const size_t* level_npts, const size_t nlevels,
+				const size_t* support_levels, const size_t* query_levels, const size_t* Ks, const size_t nsearches,
+				index_t** batch_indices, const float* eps, const size_t bid)
+{
+	// every level is a prefix of the input cloud, so one tree per level can serve all the searches on it
+	std::vector<std::unique_ptr<knn_support> > trees(nlevels);
+
+	for(size_t sid=0; sid < nsearches; sid++){
+
+		const size_t support_level = support_levels[sid];
+		const size_t nqueries = level_npts[query_levels[sid]];
+		const size_t K = Ks[sid];
+		index_t* indices = &batch_indices[sid][bid*nqueries*K];
+
+		// create the kdtree of the support level only once (the constructor builds the index)
+		if(!trees[support_level]){
+			trees[support_level].reset(new knn_support(points, level_npts[support_level], dim));
+		}
+		trees[support_level]->search(points, 0, nqueries, K, indices, eps ? eps[sid] : 0.f);
+	}
+}
+
+template <typename index_t>
+void cpp_knn_batch_pyramid(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+				const size_t* level_npts, const size_t nlevels,
+				const size_t* support_levels, const size_t* query_levels, const size_t* Ks, const size_t nsearches,
+				index_t** batch_indices, const float* eps){
+
+	for(size_t bid=0; bid < batch_size; bid++){
+		cpp_knn_pyramid_single<index_t>(&batch_data[bid*npts*dim], dim, level_npts, nlevels,
+			support_levels, query_levels, Ks, nsearches, batch_indices, eps, bid);
+	}
+
+}
+
+template <typename index_t>
+void cpp_knn_batch_pyramid_parallel(const float* batch_data, const size_t batch_size, const size_t npts,
+				const size_t dim, const size_t* level_npts, const size_t nlevels,
+				const size_t* support_levels, const size_t* query_levels, const size_t* Ks, const size_t nsearches,
+				index_t** batch_indices, const float* eps, const knn_parallel_for& parallel_for){
+
+	// trees of the support levels of all the batch elements, built in parallel (largest levels first)
+	std::vector<bool> is_support(nlevels, false);
+	for(size_t sid=0; sid < nsearches; sid++){
+		is_support[support_levels[sid]] = true;
+	}
+	std::vector<size_t> tree_units;
+	double tree_cost = 0;
+	for(size_t level=0; level < nlevels; level++){
+		for(size_t bid=0; bid < batch_size && is_support[level]; bid++){
+			tree_units.push_back(bid * nlevels + level);
+			tree_cost += 50. * level_npts[level];
+		}
+	}
+	std::vector<std::unique_ptr<knn_support> > trees(batch_size * nlevels);
+	parallel_for(tree_units.size(), tree_cost / std::max(size_t(1), tree_units.size()),
+		[&](size_t first, size_t last){
+			for(size_t unit=first; unit < last; unit++){
+				const size_t bid = tree_units[unit] / nlevels;
+				const size_t level = tree_units[unit] % nlevels;
+				trees[tree_units[unit]].reset(new knn_support(&batch_data[bid*npts*dim], level_npts[level], dim));
+			}
+		});
+
+	// then every (search, batch element, block of queries) triple is a unit of work
+	struct query_unit{
+		size_t sid;
+		size_t bid;
+		size_t start;
+	};
+	std::vector<query_unit> query_units;
+	double query_cost = 0;
+	for(size_t sid=0; sid < nsearches; sid++){
+		const size_t nqueries = level_npts[query_levels[sid]];
+		for(size_t bid=0; bid < batch_size; bid++){
+			for(size_t start=0; start < nqueries; start += QUERY_BLOCK){
+				query_units.push_back(query_unit{sid, bid, start});
+				query_cost += 200. * Ks[sid] * (std::min(nqueries, start + QUERY_BLOCK) - start);
+			}
+		}
+	}
+	parallel_for(query_units.size(), query_cost / std::max(size_t(1), query_units.size()),
+		[&](size_t first, size_t last){
+			for(size_t unit=first; unit < last; unit++){
+				const query_unit& u = query_units[unit];
+				const size_t nqueries = level_npts[query_levels[u.sid]];
+				const size_t K = Ks[u.sid];
+				trees[u.bid * nlevels + support_levels[u.sid]]->search(&batch_data[u.bid*npts*dim],
+					u.start, std::min(nqueries, u.start + QUERY_BLOCK), K, &batch_indices[u.sid][u.bid*nqueries*K],
+					eps ? eps[u.sid] : 0.f);
+			}
+		});
+}
+
+template <typename index_t>
+void cpp_knn_batch_pyramid_omp(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+				const size_t* level_npts, const size_t nlevels,
+				const size_t* support_levels, const size_t* query_levels, const size_t* Ks, const size_t nsearches,
+				index_t** batch_indices, const float* eps){
+
+	const int num_threads = cpp_knn_num_threads();
+	cpp_knn_batch_pyramid_parallel<index_t>(batch_data, batch_size, npts, dim, level_npts, nlevels,
+		support_levels, query_levels, Ks, nsearches, batch_indices, eps,
+		[num_threads](size_t nunits, double, const std::function<void(size_t, size_t)>& work){
+# pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+			for(size_t unit=0; unit < nunits; unit++){
+				work(unit, unit + 1);
+			}
+		});
+}
+
+
+// target mean number of points in the non-empty voxels of a grid
+static const double VOXEL_POINTS = 3.0;
+
+cpp_voxel_grid::cpp_voxel_grid(const float* points, const size_t npts, const size_t dim)
+	: npts(npts), dim(dim), points(points){
+
+	if(dim != 3){
+		throw std::invalid_argument("voxel grids are only defined for 3d points");
+	}
+	if(npts == 0 || npts >= size_t(std::numeric_limits<unsigned int>::max())){
+		throw std::invalid_argument("invalid number of points for a voxel grid");
+	}
+
+	// bounding box of a sample of the points without its extreme quantiles, so that a few outliers do not blow up
+	// the voxels (the points outside of the box go to the voxels of its border, the searches stay exact)
+	const size_t stride = std::max(size_t(1), npts / 4096);
+	const size_t nsamples = (npts + stride - 1) / stride;
+	const size_t low_rank = nsamples / 1000;
+	std::vector<float> sample(nsamples);
+	double extent[3];
+	double max_extent = 0;
+	for(size_t d=0; d<3; d++){
+		for(size_t i=0; i<nsamples; i++){
+			sample[i] = points[i*stride*3+d];
+		}
+		std::nth_element(sample.begin(), sample.begin() + low_rank, sample.end());
+		const float low = sample[low_rank];
+		std::nth_element(sample.begin(), sample.end() - 1 - low_rank, sample.end());
+		const float high = sample[nsamples - 1 - low_rank];
+		origin[d] = low;
+		extent[d] = double(high) - double(low);
+		max_extent = std::max(max_extent, extent[d]);
+	}
+
+	// first guess: about one point per voxel of the bounding box (flat boxes are padded)
+	voxel_size = max_extent > 0 ? max_extent : 1.0;
+	if(max_extent > 0){
+		double volume = 1;
+		for(size_t d=0; d<3; d++){
+			volume *= std::max(extent[d], max_extent * 1e-3);
+		}
+		voxel_size = std::cbrt(volume / npts);
+	}
+	// grow the voxels until the grid has at most max_voxels
+	auto fit_grid = [&](const size_t max_voxels) -> size_t{
+		for(;;){
+			size_t nvoxels = 1;
+			for(size_t d=0; d<3; d++){
+				shape[d] = long(extent[d] / voxel_size) + 1;
+				nvoxels *= size_t(shape[d]);
+			}
+			if(nvoxels <= max_voxels){
+				return nvoxels;
+			}
+			voxel_size *= 1.25;
+		}
+	};
+	size_t nvoxels = fit_grid(npts);
+
+	// the scans are surfaces, most voxels of the box are empty: scale the voxels from the occupancy of the guess
+	std::vector<char> occupied(nvoxels, 0);
+	size_t noccupied = 0;
+	long voxel[3];
+	for(size_t i=0; i<npts; i++){
+		query_voxel(&points[i*3], voxel);
+		char& o = occupied[(voxel[0] * shape[1] + voxel[1]) * shape[2] + voxel[2]];
+		noccupied += o == 0;
+		o = 1;
+	}
+	std::vector<char>().swap(occupied);
+	voxel_size *= std::sqrt(VOXEL_POINTS * noccupied / npts);
+	nvoxels = fit_grid(4 * npts);
+
+	// counting sort of the points by voxel
+	std::vector<unsigned int> voxel_ids(npts);
+	voxel_start.assign(nvoxels + 1, 0);
+	for(size_t i=0; i<npts; i++){
+		query_voxel(&points[i*3], voxel);
+		voxel_ids[i] = (unsigned int)((voxel[0] * shape[1] + voxel[1]) * shape[2] + voxel[2]);
+		voxel_start[voxel_ids[i] + 1]++;
+	}
+	for(size_t v=0; v<nvoxels; v++){
+		voxel_start[v + 1] += voxel_start[v];
+	}
+	point_ids.resize(npts);
+	std::vector<unsigned int> next(voxel_start.begin(), voxel_start.end() - 1);
+	for(size_t i=0; i<npts; i++){
+		point_ids[next[voxel_ids[i]]++] = (unsigned int)i;
+	}
+}
+
+size_t cpp_voxel_grid::nbytes() const{
+	return (voxel_start.size() + point_ids.size()) * sizeof(unsigned int);
+}
+
+void cpp_voxel_grid::query_voxel(const float* query, long* voxel) const{
+	for(size_t d=0; d<3; d++){
+		voxel[d] = voxel_index(query[d], d);
+	}
+}
+
+long cpp_voxel_grid::voxel_index(const double coord, const size_t d) const{
+	// index of a coordinate along the axis d, clamped to the grid (for the points outside of the bounding box and
+	// the queries outside of the grid)
+	const double v = std::floor((coord - origin[d]) / voxel_size);
+	return v < 0 ? 0 : (v >= shape[d] ? shape[d] - 1 : long(v));
+}
+
+template <typename F>
+void cpp_voxel_grid::for_ring(const long* center, const long r, F visit) const{
+	// the voxels of the grid at chebyshev distance r from the center voxel
+	for(long x=std::max(0L, center[0]-r); x<=std::min(shape[0]-1, center[0]+r); x++){
+		for(long y=std::max(0L, center[1]-r); y<=std::min(shape[1]-1, center[1]+r); y++){
+			const bool inner = std::abs(x - center[0]) < r && std::abs(y - center[1]) < r;
+			const long step = inner ? 2 * r : 1;
+			for(long z=center[2]-r; z<=center[2]+r; z+=step){
+				if(z >= 0 && z < shape[2]){
+					const size_t v = size_t((x * shape[1] + y) * shape[2] + z);
+					visit(voxel_start[v], voxel_start[v + 1]);
+				}
+			}
+		}
+	}
+}
+
+double cpp_voxel_grid::unvisited_distance(const float* query, const long* center, const long r) const{
+	// distance from the query to the voxels farther than r from the center voxel (infinite when there are none)
+	double dist = std::numeric_limits<double>::infinity();
+	for(size_t d=0; d<3; d++){
+		if(center[d] - r > 0){
+			dist = std::min(dist, std::max(0.0, double(query[d]) - (origin[d] + (center[d] - r) * voxel_size)));
+		}
+		if(center[d] + r < shape[d] - 1){
+			dist = std::min(dist, std::max(0.0, origin[d] + (center[d] + r + 1) * voxel_size - double(query[d])));
+		}
+	}
+	return dist;
+}
+
+template <typename index_t>
+void cpp_voxel_grid::search(const float* queries, const size_t start, const size_t end, const size_t K,
+			index_t* indices, float* dists_sqr) const{
+
+	std::vector<float> out_dists_sqr(K);
+	std::vector<size_t> out_ids(K);
+	long center[3];
+
+	for(size_t i=start; i<end; i++){
+		const float* query = &queries[i*3];
+		query_voxel(query, center);
+
+		// rings of voxels around the query, until the K-th nearest is closer than the voxels not visited yet
+		size_t count = 0;
+		float worst = std::numeric_limits<float>::max();
+		for(long r=0; ; r++){
+			for_ring(center, r, [&](const unsigned int first, const unsigned int last){
+				for(unsigned int p=first; p<last; p++){
+					const size_t id = point_ids[p];
+					float dist = 0;
+					for(size_t d=0; d<3; d++){
+						const float diff = points[id*3+d] - query[d];
+						dist += diff * diff;
+					}
+					if(dist >= worst){
+						continue;
+					}
+					size_t pos = count < K ? count++ : K - 1;
+					for(; pos > 0 && out_dists_sqr[pos-1] > dist; pos--){
+						out_dists_sqr[pos] = out_dists_sqr[pos-1];
+						out_ids[pos] = out_ids[pos-1];
+					}
+					out_dists_sqr[pos] = dist;
+					out_ids[pos] = id;
+					if(count == K){
+						worst = out_dists_sqr[K-1];
+					}
+				}
+			});
+			// (the margin covers the rounding of the float distances)
+			const double bound = unvisited_distance(query, center, r);
+			if(std::isinf(bound) || (count == K && worst <= bound * bound * (1 - 1e-5))){
+				break;
+			}
+		}
+
+		for(size_t j=0; j<K; j++){
+			indices[i*K+j] = index_t(out_ids[j]);
+			if(dists_sqr){
+				dists_sqr[i*K+j] = out_dists_sqr[j];
+			}
+		}
+	}
+}
+
+void cpp_voxel_grid::knn(const float* queries, const size_t nqueries, const size_t K,
+			long* indices, float* dists_sqr, const bool omp) const{
+
+	const size_t nblocks = (nqueries + QUERY_BLOCK - 1) / QUERY_BLOCK;
+# pragma omp parallel for schedule(dynamic) if(omp) num_threads(cpp_knn_num_threads())
+	for(size_t block=0; block<nblocks; block++){
+		search(queries, block * QUERY_BLOCK, std::min(nqueries, (block + 1) * QUERY_BLOCK), K, indices, dists_sqr);
+	}
+}
+
+void cpp_voxel_grid::crop(const float* query, const size_t K, long* indices, float* dists_sqr, float& radius_sqr) const{
+
+	std::vector<std::pair<size_t, float> > indices_dists;
+	auto gather = [&](const unsigned int first, const unsigned int last, const float max_dist_sqr){
+		for(unsigned int p=first; p<last; p++){
+			const size_t id = point_ids[p];
+			float dist = 0;
+			for(size_t d=0; d<3; d++){
+				const float diff = points[id*3+d] - query[d];
+				dist += diff * diff;
+			}
+			if(dist <= max_dist_sqr){
+				indices_dists.push_back(std::make_pair(id, dist));
+			}
+		}
+	};
+
+	if(K >= npts){
+		// the whole cloud
+		gather(0, (unsigned int)npts, std::numeric_limits<float>::infinity());
+		for(size_t j=0; j<npts; j++){
+			indices[j] = long(indices_dists[j].first);
+			dists_sqr[j] = indices_dists[j].second;
+		}
+		return;
+	}
+
+	if(!(radius_sqr > 0)){
+		// first guess: the smallest box of voxels around the query holding K points
+		long center[3];
+		query_voxel(query, center);
+		size_t count = 0;
+		long r = 0;
+		for(; count < K; r++){
+			for_ring(center, r, [&](const unsigned int first, const unsigned int last){ count += last - first; });
+		}
+		radius_sqr = float((r - 0.5) * (r - 0.5) * voxel_size * voxel_size);
+	}
+
+	// the points of the voxels intersecting the ball, growing the radius until it holds K points
+	for(;;){
+		const double radius = std::sqrt(double(radius_sqr)) * (1 + 1e-5);
+		long low[3], high[3];
+		for(size_t d=0; d<3; d++){
+			low[d] = voxel_index(query[d] - radius, d);
+			high[d] = voxel_index(query[d] + radius, d);
+		}
+		indices_dists.clear();
+		for(long x=low[0]; x<=high[0]; x++){
+			for(long y=low[1]; y<=high[1]; y++){
+				const size_t v = size_t((x * shape[1] + y) * shape[2]);
+				gather(voxel_start[v + low[2]], voxel_start[v + high[2] + 1], radius_sqr);
+			}
+		}
+		const size_t n = indices_dists.size();
+		if(n >= K){
+			break;
+		}
+		const double growth = n > 0 ? pow(1.2 * K / n, 2.0 / 3) : 4.0;
+		radius_sqr = float(radius_sqr * growth);
+	}
+
+	// partial selection of the K nearest, left unsorted
+	std::nth_element(indices_dists.begin(), indices_dists.begin() + (K - 1), indices_dists.end(),
+		nanoflann::IndexDist_Sorter());
+	for(size_t j=0; j<K; j++){
+		indices[j] = long(indices_dists[j].first);
+		dists_sqr[j] = indices_dists[j].second;
+	}
+
+	// radius for the next crop, a bit larger than the one of this crop
+	radius_sqr = float(indices_dists[K - 1].second * pow(1.1, 2.0 / 3));
+}
+
+
+template <typename index_t>
+void cpp_knn_batch_voxel(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+			const float* queries, const size_t nqueries,
+			const size_t K, index_t* batch_indices){
+
+	for(size_t bid=0; bid < batch_size; bid++){
+		cpp_voxel_grid grid(&batch_data[bid*npts*dim], npts, dim);
+		grid.search(&queries[bid*nqueries*dim], 0, nqueries, K, &batch_indices[bid*nqueries*K], (float*) NULL);
+	}
+}
+
+template <typename index_t>
+void cpp_knn_batch_voxel_omp(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+				const float* queries, const size_t nqueries,
+				const size_t K, index_t* batch_indices){
+
+	const int num_threads = cpp_knn_num_threads();
+
+	// build the grids of all the batch elements in parallel
+	std::vector<std::unique_ptr<cpp_voxel_grid> > grids(batch_size);
+# pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+	for(size_t bid=0; bid < batch_size; bid++){
+		grids[bid].reset(new cpp_voxel_grid(&batch_data[bid*npts*dim], npts, dim));
+	}
+
+	// then the (batch element, block of queries) units of work, as in cpp_knn_batch_omp
+	const size_t nblocks = (nqueries + QUERY_BLOCK - 1) / QUERY_BLOCK;
+# pragma omp parallel for schedule(dynamic) num_threads(num_threads)
+	for(size_t unit=0; unit < batch_size * nblocks; unit++){
+		const size_t bid = unit / nblocks;
+		const size_t start = (unit % nblocks) * QUERY_BLOCK;
+		grids[bid]->search(&queries[bid*nqueries*dim], start, std::min(nqueries, start + QUERY_BLOCK), K,
+			&batch_indices[bid*nqueries*K], (float*) NULL);
+	}
+}
+
+
+// explicit instantiations for int32 and int64 indices
+#define INSTANTIATE_KNN(index_t) \
+	template void cpp_knn<index_t>(const float*, const size_t, const size_t, const float*, const size_t, \
+			const size_t, index_t*, const float); \
+	template void cpp_knn_omp<index_t>(const float*, const size_t, const size_t, const float*, const size_t, \
+			const size_t, index_t*, const float); \
+	template void cpp_knn_batch<index_t>(const float*, const size_t, const size_t, const size_t, \
+			const float*, const size_t, const size_t, index_t*, const float); \
+	template void cpp_knn_batch_omp<index_t>(const float*, const size_t, const size_t, const size_t, \
+			const float*, const size_t, const size_t, index_t*, const float); \
+	template void cpp_knn_batch_pyramid<index_t>(const float*, const size_t, const size_t, const size_t, \
+			const size_t*, const size_t, const size_t*, const size_t*, const size_t*, const size_t, index_t**, \
+			const float*); \
+	template void cpp_knn_batch_pyramid_omp<index_t>(const float*, const size_t, const size_t, const size_t, \
+			const size_t*, const size_t, const size_t*, const size_t*, const size_t*, const size_t, index_t**, \
+			const float*); \
+	template void cpp_knn_batch_pyramid_parallel<index_t>(const float*, const size_t, const size_t, const size_t, \
+			const size_t*, const size_t, const size_t*, const size_t*, const size_t*, const size_t, index_t**, \
+			const float*, const knn_parallel_for&); \
+	template void cpp_knn_batch_voxel<index_t>(const float*, const size_t, const size_t, const size_t, \
+			const float*, const size_t, const size_t, index_t*); \
+	template void cpp_knn_batch_voxel_omp<index_t>(const float*, const size_t, const size_t, const size_t, \
+			const float*, const size_t, const size_t, index_t*); \
+	template void cpp_voxel_grid::search<index_t>(const float*, const size_t, const size_t, const size_t, \
+			index_t*, float*) const;
+
+INSTANTIATE_KNN(int)
+INSTANTIATE_KNN(long)
+
+
+typedef KDTree cpp_kdtree_t;
+
+cpp_kdtree::cpp_kdtree(const float* points, const size_t npts, const size_t dim, const size_t leaf_size)
+	: npts(npts), dim(dim), leaf_size(leaf_size){
+	// the adaptor constructor builds the index
+	tree = new cpp_kdtree_t(npts, dim, points, leaf_size);
+}
+
+cpp_kdtree::cpp_kdtree(const float* points, const size_t npts, const size_t dim, const char* index_file)
+	: npts(npts), dim(dim){
+	// the file is closed and a partly loaded tree freed on every error
+	std::unique_ptr<FILE, int(*)(FILE*)> stream(fopen(index_file, "rb"), fclose);
+	if(!stream){
+		throw std::ios_base::failure(std::string("cannot open the kd-tree index ") + index_file);
+	}
+	// the points are not stored in the index file, only the tree over them
+	std::unique_ptr<cpp_kdtree_t> mat_index(new cpp_kdtree_t(npts, dim, points, 10, false));
+	try{
+		mat_index->index->loadIndex(stream.get());
+	}catch(const std::exception& e){
+		// e.g. a truncated file
+		throw std::runtime_error(std::string("cannot read the kd-tree index ") + index_file + ": " + e.what());
+	}
+	const bool valid = !ferror(stream.get()) && !feof(stream.get()) && mat_index->index->m_size == npts
+		&& size_t(mat_index->index->dim) == dim && mat_index->index->vind.size() == npts;
+	if(!valid){
+		throw std::runtime_error(std::string("the kd-tree index ") + index_file + " does not match the points");
+	}
+	leaf_size = mat_index->index->m_leaf_max_size;
+	tree = mat_index.release();
+}
+
+cpp_kdtree::~cpp_kdtree(){
+	delete static_cast<cpp_kdtree_t*>(tree);
+}
+
+void cpp_kdtree::knn(const float* queries, const size_t nqueries, const size_t K,
+			long* indices, float* dists_sqr, const bool omp) const{
+
+	const cpp_kdtree_t* mat_index = static_cast<const cpp_kdtree_t*>(tree);
+
+	// iterate over the points
+# pragma omp parallel for if(omp) num_threads(cpp_knn_num_threads())
+	for(size_t i=0; i<nqueries; i++){
+		std::vector<size_t> out_ids(K);
+		std::vector<float> out_dists_sqr(K);
+
+		nanoflann::KNNResultSet<float> resultSet(K);
+		resultSet.init(&out_ids[0], &out_dists_sqr[0] );
+		mat_index->index->findNeighbors(resultSet, &queries[i*dim], nanoflann::SearchParams(10));
+		for(size_t j=0; j<K; j++){
+			indices[i*K+j] = long(out_ids[j]);
+			dists_sqr[i*K+j] = out_dists_sqr[j];
+		}
+	}
+}
+
+size_t cpp_kdtree::radius(const float* query, const float radius_sqr,
+			std::vector<std::pair<size_t, float> >& indices_dists, const bool sorted) const{
+
+	const cpp_kdtree_t* mat_index = static_cast<const cpp_kdtree_t*>(tree);
+	return mat_index->index->radiusSearch(query, radius_sqr, indices_dists, nanoflann::SearchParams(10, 0, sorted));
+}
+
+void cpp_kdtree::save(const char* index_file) const{
+
+	FILE* stream = fopen(index_file, "wb");
+	if(!stream){
+		throw std::ios_base::failure(std::string("cannot write the kd-tree index ") + index_file);
+	}
+	static_cast<cpp_kdtree_t*>(tree)->index->saveIndex(stream);
+	const bool failed = ferror(stream);
+	if(fclose(stream) != 0 || failed){
+		throw std::ios_base::failure(std::string("cannot write the kd-tree index ") + index_file);
+	}
+}
+
+void cpp_kdtree::crop(const float* query, const size_t K, long* indices, float* dists_sqr, float& radius_sqr) const{
+
+	const cpp_kdtree_t* mat_index = static_cast<const cpp_kdtree_t*>(tree);
+	const float* points = mat_index->m_data;
+	std::vector<std::pair<size_t, float> > indices_dists;
+
+	if(K >= npts){
+		// the whole cloud
+		for(size_t i=0; i<npts; i++){
+			float dist_sqr = 0;
+			for(size_t d=0; d<dim; d++){
+				const float diff = points[i*dim+d] - query[d];
+				dist_sqr += diff * diff;
+			}
+			indices[i] = long(i);
+			dists_sqr[i] = dist_sqr;
+		}
+		return;
+	}
+
+	if(!(radius_sqr > 0)){
+		// first guess: the cube holding K points at the mean density of the bounding box
+		double volume = 1;
+		double diagonal_sqr = 0;
+		for(size_t d=0; d<dim; d++){
+			const double extent = mat_index->index->root_bbox[d].high - mat_index->index->root_bbox[d].low;
+			volume *= extent;
+			diagonal_sqr += extent * extent;
+		}
+		// positive floor: the radius searches are strict, and a cloud of duplicates has no extent
+		const double side = pow(volume * K / npts, 1.0 / dim);
+		radius_sqr = std::max(float(side > 0 ? side * side : diagonal_sqr), std::numeric_limits<float>::min());
+	}
+
+	// unsorted radius searches, growing the radius until it holds K points
+	for(;;){
+		const size_t n = mat_index->index->radiusSearch(query, radius_sqr, indices_dists,
+			nanoflann::SearchParams(10, 0, false));
+		if(n >= K){
+			break;
+		}
+		const double growth = n > 0 ? pow(1.2 * K / n, 2.0 / dim) : 4.0;
+		radius_sqr = float(radius_sqr * growth);
+	}
+
+	// K points at distance 0 (duplicates of the query) are the crop as they are, otherwise partial selection of the
+	// K nearest, left unsorted
+	size_t num_zero = 0;
+	for(size_t j=0; j<indices_dists.size() && num_zero<K; j++){
+		if(indices_dists[j].second == 0){
+			std::swap(indices_dists[num_zero++], indices_dists[j]);
+		}
+	}
+	if(num_zero < K){
+		std::nth_element(indices_dists.begin(), indices_dists.begin() + (K - 1), indices_dists.end(),
+			nanoflann::IndexDist_Sorter());
+	}
+	for(size_t j=0; j<K; j++){
+		indices[j] = long(indices_dists[j].first);
+		dists_sqr[j] = indices_dists[j].second;
+	}
+
+	// radius for the next crop, a bit larger than the one of this crop
+	radius_sqr = std::max(float(indices_dists[K - 1].second * pow(1.1, 2.0 / dim)), std::numeric_limits<float>::min());
+}
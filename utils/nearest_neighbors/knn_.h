@@ -1,22 +1,42 @@
 
 
 #include <cstdlib>
+#include <functional>
+#include <utility>
+#include <vector>
+
+// cap of the threads of the omp searches (0: omp default)
+void cpp_knn_set_num_threads(const int num_threads);
+int cpp_knn_num_threads();
+
+// support sets up to npts points are searched by brute force instead of a kd-tree
+void cpp_knn_set_brute_force_npts(const size_t npts);
+size_t cpp_knn_brute_force_npts();
+
+// the kd-tree searches are eps-approximate: the squared distance of the K-th neighbour found is at most (1 + eps)
+// times the exact one (the brute force and voxel grid searches are always exact). The pyramid searches take one eps
+// per search (NULL: all exact).
+
+template <typename index_t>
 void cpp_knn(const float* points, const size_t npts, const size_t dim,
 			const float* queries, const size_t nqueries,
-			const size_t K, long* indices);
+			const size_t K, index_t* indices, const float eps = 0);
 
+template <typename index_t>
 void cpp_knn_omp(const float* points, const size_t npts, const size_t dim,
 			const float* queries, const size_t nqueries,
-			const size_t K, long* indices);
+			const size_t K, index_t* indices, const float eps = 0);
 
 
+template <typename index_t>
 void cpp_knn_batch(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
 			const float* queries, const size_t nqueries,
-			const size_t K, long* batch_indices);
+			const size_t K, index_t* batch_indices, const float eps = 0);
 
+template <typename index_t>
 void cpp_knn_batch_omp(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
 				const float* queries, const size_t nqueries,
-				const size_t K, long* batch_indices);
+				const size_t K, index_t* batch_indices, const float eps = 0);
 
 void cpp_knn_batch_distance_pick(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
 				float* queries, const size_t nqueries,
@@ -25,3 +45,102 @@ void cpp_knn_batch_distance_pick(const float* batch_data, const size_t batch_siz
 void cpp_knn_batch_distance_pick_omp(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
 				float* batch_queries, const size_t nqueries,
 				const size_t K, long* batch_indices);
+
+template <typename index_t>
+void cpp_knn_batch_pyramid(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+				const size_t* level_npts, const size_t nlevels,
+				const size_t* support_levels, const size_t* query_levels, const size_t* Ks, const size_t nsearches,
+				index_t** batch_indices, const float* eps = NULL);
+
+template <typename index_t>
+void cpp_knn_batch_pyramid_omp(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+				const size_t* level_npts, const size_t nlevels,
+				const size_t* support_levels, const size_t* query_levels, const size_t* Ks, const size_t nsearches,
+				index_t** batch_indices, const float* eps = NULL);
+
+// parallel_for(nunits, cost, work) runs work(first, last) over a partition of the units [0, nunits) on some thread
+// pool and returns once they are all done (cost: rough number of operations of a unit)
+typedef std::function<void(size_t, double, const std::function<void(size_t, size_t)>&)> knn_parallel_for;
+
+// cpp_knn_batch_pyramid_omp on another thread pool
+template <typename index_t>
+void cpp_knn_batch_pyramid_parallel(const float* batch_data, const size_t batch_size, const size_t npts,
+				const size_t dim, const size_t* level_npts, const size_t nlevels,
+				const size_t* support_levels, const size_t* query_levels, const size_t* Ks, const size_t nsearches,
+				index_t** batch_indices, const float* eps, const knn_parallel_for& parallel_for);
+
+template <typename index_t>
+void cpp_knn_batch_voxel(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+			const float* queries, const size_t nqueries,
+			const size_t K, index_t* batch_indices);
+
+template <typename index_t>
+void cpp_knn_batch_voxel_omp(const float* batch_data, const size_t batch_size, const size_t npts, const size_t dim,
+				const float* queries, const size_t nqueries,
+				const size_t K, index_t* batch_indices);
+
+
+// kd-tree kept alive between queries, the points are not copied and must outlive the tree
+class cpp_kdtree{
+public:
+	cpp_kdtree(const float* points, const size_t npts, const size_t dim, const size_t leaf_size);
+	cpp_kdtree(const float* points, const size_t npts, const size_t dim, const char* index_file);
+	~cpp_kdtree();
+
+	void knn(const float* queries, const size_t nqueries, const size_t K,
+			long* indices, float* dists_sqr, const bool omp) const;
+
+	size_t radius(const float* query, const float radius_sqr,
+			std::vector<std::pair<size_t, float> >& indices_dists, const bool sorted) const;
+
+	void crop(const float* query, const size_t K, long* indices, float* dists_sqr, float& radius_sqr) const;
+
+	void save(const char* index_file) const;
+
+	size_t npts;
+	size_t dim;
+	size_t leaf_size;
+
+private:
+	cpp_kdtree(const cpp_kdtree&);
+	cpp_kdtree& operator=(const cpp_kdtree&);
+	void* tree;
+};
+
+
+// uniform grid of voxels over 3d points, for clouds of bounded density (grid sub-sampled), with exact knn searches
+// by rings of voxels around the query. The points are not copied and must outlive the grid.
+class cpp_voxel_grid{
+public:
+	cpp_voxel_grid(const float* points, const size_t npts, const size_t dim);
+
+	// K nearest of the queries [start, end), sorted by increasing distance (dists_sqr can be NULL)
+	template <typename index_t>
+	void search(const float* queries, const size_t start, const size_t end, const size_t K,
+			index_t* indices, float* dists_sqr) const;
+
+	void knn(const float* queries, const size_t nqueries, const size_t K,
+			long* indices, float* dists_sqr, const bool omp) const;
+
+	// K nearest of a single query, in no particular order, found as cpp_kdtree::crop
+	void crop(const float* query, const size_t K, long* indices, float* dists_sqr, float& radius_sqr) const;
+
+	size_t nbytes() const;
+
+	size_t npts;
+	size_t dim;
+	double voxel_size;
+
+private:
+	void query_voxel(const float* query, long* voxel) const;
+	long voxel_index(const double coord, const size_t d) const;
+	template <typename F>
+	void for_ring(const long* center, const long r, F visit) const;
+	double unvisited_distance(const float* query, const long* center, const long r) const;
+
+	const float* points;
+	double origin[3];
+	long shape[3];
+	std::vector<unsigned int> voxel_start;
+	std::vector<unsigned int> point_ids;
+};
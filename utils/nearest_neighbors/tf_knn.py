@@ -0,0 +1,36 @@
+""" TensorFlow knn ops (compiled by compile_tf_op.sh), running on the intra-op thread pool instead of tf.py_func.
+"""
+
+import os
+import tensorflow as tf
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+knn_module = tf.load_op_library(os.path.join(BASE_DIR, 'lib', 'tf', 'tf_knn_op.so'))
+
+
+def knn_search(support_pts, query_pts, k):
+    """
+    :param support_pts: points you have, B*N1*3
+    :param query_pts: points you want to know the neighbour index, B*N2*3
+    :param k: Number of neighbours in knn search
+    :return: neighbor_idx: neighboring points indexes, B*N2*k (int32)
+    """
+    return knn_module.knn_search(support_pts, query_pts, k=k)
+
+
+def knn_pyramid(pts, sub_sampling_ratio, searches, eps=None):
+    """
+    :param pts: input points, B*N*3 (level i+1 is made of the first N_i // sub_sampling_ratio[i] points of level i)
+    :param sub_sampling_ratio: sub-sampling ratio of each layer
+    :param searches: list of (support level, query level, k)
+    :param eps: approximation of the first searches, as in nearest_neighbors.knn (the other searches are exact)
+    :return: list of B*N_query_level*k neighbour indexes (int32), one per search
+    """
+    eps = [] if eps is None else [float(e) for e in eps] + [0.0] * (len(searches) - len(eps))
+    return knn_module.knn_pyramid(pts,
+                                  sub_sampling_ratio=list(sub_sampling_ratio),
+                                  support_levels=[s[0] for s in searches],
+                                  query_levels=[s[1] for s in searches],
+                                  ks=[s[2] for s in searches],
+                                  num_searches=len(searches),
+                                  eps=eps)
@@ -0,0 +1,245 @@
+// TensorFlow ops running the nanoflann knn searches on the intra-op thread pool (no tf.py_func, no GIL)
+
+#include "tensorflow/core/framework/op.h"
+#include "tensorflow/core/framework/op_kernel.h"
+#include "tensorflow/core/framework/shape_inference.h"
+#include "tensorflow/core/util/work_sharder.h"
+
+#include "knn_.h"
+#include "nanoflann.hpp"
+#include "KDTreeTableAdaptor.h"
+
+#include <functional>
+#include <memory>
+#include <vector>
+
+using namespace tensorflow;
+using shape_inference::DimensionHandle;
+using shape_inference::InferenceContext;
+using shape_inference::ShapeHandle;
+
+typedef KDTreeTableAdaptor< float, float> KDTree;
+
+
+REGISTER_OP("KnnSearch")
+	.Input("support_pts: float32")
+	.Input("query_pts: float32")
+	.Attr("k: int >= 1")
+	.Output("neighbor_idx: int32")
+	.SetShapeFn([](InferenceContext* c) {
+		ShapeHandle support_pts;
+		ShapeHandle query_pts;
+		TF_RETURN_IF_ERROR(c->WithRank(c->input(0), 3, &support_pts));
+		TF_RETURN_IF_ERROR(c->WithRank(c->input(1), 3, &query_pts));
+
+		int k;
+		TF_RETURN_IF_ERROR(c->GetAttr("k", &k));
+
+		DimensionHandle batch_size;
+		TF_RETURN_IF_ERROR(c->Merge(c->Dim(support_pts, 0), c->Dim(query_pts, 0), &batch_size));
+		c->set_output(0, c->MakeShape({batch_size, c->Dim(query_pts, 1), k}));
+		return Status::OK();
+	})
+	.Doc(R"doc(
+Indices of the k nearest support points of every query point, B*N2*k.
+support_pts: points you have, B*N1*dim
+query_pts: points you want to know the neighbour index, B*N2*dim
+)doc");
+
+
+REGISTER_OP("KnnPyramid")
+	.Input("pts: float32")
+	.Attr("sub_sampling_ratio: list(int)")
+	.Attr("support_levels: list(int)")
+	.Attr("query_levels: list(int)")
+	.Attr("ks: list(int)")
+	.Attr("num_searches: int >= 1")
+	.Attr("eps: list(float) = []")
+	.Output("neighbor_idx: num_searches * int32")
+	.SetShapeFn([](InferenceContext* c) {
+		ShapeHandle pts;
+		TF_RETURN_IF_ERROR(c->WithRank(c->input(0), 3, &pts));
+
+		std::vector<int> sub_sampling_ratio;
+		std::vector<int> query_levels;
+		std::vector<int> ks;
+		TF_RETURN_IF_ERROR(c->GetAttr("sub_sampling_ratio", &sub_sampling_ratio));
+		TF_RETURN_IF_ERROR(c->GetAttr("query_levels", &query_levels));
+		TF_RETURN_IF_ERROR(c->GetAttr("ks", &ks));
+
+		// number of points of each level (unknown when the number of input points is unknown)
+		std::vector<DimensionHandle> level_npts(1, c->Dim(pts, 1));
+		for(size_t i=0; i<sub_sampling_ratio.size(); i++){
+			DimensionHandle npts;
+			TF_RETURN_IF_ERROR(c->Divide(level_npts.back(), sub_sampling_ratio[i], false, &npts));
+			level_npts.push_back(npts);
+		}
+
+		for(size_t sid=0; sid<ks.size(); sid++){
+			if(query_levels[sid] < 0 || query_levels[sid] >= int(level_npts.size())){
+				return errors::InvalidArgument("KnnPyramid: invalid query level ", query_levels[sid]);
+			}
+			c->set_output(sid, c->MakeShape({c->Dim(pts, 0), level_npts[query_levels[sid]], ks[sid]}));
+		}
+		return Status::OK();
+	})
+	.Doc(R"doc(
+All the knn searches of a sub-sampling pyramid, level l+1 being the first N_l / sub_sampling_ratio[l] points of
+level l. The kd-tree of a level is built once and shared by all the searches using it as support.
+pts: input points, B*N*dim
+neighbor_idx: one B*N_query_level*k tensor per (support_level, query_level, k) search
+)doc");
+
+
+class KnnSearchOp : public OpKernel {
+public:
+	explicit KnnSearchOp(OpKernelConstruction* context) : OpKernel(context) {
+		OP_REQUIRES_OK(context, context->GetAttr("k", &k_));
+	}
+
+	void Compute(OpKernelContext* context) override {
+		const Tensor& support_pts = context->input(0);
+		const Tensor& query_pts = context->input(1);
+		OP_REQUIRES(context, support_pts.dims() == 3 && query_pts.dims() == 3,
+			errors::InvalidArgument("KnnSearch expects B*N*dim support and query points"));
+
+		const int64 batch_size = support_pts.dim_size(0);
+		const int64 npts = support_pts.dim_size(1);
+		const int64 dim = support_pts.dim_size(2);
+		const int64 nqueries = query_pts.dim_size(1);
+		const int64 K = k_;
+		OP_REQUIRES(context, query_pts.dim_size(0) == batch_size && query_pts.dim_size(2) == dim,
+			errors::InvalidArgument("KnnSearch: support and query points do not match"));
+		OP_REQUIRES(context, npts >= K,
+			errors::InvalidArgument("KnnSearch: k=", K, " is larger than the number of support points ", npts));
+
+		Tensor* neighbor_idx = nullptr;
+		OP_REQUIRES_OK(context, context->allocate_output(0, TensorShape({batch_size, nqueries, K}), &neighbor_idx));
+		if(batch_size * nqueries == 0){
+			return;
+		}
+
+		const float* support_data = support_pts.flat<float>().data();
+		const float* query_data = query_pts.flat<float>().data();
+		int* indices = neighbor_idx->flat<int>().data();
+		auto workers = context->device()->tensorflow_cpu_worker_threads();
+
+		// build the trees of all the batch elements in parallel
+		std::vector<std::unique_ptr<KDTree> > trees(batch_size);
+		Shard(workers->num_threads, workers->workers, batch_size, npts * 50,
+			[&](int64 start, int64 end) {
+				for(int64 bid=start; bid<end; bid++){
+					trees[bid].reset(new KDTree(npts, dim, &support_data[bid*npts*dim], 10));
+				}
+			});
+
+		// then spread the queries of every batch element over the pool
+		Shard(workers->num_threads, workers->workers, batch_size * nqueries, K * 200,
+			[&](int64 start, int64 end) {
+				std::vector<size_t> out_ids(K);
+				std::vector<float> out_dists_sqr(K);
+				for(int64 qid=start; qid<end; qid++){
+					nanoflann::KNNResultSet<float> resultSet(K);
+					resultSet.init(&out_ids[0], &out_dists_sqr[0]);
+					trees[qid / nqueries]->index->findNeighbors(resultSet, &query_data[qid*dim],
+						nanoflann::SearchParams(10));
+					for(int64 j=0; j<K; j++){
+						indices[qid*K+j] = int(out_ids[j]);
+					}
+				}
+			});
+	}
+
+private:
+	int k_;
+};
+
+REGISTER_KERNEL_BUILDER(Name("KnnSearch").Device(DEVICE_CPU), KnnSearchOp);
+
+
+class KnnPyramidOp : public OpKernel {
+public:
+	explicit KnnPyramidOp(OpKernelConstruction* context) : OpKernel(context) {
+		std::vector<int> support_levels;
+		std::vector<int> query_levels;
+		std::vector<int> ks;
+		int num_searches;
+		OP_REQUIRES_OK(context, context->GetAttr("sub_sampling_ratio", &sub_sampling_ratio_));
+		OP_REQUIRES_OK(context, context->GetAttr("support_levels", &support_levels));
+		OP_REQUIRES_OK(context, context->GetAttr("query_levels", &query_levels));
+		OP_REQUIRES_OK(context, context->GetAttr("ks", &ks));
+		OP_REQUIRES_OK(context, context->GetAttr("num_searches", &num_searches));
+		OP_REQUIRES_OK(context, context->GetAttr("eps", &eps_));
+		OP_REQUIRES(context, int(support_levels.size()) == num_searches && int(query_levels.size()) == num_searches
+			&& int(ks.size()) == num_searches,
+			errors::InvalidArgument("KnnPyramid: support_levels, query_levels and ks must have num_searches values"));
+		// no eps: exact searches
+		OP_REQUIRES(context, eps_.empty() || int(eps_.size()) == num_searches,
+			errors::InvalidArgument("KnnPyramid: eps must be empty or have num_searches values"));
+		eps_.resize(num_searches, 0);
+
+		const int nlevels = sub_sampling_ratio_.size() + 1;
+		for(int i=0; i<int(sub_sampling_ratio_.size()); i++){
+			OP_REQUIRES(context, sub_sampling_ratio_[i] >= 1,
+				errors::InvalidArgument("KnnPyramid: invalid sub-sampling ratio ", sub_sampling_ratio_[i]));
+		}
+		for(int sid=0; sid<num_searches; sid++){
+			OP_REQUIRES(context, support_levels[sid] >= 0 && support_levels[sid] < nlevels
+				&& query_levels[sid] >= 0 && query_levels[sid] < nlevels && ks[sid] >= 1,
+				errors::InvalidArgument("KnnPyramid: invalid search ", sid));
+			support_levels_.push_back(support_levels[sid]);
+			query_levels_.push_back(query_levels[sid]);
+			ks_.push_back(ks[sid]);
+		}
+	}
+
+	void Compute(OpKernelContext* context) override {
+		const Tensor& pts = context->input(0);
+		OP_REQUIRES(context, pts.dims() == 3, errors::InvalidArgument("KnnPyramid expects B*N*dim points"));
+
+		const int64 batch_size = pts.dim_size(0);
+		const int64 npts = pts.dim_size(1);
+		const int64 dim = pts.dim_size(2);
+		const size_t nsearches = ks_.size();
+
+		std::vector<size_t> level_npts(1, npts);
+		for(size_t i=0; i<sub_sampling_ratio_.size(); i++){
+			level_npts.push_back(level_npts.back() / sub_sampling_ratio_[i]);
+		}
+
+		OpOutputList outputs;
+		OP_REQUIRES_OK(context, context->output_list("neighbor_idx", &outputs));
+		std::vector<int*> indices(nsearches);
+		for(size_t sid=0; sid<nsearches; sid++){
+			OP_REQUIRES(context, level_npts[support_levels_[sid]] >= ks_[sid],
+				errors::InvalidArgument("KnnPyramid: k=", ks_[sid], " is larger than the support level ",
+					support_levels_[sid]));
+			Tensor* neighbor_idx = nullptr;
+			const int64 nqueries = level_npts[query_levels_[sid]];
+			OP_REQUIRES_OK(context, outputs.allocate(sid, TensorShape({batch_size, nqueries, int64(ks_[sid])}),
+				&neighbor_idx));
+			indices[sid] = neighbor_idx->flat<int>().data();
+		}
+
+		const float* data = pts.flat<float>().data();
+		auto workers = context->device()->tensorflow_cpu_worker_threads();
+
+		// the units of work of the omp kernel (the trees of every level and batch element, then the blocks of
+		// queries of every search and batch element) spread over the pool
+		cpp_knn_batch_pyramid_parallel<int>(data, batch_size, npts, dim, &level_npts[0], level_npts.size(),
+			&support_levels_[0], &query_levels_[0], &ks_[0], nsearches, &indices[0], &eps_[0],
+			[workers](size_t nunits, double cost, const std::function<void(size_t, size_t)>& work){
+				Shard(workers->num_threads, workers->workers, nunits, int64(cost),
+					[&work](int64 start, int64 end) { work(start, end); });
+			});
+	}
+
+private:
+	std::vector<int> sub_sampling_ratio_;
+	std::vector<size_t> support_levels_;
+	std::vector<size_t> query_levels_;
+	std::vector<size_t> ks_;
+	std::vector<float> eps_;
+};
+
+REGISTER_KERNEL_BUILDER(Name("KnnPyramid").Device(DEVICE_CPU), KnnPyramidOp);
@@ -0,0 +1,73 @@
+import numpy as np
+
+# base colors of the classes of utils/meta/class_names.txt
+class_colors = np.array([[230, 230, 225], [140, 120, 100], [200, 195, 185], [180, 180, 170], [190, 185, 175],
+                         [120, 160, 200], [150, 100, 60], [170, 130, 80], [60, 60, 70], [110, 40, 40],
+                         [130, 90, 50], [240, 240, 240], [100, 140, 90]])
+label_values = {name: i for i, name in enumerate(['ceiling', 'floor', 'wall', 'beam', 'column', 'window', 'door',
+                                                  'table', 'chair', 'sofa', 'bookcase', 'board', 'clutter'])}
+
+
+def sample_rectangle(rng, origin, u, v, density):
+    # points on the rectangle origin + [0, 1] * u + [0, 1] * v
+    area = np.linalg.norm(np.cross(u, v))
+    n = rng.poisson(density * area)
+    return origin + rng.rand(n, 1) * np.array(u) + rng.rand(n, 1) * np.array(v)
+
+
+def sample_box(rng, low, size, density, bottom=False):
+    # points on the faces of an axis aligned box (without its bottom face by default)
+    dx, dy, dz = np.diag(size)
+    low = np.array(low, dtype=np.float64)
+    faces = [(low + dz, dx, dy), (low, dx, dz), (low + dy, dx, dz), (low, dy, dz), (low + dx, dy, dz)]
+    faces += [(low, dx, dy)] if bottom else []
+    return np.concatenate([sample_rectangle(rng, o, u, v, density) for o, u, v in faces])
+
+
+def synthetic_room(rng, density=5000.0, noise=0.005):
+    """
+    S3DIS-like room: floor, ceiling and walls with a door, a window and a board, a column, tables with chairs, a sofa,
+    a bookcase and clutter, sampled on their surfaces with some sensor noise
+    :param rng: np.random.RandomState
+    :param density: points per square meter of surface
+    :param noise: standard deviation of the sensor noise
+    :return: xyz (N*3 float32, minimum at 0), colors (N*3 uint8), labels (N, uint8) of utils/meta/class_names.txt
+    """
+    length, width, height = rng.uniform(4, 10), rng.uniform(3, 8), rng.uniform(2.6, 3.2)
+    parts = []
+
+    def add(name, points):
+        parts.append((label_values[name], points))
+
+    # shell of the room, the openings are thin boxes just in front of the walls
+    add('floor', sample_rectangle(rng, [0, 0, 0], [length, 0, 0], [0, width, 0], density))
+    add('ceiling', sample_rectangle(rng, [0, 0, height], [length, 0, 0], [0, width, 0], density))
+    for origin, u in [([0, 0, 0], [length, 0, 0]), ([0, width, 0], [length, 0, 0]),
+                      ([0, 0, 0], [0, width, 0]), ([length, 0, 0], [0, width, 0])]:
+        add('wall', sample_rectangle(rng, origin, u, [0, 0, height], density))
+    add('door', sample_box(rng, [rng.uniform(0.2, length - 1.2), -0.02, 0], [0.9, 0.04, 2.1], density))
+    add('window', sample_box(rng, [rng.uniform(0.2, length - 1.8), width - 0.02, 0.9], [1.5, 0.04, 1.2], density))
+    add('board', sample_box(rng, [-0.02, rng.uniform(0.2, width - 2.2), 0.9], [0.04, 2.0, 1.1], density))
+    add('column', sample_box(rng, [length - 0.4, width - 0.4, 0], [0.4, 0.4, height], density))
+    add('beam', sample_box(rng, [0, width / 2 - 0.15, height - 0.3], [length, 0.3, 0.3], density, bottom=True))
+
+    # furniture
+    for _ in range(rng.randint(1, 4)):
+        x, y = rng.uniform(1, length - 2.5), rng.uniform(1, width - 2)
+        add('table', sample_box(rng, [x, y, 0.72], [1.6, 0.8, 0.04], density, bottom=True))
+        for cx in [x + 0.3, x + 1.0]:
+            add('chair', sample_box(rng, [cx, y - 0.5, 0], [0.45, 0.45, 0.45], density))
+            add('chair', sample_box(rng, [cx, y - 0.5, 0.45], [0.45, 0.05, 0.45], density))
+    add('sofa', sample_box(rng, [0.1, rng.uniform(0.2, width - 2.2), 0], [0.9, 2.0, 0.45], density))
+    add('bookcase', sample_box(rng, [length - 0.45, rng.uniform(0.2, width - 1.4), 0], [0.4, 1.0, 1.8], density))
+    for _ in range(rng.randint(3, 10)):
+        size = rng.uniform(0.1, 0.5, 3)
+        add('clutter', sample_box(rng, [rng.uniform(0, length - size[0]), rng.uniform(0, width - size[1]), 0], size,
+                                  density))
+
+    xyz = np.concatenate([points for _, points in parts])
+    xyz += rng.normal(scale=noise, size=xyz.shape)
+    labels = np.concatenate([np.full(len(points), label, dtype=np.uint8) for label, points in parts])
+    colors = class_colors[labels] + rng.normal(scale=12, size=xyz.shape)
+    xyz -= np.amin(xyz, axis=0)
+    return xyz.astype(np.float32), np.clip(colors, 0, 255).astype(np.uint8), labels